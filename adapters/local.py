@@ -1,12 +1,40 @@
-import shutil
+import argparse
 import os
 import os.path
+import sys
+import tempfile
+
+if __name__ == '__main__':
+    # allow running the migration tool directly from the adapters directory
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import cache
+from exile import fastcopy
+from exile import worker
 
 template = {
     "location": "/path/to/repo"
 }
 
+# copies between local disks gain little from more threads than this
+max_threads = 32
+
+# gets and puts are handed to get_many and put_many in batches of this many objects
+batch_size = 32
+
+# the objects of a batch are copied on this many threads at once, so that the copies of a batch
+# overlap like those of separate tasks would (on a network mount, each copy waits for round trips)
+BATCH_THREADS = 8
+
+# temporary files in the repository start with this prefix so they are never mistaken for objects
+TEMP_PREFIX = '.tmp-'
+
 class Communicator:
+    """
+    Stores objects in a local (or network mounted) directory. Objects are spread across
+    subdirectories named by the first two hex digits of their digest, like the object cache.
+    """
+
     def __init__(self, config):
         try:
             self.__location = config['location']
@@ -20,10 +48,93 @@ class Communicator:
             raise RuntimeError("configured repository location is not a directory: " + self.__location)
 
     def get(self, hash, dest):
-        shutil.copy(self.__repoPath(hash), dest)
+        path = self.__repoPath(hash)
+        if not os.path.exists(path):
+            # repositories that haven't been migrated yet store objects in a single directory
+            path = os.path.join(self.__location, hash)
+
+        fastcopy.copy(path, dest)
 
     def put(self, source, hash):
-        shutil.copy(source, self.__repoPath(hash))
+        path = self.__repoPath(hash)
+
+        # objects are named by their contents, so an existing object never needs rewriting
+        if os.path.exists(path):
+            return
+
+        dir = os.path.dirname(path)
+        try:
+            os.mkdir(dir)
+        except OSError:
+            pass
+
+        # copy next to the final path and rename, so readers never see a partial object
+        fd, tmp = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=dir)
+        os.close(fd)
+        try:
+            fastcopy.copy(source, tmp)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Windows won't rename over an existing file, in which case
+                # another client already uploaded the same object
+                if not os.path.isfile(path):
+                    raise
+                os.remove(tmp)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def get_many(self, items):
+        worker.parallel(self.get, items, BATCH_THREADS)
+
+    def put_many(self, items):
+        worker.parallel(self.put, items, BATCH_THREADS)
+
+    def exists_many(self, hashes):
+        # a stat per object is cheaper than listing the subdirectories, which may hold many objects
+        return set(hash for hash in hashes if os.path.isfile(self.__repoPath(hash)) or os.path.isfile(os.path.join(self.__location, hash)))
+
+    def list(self, prefix):
+        # the prefix ends with the first two digits of the digest, which name the subdirectory
+        try:
+            names = os.listdir(os.path.join(self.__location, prefix[-2:]))
+        except OSError:
+            return []
+        return [name for name in names if name.startswith(prefix)]
 
     def __repoPath(self, hash):
-        return os.sep.join([self.__location, hash])
+        return os.sep.join([self.__location, cache.shard(hash), hash])
+
+def migrate(location):
+    """
+    Moves the objects of a repository created by an older version of exile, which stored every
+    object directly in the repository directory, into subdirectories.
+
+    Returns:
+        the number of objects moved
+    """
+    moved = 0
+    for name in os.listdir(location):
+        old = os.path.join(location, name)
+        if name.startswith('.') or not os.path.isfile(old):
+            continue
+
+        dir = os.path.join(location, cache.shard(name))
+        try:
+            os.mkdir(dir)
+        except OSError:
+            pass
+
+        os.rename(old, os.path.join(dir, name))
+        moved += 1
+
+    return moved
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move the objects of a local exile repository created by an older version of exile into subdirectories.")
+    parser.add_argument("location", help="the path of the repository")
+    args = parser.parse_args()
+
+    print "moved %d objects" % (migrate(args.location))
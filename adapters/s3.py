@@ -1,27 +1,148 @@
 import boto
-import hashlib
+import boto.exception
+import boto.s3.connection
+import boto.s3.multipart
+import contextlib
 import os
 import os.path
+import sys
 import tempfile
+import threading
+
+from exile import cache
+from exile import hashing
+from exile import worker
 
 template = {
     "id": "<Access Key ID>",
     "secret": "<Secret Access Key>",
     "bucket": "mybucket",
     "encrypt": False,
-    "reduced_redundancy": False
+    "reduced_redundancy": False,
+    "multipart_threshold": "64M",
+    "part_size": "16M",
+    "part_threads": 4,
+    "connections": 32
 }
 
-def compute_hash(path):
-    """Compute the SHA1 hash of a file"""
+# objects larger than this are transferred in parts, unless "multipart_threshold" is configured
+MULTIPART_THRESHOLD = 64 * 1024 ** 2
+
+# the size of each part, unless "part_size" is configured
+PART_SIZE = 16 * 1024 ** 2
+
+# S3 rejects multipart uploads with smaller parts (except for the last one), so smaller configured
+# part sizes are raised to this
+MIN_PART_SIZE = 5 * 1024 ** 2
+
+# the number of parts of an object transferred at once, unless "part_threads" is configured
+PART_THREADS = 4
+
+# S3 accepts no more parts than this for an object, so larger objects use larger parts
+MAX_PARTS = 10000
+
+# the most connections a process keeps open to a bucket, unless "connections" is configured
+CONNECTIONS = 32
+
+# gets and puts are handed to get_many and put_many in batches of this many objects, which are
+# transferred at once on the connections of the pool
+batch_size = 32
 
-    with open(path, 'rb') as file:
-        h = hashlib.sha1()
+# the most keys exists_many asks for in a single listing
+LIST_PAGE = 1000
 
-        for block in iter(lambda: file.read(65536), ''):
-            h.update(block)
+# connection pools shared among all threads of the process, by the configuration they connect with
+pools = {}
+pools_lock = threading.Lock()
 
-        return h.hexdigest()
+class ConnectionPool:
+    """
+    A bounded set of connections to a bucket, shared by every thread of the process. A boto
+    connection may only be used by one thread at a time, so each request takes a connection from
+    the pool and returns it afterwards, keeping it alive for the next request rather than paying
+    for a new TCP (and TLS) handshake. Once size connections are in use, threads wait for one to
+    be returned.
+    """
+
+    def __init__(self, connect, bucket_name, key_class, size):
+        """
+        Args:
+            connect: a function creating a new connection
+            bucket_name: the name of the bucket
+            key_class: if not None, set as the key factory of the bucket objects
+            size: the most connections open at once
+        """
+        self.__connect = connect
+        self.__bucket_name = bucket_name
+        self.__key_class = key_class
+        self.__size = size
+        self.__condition = threading.Condition()
+        self.__idle = []        # buckets on connections that aren't in use
+        self.__open = 0         # the number of connections created
+        self.__hits = 0         # requests that reused an idle connection
+        self.__misses = 0       # requests that created a connection
+        self.__waits = 0        # requests that waited for a connection to be returned
+
+    @contextlib.contextmanager
+    def bucket(self):
+        """Returns a context manager providing a bucket object on a connection that no other thread is using."""
+
+        bucket = self.__acquire()
+        try:
+            yield bucket
+        finally:
+            with self.__condition:
+                self.__idle.append(bucket)
+                self.__condition.notify()
+
+    def __acquire(self):
+        with self.__condition:
+            if not self.__idle and self.__open >= self.__size:
+                self.__waits += 1
+                while not self.__idle:
+                    self.__condition.wait()
+
+            if self.__idle:
+                self.__hits += 1
+                return self.__idle.pop()
+
+            self.__misses += 1
+            self.__open += 1
+
+        try:
+            # the bucket is assumed to exist rather than looked up, which would cost a request for
+            # each connection; requests to a missing bucket fail with NoSuchBucket instead
+            bucket = self.__connect().get_bucket(self.__bucket_name, validate=False)
+        except:
+            with self.__condition:
+                self.__open -= 1
+                self.__condition.notify()
+            raise
+
+        if self.__key_class is not None:
+            bucket.key_class = self.__key_class
+        return bucket
+
+    def stats(self):
+        """Returns a dict with the number of connections opened, and the hits, misses and waits of requests for one."""
+
+        with self.__condition:
+            return {
+                'connections': self.__open,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'waits': self.__waits
+            }
+
+def stats():
+    """Returns the stats (see ConnectionPool.stats) of the process's connection pools, summed."""
+
+    totals = { 'connections': 0, 'hits': 0, 'misses': 0, 'waits': 0 }
+    with pools_lock:
+        for pool in pools.itervalues():
+            for name, value in pool.stats().iteritems():
+                totals[name] += value
+    return totals
 
 class Communicator:
     def __init__(self, config, key_class=None):
@@ -37,36 +158,105 @@ class Communicator:
             self.__id = config['id']
             self.__secret = config['secret']
             self.__bucket_name = config['bucket']
-            self.__bucket_conn = None   # connection initialized lazily
         except KeyError as e:
             raise Exception("missing required configuration: " + str(e))
 
-        self.__key_class = key_class
         self.__encrypt = config.get('encrypt', False)
         self.__rr = config.get('reduced_redundancy', False)
 
-    def __bucket(self):
-        """Lazily creates the S3 connection, which is then reused for future requests."""
-        if self.__bucket_conn is None:
-            # uses HTTPS by default
-            conn = boto.connect_s3(self.__id, self.__secret)
-            self.__bucket_conn = conn.get_bucket(self.__bucket_name)
-            if self.__key_class is not None:
-                self.__bucket_conn.key_class = self.__key_class
-        return self.__bucket_conn
+        # S3-compatible services (or a local stand-in) are configured with a host and port
+        self.__host = config.get('host')
+        self.__port = config.get('port')
+        self.__secure = config.get('secure', True)
 
-    def get(self, hash, dest):
-        key = self.__bucket().get_key(hash)
-        if key is None:
-            raise RuntimeError("no such key: " + hash) 
+        self.__threshold = cache.parse_size(config.get('multipart_threshold', MULTIPART_THRESHOLD))
+        self.__part_size = max(MIN_PART_SIZE, cache.parse_size(config.get('part_size', PART_SIZE)))
+        self.__part_threads = config.get('part_threads', PART_THREADS)
 
+        # every communicator of the process connecting the same way shares a pool
+        self.__connections = config.get('connections', CONNECTIONS)
+        pool_key = (self.__id, self.__secret, self.__bucket_name, self.__host, self.__port, self.__secure, key_class)
+        with pools_lock:
+            if pool_key not in pools:
+                pools[pool_key] = ConnectionPool(self.__connect, self.__bucket_name, key_class, self.__connections)
+            self.__pool = pools[pool_key]
+
+    def __connect(self):
+        """Creates an S3 connection, which uses HTTPS unless "secure" is false."""
+        options = { 'is_secure': self.__secure }
+        if self.__host is not None:
+            # other services don't necessarily have a subdomain for each bucket
+            options['host'] = self.__host
+            options['calling_format'] = boto.s3.connection.OrdinaryCallingFormat()
+        if self.__port is not None:
+            options['port'] = self.__port
+        return boto.connect_s3(self.__id, self.__secret, **options)
+
+    def __parts(self, size, start=0):
+        """Splits the bytes of an object from start to size into a list of (offset, length) parts."""
+        part_size = max(self.__part_size, -(-(size - start) // MAX_PARTS))
+        return [(offset, min(part_size, size - offset)) for offset in xrange(start, size, part_size)]
+
+    def __parallel(self, function, parts):
+        """
+        Calls function(number, offset, length) for each part, numbered from 1, on up to
+        part_threads threads (see worker.parallel).
+        """
+        worker.parallel(function, [(number, offset, length) for number, (offset, length) in enumerate(parts, 1)], self.__part_threads)
+
+    def __download(self, hash, path):
+        """
+        Downloads an object to a file. The first request only asks for the first
+        multipart_threshold bytes, which is the whole object unless it is larger. Otherwise the
+        size in the response splits the rest into ranges that are downloaded in parallel, each
+        written straight to its offset in the file.
+        """
+        # the connection is returned before downloading the rest, which takes connections of its own
+        with open(path, 'wb') as file, self.__pool.bucket() as bucket:
+            key = bucket.new_key(hash)
+            try:
+                key.get_contents_to_file(file, headers={ 'Range': 'bytes=0-%d' % (self.__threshold - 1) })
+            except boto.exception.S3ResponseError as e:
+                # an empty object has no bytes to request
+                if e.status != 416:
+                    raise
+                file.seek(0)
+                file.truncate()
+                key = bucket.new_key(hash)     # the key holds on to the failed response
+                key.get_contents_to_file(file)
+
+        if key.size is None or key.size <= self.__threshold:
+            return
+
+        def get_part(number, offset, length):
+            with open(path, 'r+b') as file, self.__pool.bucket() as bucket:
+                file.seek(offset)
+                bucket.new_key(hash).get_contents_to_file(file, headers={ 'Range': 'bytes=%d-%d' % (offset, offset + length - 1) })
+
+        self.__parallel(get_part, self.__parts(key.size, self.__threshold))
+
+    def get(self, hash, dest):
         # check for validity after download, retry once
         for tries in range(2):
             tmpfd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.realpath(dest)))
-            with os.fdopen(tmpfd, 'wb') as file:
-                key.get_contents_to_file(file)
+            os.close(tmpfd)
+            try:
+                # a key created locally skips the HEAD request get_key would make, and a
+                # missing object is reported by the download instead
+                self.__download(hash, tmp)
+            except boto.exception.S3ResponseError as e:
+                os.remove(tmp)
+                if e.error_code == 'NoSuchBucket':
+                    raise RuntimeError("no such bucket: " + self.__bucket_name)
+                if e.status == 404:
+                    raise RuntimeError("no such key: " + hash)
+                raise
+            except:
+                os.remove(tmp)
+                raise
 
-            if hash == compute_hash(tmp):
+            # verify using the algorithm the object was named with
+            if hash == hashing.hash(tmp, hashing.algorithm(hash)):
                 try:
                     os.rename(tmp, dest)
                 except WindowsError as e:
@@ -82,4 +272,61 @@ class Communicator:
         raise Exception('error: object corrupt: ' + hash)
 
     def put(self, source, hash):
-        self.__bucket().new_key(hash).set_contents_from_filename(source, encrypt_key=self.__encrypt, reduced_redundancy=self.__rr)
+        size = os.path.getsize(source)
+        if size <= self.__threshold:
+            with self.__pool.bucket() as bucket:
+                bucket.new_key(hash).set_contents_from_filename(source, encrypt_key=self.__encrypt, reduced_redundancy=self.__rr)
+            return
+
+        with self.__pool.bucket() as bucket:
+            upload = bucket.initiate_multipart_upload(hash, encrypt_key=self.__encrypt, reduced_redundancy=self.__rr)
+        try:
+            def put_part(number, offset, length):
+                with open(source, 'rb') as file, self.__pool.bucket() as bucket:
+                    part = boto.s3.multipart.MultiPartUpload(bucket)
+                    part.key_name = hash
+                    part.id = upload.id
+                    file.seek(offset)
+                    part.upload_part_from_file(file, number, size=length)
+
+            self.__parallel(put_part, self.__parts(size))
+            with self.__pool.bucket() as bucket:
+                upload.bucket = bucket
+                upload.complete_upload()
+        except:
+            with self.__pool.bucket() as bucket:
+                upload.bucket = bucket
+                upload.cancel_upload()
+            raise
+
+    def get_many(self, items):
+        # S3 has no bulk requests, so the objects are transferred at once on the pool's connections
+        worker.parallel(self.get, items, self.__connections)
+
+    def put_many(self, items):
+        worker.parallel(self.put, items, self.__connections)
+
+    def exists_many(self, hashes):
+        """
+        Lists the bucket from just before each name that no earlier listing reached, rather than
+        making a HEAD request per name, so names that are close together in the bucket (or all of
+        them, in a bucket of up to LIST_PAGE objects) are answered by a single request.
+        """
+        found = set()
+        listed = set()
+        end = ''    # the last key of the latest listing, or None once a listing reached the end of the bucket
+        with self.__pool.bucket() as bucket:
+            for hash in sorted(set(hashes)):
+                while end is not None and hash > end:
+                    # the marker is exclusive, and the name with its last digit dropped sorts just before it
+                    keys = bucket.get_all_keys(marker=max(hash[:-1], end), max_keys=LIST_PAGE)
+                    listed = set(key.name for key in keys)
+                    end = keys[-1].name if keys.is_truncated else None
+
+                if hash in listed:
+                    found.add(hash)
+        return found
+
+    def list(self, prefix):
+        with self.__pool.bucket() as bucket:
+            return [key.name for key in bucket.list(prefix=prefix)]
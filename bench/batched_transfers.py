@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Resolves many small objects (2000 by default) from a local repository whose requests are slowed
+down to look like a remote with a fixed round trip per request. The local adapter as shipped,
+which hands batches of objects to get_many to transfer at once, is compared with the same adapter
+without a batch_size, which transfers one object per network task.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import worker
+
+parser = argparse.ArgumentParser(description="Benchmark batched transfers.")
+parser.add_argument("-n", "--objects", type=int, default=2000,
+                    help="the number of objects to resolve (default: 2000)")
+parser.add_argument("-l", "--latency", type=float, default=20.0,
+                    help="the round trip added to each request in ms (default: 20)")
+args = parser.parse_args()
+
+work = tempfile.mkdtemp()
+try:
+    repo = os.path.join(work, 'repo')
+    os.mkdir(repo)
+    config = { 'type': 'local', 'location': repo }
+
+    module = worker.load_comm_module(config)
+    comm = module.Communicator(config)
+    names = []
+    source = os.path.join(work, 'source')
+    for i in range(args.objects):
+        with open(source, 'wb') as file:
+            file.write(str(i))
+        names.append('%040x' % (i))
+        comm.put(source, names[-1])
+
+    load_comm_module = worker.load_comm_module
+
+    def resolve(label, batched):
+        # the pool reloads the adapter, so slow down the module it loads
+        def load_slow_module(config):
+            module = load_comm_module(config)
+            communicator = module.Communicator
+            get = communicator.get
+
+            def slow_get(self, hash, dest):
+                time.sleep(args.latency / 1000.0)
+                get(self, hash, dest)
+            communicator.get = slow_get
+
+            if not batched:
+                del module.batch_size
+            return module
+
+        worker.load_comm_module = load_slow_module
+        try:
+            pool = worker.AsyncCommunicator(work, os.path.join(work, label + '-cache'), config, False)
+        finally:
+            worker.load_comm_module = load_comm_module
+
+        start = time.time()
+        for i, name in enumerate(names):
+            pool.get(name, os.path.join(work, label, str(i)))
+        pool.join()
+        stats = pool.stats()['network']
+        print "%-10s %8.3f s %6d network tasks %4d threads" % (label, time.time() - start, stats['tasks'], stats['threads'])
+
+    print "%d objects, %g ms per request" % (args.objects, args.latency)
+    resolve('single', False)
+    resolve('batched', True)
+finally:
+    shutil.rmtree(work)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Compares object lookup and insert latency in the flat and sharded object cache layouts.
+
+Creates N empty objects (10^5 by default, try -n 1000000) in a flat directory and in an
+ObjectCache, then measures the average time to insert an object, to look up present and
+missing objects (as CachedCommunicator.fetch does) and to list and stat every object. Use --dir to
+run on the filesystem you care about (e.g. NTFS or a network mount).
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import cache
+
+parser = argparse.ArgumentParser(description="Benchmark object cache layouts.")
+parser.add_argument("-n", "--objects", type=int, default=100000,
+                    help="the number of objects to create (default: 100000)")
+parser.add_argument("-l", "--lookups", type=int, default=20000,
+                    help="the number of lookups to time (default: 20000)")
+parser.add_argument("-d", "--dir",
+                    help="the directory in which to create the caches")
+args = parser.parse_args()
+
+names = [hashlib.sha1(str(i)).hexdigest() for i in range(args.objects)]
+missing = [hashlib.sha1('missing' + str(i)).hexdigest() for i in range(args.lookups)]
+present = random.sample(names, min(args.lookups, len(names)))
+
+def us(elapsed, count):
+    return elapsed / count * 1000000
+
+def run(label, path):
+    start = time.time()
+    for name in names:
+        open(path(name), 'w').close()
+    insert = time.time() - start
+
+    start = time.time()
+    for name in present:
+        os.path.exists(path(name))
+    hit = time.time() - start
+
+    start = time.time()
+    for name in missing:
+        os.path.exists(path(name))
+    miss = time.time() - start
+
+    start = time.time()
+    listed = list(objects())
+    listing = time.time() - start
+
+    print "%-8s insert %6.1f us  hit %6.1f us  miss %6.1f us  list %6.2f s" % (
+        label, us(insert, len(names)), us(hit, len(present)), us(miss, len(missing)), listing)
+
+work = tempfile.mkdtemp(dir=args.dir)
+try:
+    print "%d objects" % (args.objects)
+
+    flat = os.path.join(work, 'flat')
+    os.mkdir(flat)
+    objects = lambda: [(name, os.stat(os.path.join(flat, name))) for name in os.listdir(flat)]
+    run('flat', lambda name: os.path.join(flat, name))
+
+    sharded = cache.ObjectCache(os.path.join(work, 'sharded'))
+    objects = sharded.objects
+    run('sharded', sharded.path)
+finally:
+    shutil.rmtree(work)
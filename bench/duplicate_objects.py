@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+Resolves many paths that share a few objects (1000 paths, 10 objects by default) from a local
+repository whose downloads are slowed down to look like a remote, counting the downloads made
+with and without coalescing concurrent fetches of the same object.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import remote
+from exile import worker
+
+parser = argparse.ArgumentParser(description="Benchmark resolving duplicate objects.")
+parser.add_argument("-n", "--paths", type=int, default=1000,
+                    help="the number of paths to resolve (default: 1000)")
+parser.add_argument("-o", "--objects", type=int, default=10,
+                    help="the number of distinct objects (default: 10)")
+parser.add_argument("-l", "--latency", type=float, default=200,
+                    help="the latency added to each download in ms (default: 200)")
+args = parser.parse_args()
+
+class Uncoalesced:
+    """Runs every call, as fetch did before it was coalesced."""
+    def run(self, key, function):
+        function()
+        return True
+
+work = tempfile.mkdtemp()
+try:
+    repo = os.path.join(work, 'repo')
+    os.mkdir(repo)
+    config = { 'type': 'local', 'location': repo }
+
+    module = worker.load_comm_module(config)
+    comm = module.Communicator(config)
+    names = []
+    source = os.path.join(work, 'source')
+    for i in range(args.objects):
+        with open(source, 'wb') as file:
+            file.write(str(i) * 1024 * 1024)
+        names.append('%040x' % (i))
+        comm.put(source, names[-1])
+
+    downloads = [0]
+    lock = threading.Lock()
+
+    def resolve(label, fetches):
+        remote.fetches = fetches
+        downloads[0] = 0
+        pool = worker.AsyncCommunicator(work, os.path.join(work, label + '-cache'), config, False)
+
+        # the pool reloads the adapter, so slow down the class its threads will use
+        communicator = sys.modules['local'].Communicator
+        get = communicator.get
+        def slow_get(self, hash, dest):
+            with lock:
+                downloads[0] += 1
+            time.sleep(args.latency / 1000.0)
+            get(self, hash, dest)
+        communicator.get = slow_get
+
+        start = time.time()
+        for i in range(args.paths):
+            pool.get(names[i % len(names)], os.path.join(work, label, str(i)))
+        pool.join()
+        print "%-12s %8.3f s %6d downloads" % (label, time.time() - start, downloads[0])
+
+    print "%d paths sharing %d objects, %g ms per download" % (args.paths, args.objects, args.latency)
+    resolve('uncoalesced', Uncoalesced())
+    resolve('coalesced', remote.SingleFlight())
+finally:
+    shutil.rmtree(work)
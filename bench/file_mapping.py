@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Measures FileMapping operations on a large manifest (10^6 files by default).
+
+The manifest is spread over a directory tree with --fanout entries per directory. Reported
+times cover building the flat index, single-file lookups (as resolve and add do for every
+file), listing every file under the root and under one directory, adding files and removing
+a directory.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import files
+
+parser = argparse.ArgumentParser(description="Benchmark FileMapping on large manifests.")
+parser.add_argument("-n", "--files", type=int, default=1000000,
+                    help="the number of files in the manifest (default: 1000000)")
+parser.add_argument("-f", "--fanout", type=int, default=100,
+                    help="the number of entries per directory (default: 100)")
+parser.add_argument("-l", "--lookups", type=int, default=100000,
+                    help="the number of lookups and adds to time (default: 100000)")
+args = parser.parse_args()
+
+root = os.path.realpath(tempfile.gettempdir())
+
+# build a nested manifest, e.g. d0/d3/f17
+config = {}
+paths = []
+for i in range(args.files):
+    parts = []
+    n = i / args.fanout
+    while n:
+        parts.insert(0, 'd%d' % (n % args.fanout))
+        n /= args.fanout
+    parent = config
+    for part in parts:
+        parent = parent.setdefault(part, {})
+    name = 'f%d' % (i % args.fanout)
+    parent[name] = '%040x' % (i)
+    paths.append(os.path.join(root, *(parts + [name])))
+
+mapping = files.FileMapping(root, config, silent=True)
+
+def timed(label, count, function):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    print "%-28s %8.3f s  %8.2f us/op" % (label, elapsed, elapsed / max(count, 1) * 1000000)
+
+print "%d files" % (args.files)
+sample = random.sample(paths, min(args.lookups, len(paths)))
+timed('build index', args.files, mapping.index)
+timed('get', len(sample), lambda: [mapping.get(path) for path in sample])
+timed('items (root)', args.files, lambda: mapping.items(root))
+directory = os.path.dirname(sample[0])
+timed('items (one directory)', 1, lambda: mapping.items(directory))
+timed('add', len(sample), lambda: [mapping.add(path + '.new', 'x' * 40) for path in sample])
+timed('remove (one directory)', 1, lambda: mapping.remove(directory))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+Compares the throughput of the object naming algorithms supported by exile.hashing.
+
+A file of random data is generated (2 GB by default) and hashed once with each available
+algorithm. Run it against a file on the disk you care about with --path to include real
+I/O; the first pass over a freshly generated file is usually served from the page cache.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import hashing
+
+MB = 1024 * 1024
+
+parser = argparse.ArgumentParser(description="Benchmark hash throughput per algorithm.")
+parser.add_argument("-s", "--size", type=int, default=2048,
+                    help="the size of the generated file in MB (default: 2048)")
+parser.add_argument("-p", "--path",
+                    help="hash an existing file instead of generating one")
+args = parser.parse_args()
+
+if args.path:
+    path = args.path
+else:
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as file:
+        for _ in range(args.size):
+            file.write(os.urandom(MB))
+
+try:
+    size = os.path.getsize(path)
+    print "hashing %d MB" % (size / MB)
+
+    for base in sorted(hashing.ALGORITHMS):
+        for algorithm in [base, base + hashing.TREE_SUFFIX]:
+            try:
+                hashing.new(algorithm)
+            except RuntimeError as e:
+                print "%-14s skipped: %s" % (algorithm, e)
+                continue
+
+            start = time.time()
+            hashing.hash(path, algorithm)
+            elapsed = time.time() - start
+            print "%-14s %8.1f MB/s" % (algorithm, size / MB / elapsed)
+finally:
+    if not args.path:
+        os.remove(path)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Compares opening a large manifest (10^6 files by default) by parsing its JSON against opening
+its memory-mapped index, as resolve does for a single file. Also reports the time to build the
+index, which is paid whenever the manifest is written.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import files
+from exile import index
+
+parser = argparse.ArgumentParser(description="Benchmark the manifest index against parsing the manifest.")
+parser.add_argument("-n", "--files", type=int, default=1000000,
+                    help="the number of files in the manifest (default: 1000000)")
+parser.add_argument("-f", "--fanout", type=int, default=100,
+                    help="the number of entries per directory (default: 100)")
+args = parser.parse_args()
+
+root = os.path.realpath(tempfile.mkdtemp())
+manifest = os.path.join(root, 'exile.manifest')
+
+def timed(label, function):
+    start = time.time()
+    result = function()
+    print "%-36s %8.3f s" % (label, time.time() - start)
+    return result
+
+try:
+    # build a nested manifest, e.g. d0/d3/f17
+    tree = {}
+    for i in range(args.files):
+        parts = []
+        n = i / args.fanout
+        while n:
+            parts.insert(0, 'd%d' % (n % args.fanout))
+            n /= args.fanout
+        parent = tree
+        for part in parts:
+            parent = parent.setdefault(part, {})
+        parent['f%d' % (i % args.fanout)] = '%040x' % (i)
+
+    config = { 'version': 2, 'remote': { 'type': 'local', 'location': root }, 'files': tree }
+    del tree
+
+    def dump():
+        with open(manifest, 'wb') as file:
+            json.dump(config, file, indent=4, sort_keys=True)
+    timed('json.dump (write manifest)', dump)
+    timed('build index', lambda: index.write(manifest, config))
+    del config
+
+    target = os.path.join(root, 'd1', 'd2', 'f3')
+    print "%d files, %d byte manifest" % (args.files, os.path.getsize(manifest))
+
+    def parse():
+        with open(manifest, 'r') as file:
+            config = json.load(file)
+        return files.FileMapping(root, config['files'], True).items(target)
+    expected = timed('json.load + items (one file)', parse)
+
+    def mapped():
+        mapping = index.load(manifest)
+        try:
+            return mapping.items(target)
+        finally:
+            mapping.close()
+    assert timed('index load + items (one file)', mapped) == expected
+
+    # an index written within a moment of the manifest is checked against the manifest's digest
+    timed('manifest digest (recent manifest)', lambda: index.manifest_digest(manifest))
+
+    def directory():
+        mapping = index.load(manifest)
+        try:
+            return len(mapping.items(os.path.join(root, 'd1')))
+        finally:
+            mapping.close()
+    timed('index load + items (directory)', directory)
+finally:
+    shutil.rmtree(root)
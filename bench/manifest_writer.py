@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Compares writing a large manifest (10^6 files by default) with json.dump against exile's
+manifest writer, for a new file, an unchanged manifest and a manifest with one changed file.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import manifest
+
+parser = argparse.ArgumentParser(description="Benchmark writing large manifests.")
+parser.add_argument("-n", "--files", type=int, default=1000000,
+                    help="the number of files in the manifest (default: 1000000)")
+parser.add_argument("-f", "--fanout", type=int, default=100,
+                    help="the number of entries per directory (default: 100)")
+args = parser.parse_args()
+
+root = tempfile.mkdtemp()
+path = os.path.join(root, 'exile.manifest')
+
+def timed(label, function):
+    start = time.time()
+    result = function()
+    print "%-36s %8.3f s" % (label, time.time() - start)
+    return result
+
+try:
+    # build a nested manifest, e.g. d0/d3/f17
+    tree = {}
+    for i in range(args.files):
+        parts = []
+        n = i / args.fanout
+        while n:
+            parts.insert(0, 'd%d' % (n % args.fanout))
+            n /= args.fanout
+        parent = tree
+        for part in parts:
+            parent = parent.setdefault(part, {})
+        parent['f%d' % (i % args.fanout)] = '%040x' % (i)
+    config = { 'version': 2, 'remote': { 'type': 'local', 'location': root }, 'files': tree }
+
+    print "%d files" % (args.files)
+
+    def dump():
+        with open(path, 'wb') as file:
+            json.dump(config, file, indent=4, sort_keys=True)
+    timed('json.dump', dump)
+    with open(path, 'rb') as file:
+        expected = file.read()
+
+    os.remove(path)
+    timed('manifest.write (new file)', lambda: manifest.write(path, config))
+    with open(path, 'rb') as file:
+        assert file.read() == expected
+    del expected
+
+    assert not timed('manifest.write (unchanged)', lambda: manifest.write(path, config))
+
+    # a file near the end of the manifest, then one near the start
+    tree['d99']['f0'] = '0' * 40
+    assert timed('manifest.write (change near end)', lambda: manifest.write(path, config))
+    tree['f0'] = '1' * 40
+    assert timed('manifest.write (change near start)', lambda: manifest.write(path, config))
+finally:
+    shutil.rmtree(root)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+Times a resolve in which every file is already up to date (100k files by default): handing every
+file to the worker threads to check against the snapshot (as resolve used to) against checking
+them up front, a directory at a time.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import log
+from exile import remote
+from exile import worker
+
+parser = argparse.ArgumentParser(description="Benchmark a resolve of up-to-date files.")
+parser.add_argument("-n", "--files", type=int, default=100000,
+                    help="the number of files (default: 100000)")
+parser.add_argument("-f", "--fanout", type=int, default=100,
+                    help="the number of files per directory (default: 100)")
+args = parser.parse_args()
+
+log.verbosity = 0
+
+root = os.path.realpath(tempfile.mkdtemp())
+try:
+    repo = os.path.join(root, 'repo')
+    os.mkdir(repo)
+
+    snapshot = remote.load_snapshot(root)
+    items = []
+    for i in range(args.files):
+        dir = os.path.join(root, 'd%d' % (i / args.fanout))
+        if i % args.fanout == 0:
+            os.mkdir(dir)
+        path = os.path.join(dir, 'f%d' % (i % args.fanout))
+        with open(path, 'wb') as file:
+            file.write(str(i))
+        items.append((path, '%040x' % (i)))
+        snapshot.add(path, items[-1][1])
+    snapshot.write()
+
+    print "%d up-to-date files" % (args.files)
+
+    comm = worker.AsyncCommunicator(root, os.path.join(root, 'cache'), { 'type': 'local', 'location': repo }, False)
+    start = time.time()
+    for path, hash in items:
+        comm.get(hash, path)
+    comm.join()
+    print "%-32s %8.3f s" % ('dispatch every file', time.time() - start)
+
+    start = time.time()
+    outdated = list(snapshot.outdated(items))
+    print "%-32s %8.3f s (%d outdated)" % ('check by directory', time.time() - start, len(outdated))
+finally:
+    shutil.rmtree(root)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Resolves objects from a local repository whose downloads are slowed down to look like a remote
+(20 ms each by default), with downloading and placing each object on the same thread (as before
+the pipeline was split) and then through the network and disk stages. Prints the utilization of
+each stage.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import remote
+from exile import worker
+
+parser = argparse.ArgumentParser(description="Benchmark the staged transfer pipeline.")
+parser.add_argument("-n", "--objects", type=int, default=2000,
+                    help="the number of objects to resolve (default: 2000)")
+parser.add_argument("-s", "--size", type=int, default=256,
+                    help="the size of each object in KB (default: 256)")
+parser.add_argument("-l", "--latency", type=float, default=20,
+                    help="the latency added to each download in ms (default: 20)")
+args = parser.parse_args()
+
+work = tempfile.mkdtemp()
+try:
+    repo = os.path.join(work, 'repo')
+    os.mkdir(repo)
+    config = { 'type': 'local', 'location': repo }
+
+    module = worker.load_comm_module(config)
+    comm = module.Communicator(config)
+    names = []
+    source = os.path.join(work, 'source')
+    for i in range(args.objects):
+        with open(source, 'wb') as file:
+            file.write(str(i).ljust(args.size * 1024))
+        names.append('%040x' % (i))
+        comm.put(source, names[-1])
+
+    get = module.Communicator.get
+    def slow_get(self, hash, dest):
+        time.sleep(args.latency / 1000.0)
+        get(self, hash, dest)
+    module.Communicator.get = slow_get
+
+    def resolve(label, staged):
+        pool = worker.AsyncCommunicator(work, os.path.join(work, label + '-cache'), config, False)
+        start = time.time()
+        for name in names:
+            dest = os.path.join(work, label, name)
+            if staged:
+                pool.get(name, dest)
+            else:
+                pool.submit(remote.CachedCommunicator.get, name, dest)
+        pool.join()
+        print "%-10s %8.3f s" % (label, time.time() - start)
+        for stage, stats in sorted(pool.stats().iteritems()):
+            print "  %-8s %6d tasks %4d threads %5.0f%% utilization %6.2f s blocked" % (
+                stage, stats['tasks'], stats['threads'], stats['utilization'] * 100, stats['blocked'])
+
+    print "%d objects of %d KB, %g ms per download" % (args.objects, args.size, args.latency)
+    resolve('combined', False)
+    resolve('staged', True)
+finally:
+    shutil.rmtree(work)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Uploads a tree of objects (2000 by default) of which most (90% by default) are already on a local
+repository whose requests are slowed down to look like a remote behind a shared link, which always
+transfers the whole object on a put. Compares uploading every object with skipping the objects the
+remote is found to have, by looking them up or listing their prefixes, counting the bytes transferred.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import inventory
+from exile import worker
+
+parser = argparse.ArgumentParser(description="Benchmark skipping uploads with the remote inventory.")
+parser.add_argument("-n", "--objects", type=int, default=2000,
+                    help="the number of objects to upload (default: 2000)")
+parser.add_argument("-u", "--uploaded", type=float, default=0.9,
+                    help="the fraction of objects already on the remote (default: 0.9)")
+parser.add_argument("-s", "--size", type=int, default=64,
+                    help="the size of each object in KB (default: 64)")
+parser.add_argument("-l", "--latency", type=float, default=20,
+                    help="the round trip added to each request in ms (default: 20)")
+parser.add_argument("-b", "--bandwidth", type=float, default=100.0,
+                    help="the bandwidth of the link shared by all uploads in MB/s (default: 100)")
+args = parser.parse_args()
+
+work = tempfile.mkdtemp()
+try:
+    repo = os.path.join(work, 'repo')
+    os.mkdir(repo)
+    config = { 'type': 'local', 'location': repo }
+
+    module = worker.load_comm_module(config)
+    comm = module.Communicator(config)
+    sources = []
+    for i in range(args.objects):
+        source = os.path.join(work, 'source-%d' % (i))
+        with open(source, 'wb') as file:
+            file.write(('%08d' % (i)) * (args.size * 128))
+        name = '%040x' % (i * 7919 % 65536 * 2 ** 144 + i)     # spread across prefixes
+        sources.append((source, name))
+        if i < args.objects * args.uploaded:
+            comm.put(source, name)
+
+    transferred = [0]
+    link = threading.Lock()     # held while an upload uses the link
+
+    def upload(label, force):
+        # each run starts from the same remote, with a fresh cache (and so an empty inventory)
+        location = os.path.join(work, label + '-repo')
+        shutil.copytree(repo, location)
+        cache_path = os.path.join(work, label + '-cache')
+        pool = worker.AsyncCommunicator(work, cache_path, { 'type': 'local', 'location': location }, force)
+
+        # the pool reloads the adapter, so slow down the class its threads will use
+        communicator = sys.modules['local'].Communicator
+        put = communicator.put
+        list = communicator.list
+        exists_many = communicator.exists_many
+        def slow_put(self, source, hash):
+            time.sleep(args.latency / 1000.0)
+            size = os.path.getsize(source)
+            with link:
+                transferred[0] += size
+                time.sleep(size / (args.bandwidth * 1024 ** 2))
+            put(self, source, hash)
+        def slow_list(self, prefix):
+            time.sleep(args.latency / 1000.0)
+            return list(self, prefix)
+        def slow_exists_many(self, hashes):
+            # a request per object, like the HEAD requests of the s3 adapter
+            time.sleep(len(hashes) * args.latency / 1000.0)
+            return exists_many(self, hashes)
+        communicator.put = slow_put
+        communicator.list = slow_list
+        communicator.exists_many = slow_exists_many
+
+        transferred[0] = 0
+        start = time.time()
+        for source, name in sources:
+            pool.put(source, name)
+        pool.join()
+        print "%-14s %8.3f s %8.1f MB transferred" % (label, time.time() - start, transferred[0] / 1024.0 ** 2)
+
+    print "%d objects of %d KB, %d%% already uploaded, %g ms per request, %g MB/s" % (args.objects, args.size, args.uploaded * 100, args.latency, args.bandwidth)
+    upload('upload all', True)
+    upload('inventory', False)
+finally:
+    shutil.rmtree(work)
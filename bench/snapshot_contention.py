@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Measures how snapshot updates scale with the number of worker threads.
+
+Each thread repeatedly looks up and records entries for its own files, as
+CachedCommunicator.get does for every resolved file. "locked" wraps every call in a single
+global lock, as exile did before snapshots kept per-thread deltas, while "delta" calls the
+snapshot directly. The locked variant also serializes the path resolution (realpath) done
+for every lookup, which otherwise runs in parallel with I/O in other threads.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import remote
+
+parser = argparse.ArgumentParser(description="Benchmark snapshot lock contention.")
+parser.add_argument("-o", "--operations", type=int, default=200000,
+                    help="the total number of lookups and updates per run (default: 200000)")
+parser.add_argument("-t", "--threads", type=int, nargs='*', default=[1, 2, 8, 32, 250],
+                    help="the thread counts to measure (default: 1 2 8 32 250)")
+args = parser.parse_args()
+
+def worker(snapshot, lock, root, id, count, stat):
+    paths = [os.path.join(root, 'dir%d' % (id), 'file%d' % (i)) for i in range(count)]
+    for path in paths:
+        if lock is None:
+            snapshot.current(path, 'hash', stat)
+            snapshot.add(path, 'hash', stat)
+        else:
+            with lock:
+                snapshot.current(path, 'hash', stat)
+            with lock:
+                snapshot.add(path, 'hash', stat)
+
+def run(threads, lock):
+    root = os.path.realpath(tempfile.mkdtemp())
+    try:
+        snapshot = remote.Snapshot(root)
+        stat = os.stat(root)
+        count = args.operations / threads
+
+        workers = [threading.Thread(target=worker, args=(snapshot, lock, root, id, count, stat)) for id in range(threads)]
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        snapshot.merge()
+        return count * threads / (time.time() - start)
+    finally:
+        shutil.rmtree(root)
+
+print "%8s %14s %14s" % ('threads', 'locked ops/s', 'delta ops/s')
+for threads in args.threads:
+    print "%8d %14d %14d" % (threads, run(threads, threading.Lock()), run(threads, None))
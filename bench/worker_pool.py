@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Measures the worker pool: the cost of resolving a single object (which used to start 250
+threads, each with its own communicator, before doing any work) and of resolving many objects
+through the local adapter, along with the number of threads the pool ended up using.
+"""
+
+import argparse
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from exile import remote
+from exile import worker
+
+parser = argparse.ArgumentParser(description="Benchmark the adaptive worker pool.")
+parser.add_argument("-n", "--objects", type=int, default=2000,
+                    help="the number of objects to resolve (default: 2000)")
+args = parser.parse_args()
+
+work = tempfile.mkdtemp()
+try:
+    repo = os.path.join(work, 'repo')
+    os.mkdir(repo)
+    config = { 'type': 'local', 'location': repo }
+
+    names = []
+    source = os.path.join(work, 'source')
+    comm = worker.load_comm_module(config).Communicator(config)
+    for i in range(args.objects):
+        with open(source, 'wb') as file:
+            file.write('object %d' % (i))
+        names.append('%040x' % (i))
+        comm.put(source, names[-1])
+
+    def eager():
+        # what the pool used to do before accepting any work
+        module = worker.load_comm_module(config)
+        def main():
+            remote.CachedCommunicator(work, os.path.join(work, 'eager-cache'), False, module.Communicator(copy.deepcopy(config)))
+        threads = [threading.Thread(target=main) for _ in range(worker.THREAD_COUNT)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def resolve(count, cache):
+        pool = worker.AsyncCommunicator(work, os.path.join(work, cache), config, False)
+        for i, name in enumerate(names[:count]):
+            pool.get(name, os.path.join(work, cache + '-files', str(i)))
+        # counted before join, which stops the threads
+        threads = threading.active_count() - 1
+        pool.join()
+        return threads
+
+    start = time.time()
+    eager()
+    print "%-40s %8.3f s" % ('start %d threads and communicators' % (worker.THREAD_COUNT), time.time() - start)
+
+    start = time.time()
+    resolve(1, 'one')
+    print "%-40s %8.3f s" % ('resolve 1 object', time.time() - start)
+
+    start = time.time()
+    threads = resolve(args.objects, 'many')
+    print "%-40s %8.3f s (%d threads)" % ('resolve %d objects' % (args.objects), time.time() - start, threads)
+finally:
+    shutil.rmtree(work)
@@ -5,13 +5,21 @@ import exile
 import hashlib
 import imp
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import shutil
 import sys
 import time
 
 MANIFEST_NAME = "exile.manifest"
+# version 1 manifests name objects by a hash of their path and contents, version 2 by contents alone
+MANIFEST_VERSION = 2
 CACHE_DIR = "exile.cache"
+DAY = 24 * 60 * 60
+
+# actions that only read the manifest, and so can use its index instead of parsing it
+READ_ONLY_ACTIONS = ['resolve', 'cache']
 
 def find_config():
     """Looks for a config file at or above the current directory."""
@@ -57,6 +65,46 @@ def find_cache(root, config):
 
     return cache_path
 
+def cache_limits(config):
+    """
+    Reads the configured limits of the object cache.
+
+    Returns:
+        a (max size in bytes, max age in seconds) tuple, where either may be None if unlimited
+    """
+
+    max_size = config['remote'].get('cache_size', None)
+    if max_size is not None:
+        max_size = exile.cache.parse_size(max_size)
+
+    max_age = config['remote'].get('cache_age', None)
+    if max_age is not None:
+        max_age = float(max_age) * DAY
+
+    return max_size, max_age
+
+def trim_cache():
+    """Evicts the least recently used objects from the object cache if it exceeds its configured limits."""
+
+    max_size, max_age = cache_limits(config)
+    if max_size is not None or max_age is not None:
+        removed, freed = exile.cache.ObjectCache(cache_path).evict(max_size, max_age)
+        if removed:
+            exile.log.info("evicted %d objects (%d bytes) from the object cache" % (removed, freed))
+
+def write_index(config, stat=None):
+    """
+    Rebuilds the index of the manifest, which lets read-only actions skip parsing the manifest.
+
+    Args:
+        config: the parsed configuration
+        stat: the stat of the manifest when it was parsed, if it may have changed since
+    """
+    try:
+        exile.index.write(config_path, config, stat)
+    except (IOError, OSError) as e:
+        exile.log.info("could not write the manifest index: " + str(e))
+
 def init(type):
     """
     Create a blank manifest in the current directory populated with the template configuration for the specified remote type.
@@ -84,9 +132,8 @@ def init(type):
     if not hasattr(template, 'type'):
         template['type'] = type
 
-    config = { "remote": template }
-    with open('exile.manifest', 'wb') as file:
-        json.dump(config, file, indent=4, sort_keys=True)
+    config = { "version": MANIFEST_VERSION, "remote": template }
+    exile.manifest.write(MANIFEST_NAME, config)
 
     exile.log.message("Initialized manifest with remote type '%s'" % (args.type))
 
@@ -108,8 +155,31 @@ def cache(args, root):
             except OSError:
                 pass
             
+    elif args.cache_action == 'gc':
+        keep = set()
+        for manifest in (args.manifests or [config_path]):
+            index = exile.index.load(manifest)
+            if index is not None:
+                keep |= index.hashes()
+                index.close()
+                continue
+
+            with open(manifest, 'r') as file:
+                keep |= exile.files.FileMapping(root, json.load(file).get('files', {})).hashes()
+
+        removed, freed = exile.cache.ObjectCache(cache_path).gc(keep)
+        exile.log.message("Removed %d unreferenced objects (%d bytes) from %s" % (removed, freed, cache_path))
+        trim_cache()
+
     elif args.cache_action == 'info':
-        exile.log.message("Object cache: " + cache_path)
+        objects = list(exile.cache.ObjectCache(cache_path).objects())
+        exile.log.message("Object cache: %s (%d objects, %d bytes)" % (cache_path, len(objects), sum(st.st_size for _, st in objects)))
+
+        max_size, max_age = cache_limits(config)
+        if max_size is not None:
+            exile.log.message("Object cache size limit: %d bytes" % (max_size))
+        if max_age is not None:
+            exile.log.message("Object cache age limit: %g days" % (max_age / DAY))
 
         try:
             exile.log.message("Snapshot file (updated %s): %s" % (time.ctime(os.path.getmtime(snapshot_path)), snapshot_path))
@@ -136,6 +206,14 @@ add_parser.add_argument("paths", nargs='*',
                         help="the paths to which the action applies")
 add_parser.add_argument('-p', '--purge', action='store_true',
                         help='also remove any tracked files that no longer exist under the given paths')
+add_parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='the number of files to hash in parallel (default: number of CPUs)')
+add_parser.add_argument("-f", "--force", action='store_true',
+                        help="uploads every file, even those that are unchanged or that exile thinks the remote already has")
+
+migrate_parser = subparsers.add_parser('migrate', help='rename objects added by older versions of exile so identical files share storage')
+migrate_parser.add_argument("paths", nargs='*',
+                            help="the paths to migrate (default: every tracked file)")
 
 init_parser = subparsers.add_parser('init', help='create a new manifest in the current directory')
 init_parser.add_argument("-t", "--type",
@@ -149,6 +227,9 @@ cache_clean_parser.add_argument("-s", "--snapshot", action='store_true',
 cache_clean_parser.add_argument("-o", "--objects", action='store_true',
                                 help='clean all cached objects (possibly shared by other exile repositories)')
 cache_info_parser = cache_subparsers.add_parser('info', help='display information about the caches')
+cache_gc_parser = cache_subparsers.add_parser('gc', help='remove cached objects not used by any of the given manifests, then apply the configured cache limits')
+cache_gc_parser.add_argument("manifests", nargs='*',
+                             help="the manifests whose objects should be kept (default: the current manifest)")
 
 args = root_parser.parse_args()
 
@@ -161,17 +242,39 @@ if args.action == 'init':
 try:
     # load an parse configuration file
     config_path = find_config()
-    with open(config_path, 'r') as file:
-        config = json.load(file)
+    root_path = os.path.dirname(config_path)
+
+    manifest_index = exile.index.load(config_path) if args.action in READ_ONLY_ACTIONS else None
+    if manifest_index is not None:
+        config = manifest_index.config()
+    else:
+        with open(config_path, 'r') as file:
+            manifest_stat = os.fstat(file.fileno())
+            config = json.load(file)
+
+        if args.action in READ_ONLY_ACTIONS:
+            write_index(config, manifest_stat)
+
+    version = config.get('version', 1)
+    if version > MANIFEST_VERSION:
+        raise RuntimeError("manifest version %d is not supported by this version of exile (expected %d or lower)" % (version, MANIFEST_VERSION))
+
+    # validates the configured object naming algorithm
+    algorithm = config['remote'].get('hash', exile.hashing.DEFAULT_ALGORITHM)
+    exile.hashing.new(algorithm)
 
     # compute location of cache and create communicator
-    root_path = os.path.dirname(config_path)
     cache_path = find_cache(root_path, config)
+    cache_limits(config)
 
     if args.action == 'cache':
         cache(args, root_path)
 
+    # opened before the workers start, so that any migration of the cache's layout happens once
+    objects = exile.cache.ObjectCache(cache_path)
+
     comm = exile.worker.AsyncCommunicator(os.path.dirname(config_path), cache_path, config['remote'], getattr(args, 'force', False))
+    snapshot = exile.remote.load_snapshot(root_path)
 except Exception as e:
     exile.log.error(str(e))
 
@@ -179,7 +282,8 @@ except Exception as e:
 if 'files' not in config:
     config['files'] = {}
 
-filemap = exile.files.FileMapping(root_path, config['files'])
+# the index provides the same lookups as the mapping of the parsed manifest
+filemap = manifest_index or exile.files.FileMapping(root_path, config['files'])
 
 def resolve(paths):
     """
@@ -189,60 +293,143 @@ def resolve(paths):
         paths: a list of paths to add. Directories will be resolved recursively.
     """
     for path in paths:
-        for relative in filemap.paths(path):
+        items = filemap.items(path)
+
+        # files that are already up to date are found without handing them to the workers
+        if not args.force:
+            items = snapshot.outdated(items)
+
+        for relative, filehash in items:
             exile.log.message("resolving: " + relative)
-            filehash = filemap.get(relative)
             comm.get(filehash, relative)
 
     comm.join()
+    trim_cache()
+
+def hash_file(item):
+    """
+    Hash a single file, inserting it into the object cache. Runs on the hashing pool, so it must
+    not touch the file mapping.
+
+    Files whose size, mtime and inode match the snapshot are not rehashed.
+
+    Args:
+        item: a (path, removed) tuple as produced by walk
+    """
+    path, removed = item
+    stat = os.stat(path)
+
+    filehash = snapshot.hash(path, stat)
+
+    # hashes recorded with a different algorithm can't be reused
+    if filehash is None or exile.hashing.algorithm(filehash) != algorithm:
+        # hashing and copying into the object cache share a single read of the file
+        filehash = objects.ingest(path, algorithm)
+        snapshot.add(path, filehash, stat)
 
-def add_file(path, removed=None):
+    return path, removed, filehash
+
+def walk(paths, removed):
+    """
+    Lazily generates the files to add as (path, removed) tuples.
+
+    Args:
+        paths: a list of paths to add. Directories will be added recursively.
+        removed: maps each purged directory in paths to the mapping of its removed files
+    """
+    for path in paths:
+        if os.path.exists(path):
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    for file in files:
+                        yield os.path.join(root, file), removed.get(path)
+            elif os.path.isfile(path):
+                yield path, None
+        else:
+            exile.log.warning("path does not exist: " + path)
+
+def add_file(path, filehash, removed=None):
     """
     Add a single file. This only changes the parsed configuration, not the file.
 
     Args:
         path: the path to a file to add (must be a file)
+        filehash: the hash of the file's current contents
+        removed: the mapping of files purged from the file's directory, if any
     """
-    filehash = exile.hash(path)
 
     # if we just removed this file and its hash matches, we're just replacing the entry in the map
     replacing = removed is not None and removed.get(path) == filehash
 
-    if filemap.add(path, filehash, replacing):
-        if not replacing:
-            comm.put(path, filehash)
+    if (filemap.add(path, filehash, replacing) and not replacing) or args.force:
+        comm.put(path, filehash)
 
 def add(paths):
     """
     Start tracking a file. This includes uploading the object and updating the configuration file.
 
+    Files are hashed on a pool of threads (hashlib releases the GIL while hashing large blocks) and
+    are handed to the upload queue as soon as their hash is known.
+
     Args:
         paths: a list of paths to add. Directories will be added recursively.
     """
-    cwd = os.getcwd()
 
-    for path in paths:
-        if os.path.exists(path):
+    # a manifest without tracked files has no legacy objects, so it can start out at the current version
+    if not config['files']:
+        config['version'] = MANIFEST_VERSION
+
+    # purge up front, since the file mapping is only safe to modify from this thread
+    removed = {}
+    if args.purge:
+        for path in paths:
             if os.path.isdir(path):
-                if args.purge:
-                    exile.log.message("purging: " + path)
-                    removed = filemap.remove(path)
-                else:
-                    removed = None
+                exile.log.message("purging: " + path)
+                removed[path] = filemap.remove(path)
+
+    pool = multiprocessing.pool.ThreadPool(max(args.jobs, 1))
+    try:
+        for path, purged, filehash in pool.imap_unordered(hash_file, walk(paths, removed)):
+            add_file(path, filehash, purged)
+    finally:
+        pool.terminate()
 
-                for root, dirs, files in os.walk(path):
-                    for file in files:
-                        add_file(os.path.join(root, file), removed)
-            elif os.path.isfile(path):
-                add_file(path)
-        else:
-            exile.log.warning("path does not exist: " + path)
-                
     comm.join()
+    trim_cache()
+
+    if config.get('version', 1) < MANIFEST_VERSION:
+        exile.log.warning("manifest contains objects named by an older version of exile, run 'migrate' to deduplicate them")
+
+    write_config()
+
+def migrate(paths):
+    """
+    Rename the objects for tracked files to their content-only names, uploading them under the
+    new name. Objects under their old names are left in place for older revisions of the manifest.
+
+    Args:
+        paths: a list of paths to migrate. If empty, all tracked files are migrated and the manifest version is updated.
+    """
+    migrated = []
+    for path in (paths or [root_path]):
+        for relative, filehash in filemap.items(path):
+            exile.log.message("migrating: " + relative)
+            comm.migrate(filehash, relative, migrated)
+
+    comm.join()
+
+    for path, filehash in migrated:
+        filemap.add(path, filehash, True)
+
+    if not paths:
+        config['version'] = MANIFEST_VERSION
+
+    write_config()
 
-    # update the manifest file
-    with open(config_path, 'wb') as file:
-        json.dump(config, file, indent=4, sort_keys=True)
+def write_config():
+    """Writes the parsed configuration back to the manifest file, if it has changed."""
+    if exile.manifest.write(config_path, config):
+        write_index(config)
 
 try:
     # calls the local function with the same name as the action argument -- "add" calls add(paths)
@@ -1,17 +1,10 @@
+import cache
 import remote
 import log
+import manifest
 import files
+import index
+import inventory
 import worker
 
-import hashlib
-
-def hash(path):
-    """Compute the SHA1 hash of a file"""
-
-    with open(path, 'rb') as file:
-        h = hashlib.sha1()
-        h.update(path)
-        for block in iter(lambda: file.read(65536), ''):
-            h.update(block)
-
-        return h.hexdigest()
+from hashing import hash
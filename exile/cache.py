@@ -0,0 +1,534 @@
+import atexit
+import errno
+import fastcopy
+import hashing
+import os
+import shutil
+import stat
+import tempfile
+import thread
+import threading
+import time
+
+# temporary files in the cache start with this prefix so they are never mistaken for objects
+TEMP_PREFIX = '.tmp-'
+
+# temporary files older than this (in seconds) were left behind by an interrupted process
+STALE_TEMP_AGE = 24 * 60 * 60
+
+# marks an object that a process sharing the cache is downloading (see ObjectCache.download)
+CLAIM_PREFIX = '.claim-'
+
+# a process refreshes the mtime of its claims this often (in seconds), so a claim that hasn't been
+# refreshed for CLAIM_STALE_AGE was left behind by a process that died
+CLAIM_REFRESH = 10
+CLAIM_STALE_AGE = 6 * CLAIM_REFRESH
+
+# objects claimed, inserted or used this recently (in seconds) may be about to be placed in a
+# workspace by a process sharing the cache, so evict and gc leave them alone
+IN_USE_AGE = CLAIM_STALE_AGE
+
+# how often (in seconds) a process waiting for another's download checks whether it has finished
+CLAIM_POLL = 0.05
+
+# files up to this size are read into memory while they are hashed for ingest, so they are only
+# written to the cache if the object is missing
+INGEST_BUFFER_SIZE = 4 * 1024 * 1024
+
+# marks a cache that stores objects in subdirectories named by the first two digits of their hash
+LAYOUT_FILE = '.layout'
+LAYOUT_VERSION = '2'
+
+SHARDS = ['%02x' % (i) for i in range(256)]
+
+# serializes migration of the layout between the threads of this process
+layout_lock = threading.Lock()
+
+UNITS = {
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4
+}
+
+def parse_size(size):
+    """Parses a size in bytes, which may be a string with a K, M, G or T suffix (e.g. "20G")."""
+
+    if isinstance(size, basestring):
+        value = size.strip().upper().rstrip('B')
+        try:
+            if value and value[-1] in UNITS:
+                return int(float(value[:-1]) * UNITS[value[-1]])
+            return int(value)
+        except ValueError:
+            raise RuntimeError("invalid size: " + size)
+    return int(size)
+
+def shard(name):
+    """Returns the subdirectory of the cache in which the named object is stored."""
+    return hashing.digest(name)[:2]
+
+class Heartbeat:
+    """
+    Refreshes the mtimes of a set of files from a background thread, to show other processes that
+    the files are still in use. The thread is only started once the first file is added, and runs
+    until stop is called.
+    """
+
+    def __init__(self, interval):
+        self.__interval = interval
+        self.__paths = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__stopped = threading.Event()
+
+    def add(self, path):
+        with self.__lock:
+            self.__paths.add(path)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run)
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def remove(self, path):
+        with self.__lock:
+            self.__paths.discard(path)
+
+    def stop(self):
+        """Stops the thread, which would otherwise be killed mid-refresh at interpreter shutdown."""
+        self.__stopped.set()
+        with self.__lock:
+            thread = self.__thread
+        if thread is not None:
+            thread.join()
+
+    def __run(self):
+        while not self.__stopped.wait(self.__interval):
+            with self.__lock:
+                paths = list(self.__paths)
+            for path in paths:
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+
+# keeps the claims held by this process from going stale
+claims = Heartbeat(CLAIM_REFRESH)
+atexit.register(claims.stop)
+
+class ObjectCache:
+    """
+    A local directory of objects, each stored in a file named by its hash. Objects are spread
+    across 256 subdirectories named by the first two hex digits of their digest (e.g.
+    "3f/3f786850..."), which keeps directories small enough for fast lookups.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: the directory containing the cache, which is created if it doesn't exist
+        """
+        if os.path.exists(path) and not os.path.isdir(path):
+            raise RuntimeError('cache is not a directory, please remove it: ' + path)
+
+        # create if it doesn't exist
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+
+        self.__path = path
+
+        if not os.path.exists(os.path.join(path, LAYOUT_FILE)):
+            with layout_lock:
+                self.__migrate()
+
+    def __migrate(self):
+        """Creates the shard directories and moves any objects from the older flat layout into them."""
+
+        marker = os.path.join(self.__path, LAYOUT_FILE)
+        if os.path.exists(marker):
+            return
+
+        for dir in SHARDS:
+            try:
+                os.mkdir(os.path.join(self.__path, dir))
+            except OSError:
+                pass
+
+        for name in os.listdir(self.__path):
+            old = os.path.join(self.__path, name)
+            if name.startswith('.') or not os.path.isfile(old):
+                continue
+
+            try:
+                os.rename(old, self.path(name))
+            except OSError:
+                pass    # moved by another process
+
+        with open(marker, 'w') as file:
+            file.write(LAYOUT_VERSION)
+
+    def path(self, name):
+        """Returns the path at which the named object is stored."""
+        return os.path.join(self.__path, shard(name), name)
+
+    def objects(self):
+        """Generates a (name, stat) tuple for every object in the cache."""
+        for dir in SHARDS:
+            try:
+                names = os.listdir(os.path.join(self.__path, dir))
+            except OSError:
+                continue
+
+            for name in names:
+                try:
+                    st = os.stat(self.path(name))
+                except OSError:
+                    continue    # removed by another process
+
+                if stat.S_ISREG(st.st_mode):
+                    yield name, st
+
+    def touch(self, name):
+        """
+        Records a use of an object for least-recently-used eviction. The access time is set
+        explicitly since filesystems are often mounted without atime updates. The mtime is
+        preserved, since linked workspace files share it.
+        """
+        path = self.path(name)
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    def remove(self, name):
+        """Removes an object from the cache, returning the number of bytes freed."""
+        path = self.path(name)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
+
+    def evict(self, max_size=None, max_age=None):
+        """
+        Removes the least recently used objects until the cache holds no more than max_size bytes
+        and no object has gone unused for more than max_age seconds. Objects that may be in use by
+        another process (see IN_USE_AGE) are kept, even if that leaves the cache over max_size.
+
+        Returns:
+            a (number of objects, number of bytes) tuple describing what was removed
+        """
+        objects = sorted(self.objects(), key=lambda object: object[1].st_atime)
+        total = sum(st.st_size for _, st in objects)
+        now = time.time()
+
+        removed = 0
+        freed = 0
+        for name, st in objects:
+            # objects are in order of last use, so once one can stay, so can the rest
+            if (max_size is None or total <= max_size) and (max_age is None or now - st.st_atime <= max_age):
+                break
+
+            if self.__in_use(name, st, now):
+                continue
+
+            size = self.remove(name)
+            total -= size
+            freed += size
+            removed += 1
+
+        return removed, freed
+
+    def gc(self, keep):
+        """
+        Removes every object whose name isn't in keep, along with stale temporary files. Objects
+        that may be in use by another process (see IN_USE_AGE) are kept.
+
+        Args:
+            keep: a set of object names to keep
+
+        Returns:
+            a (number of objects, number of bytes) tuple describing what was removed
+        """
+        removed = 0
+        freed = 0
+        now = time.time()
+        for name, st in list(self.objects()):
+            if name not in keep and not self.__in_use(name, st, now):
+                freed += self.remove(name)
+                removed += 1
+
+        for name in os.listdir(self.__path):
+            if name.startswith(TEMP_PREFIX):
+                max_age = STALE_TEMP_AGE
+            elif name.startswith(CLAIM_PREFIX):
+                max_age = CLAIM_STALE_AGE
+            else:
+                continue
+
+            path = os.path.join(self.__path, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+        return removed, freed
+
+    def __in_use(self, name, st, now):
+        """
+        Returns whether an object may be about to be placed by a process sharing the cache: it is
+        claimed, or was inserted or used within IN_USE_AGE seconds.
+        """
+        if now - max(st.st_atime, st.st_mtime) < IN_USE_AGE:
+            return True
+        return os.path.exists(self.__claim_path(name))
+
+    def ingest(self, source, algorithm):
+        """
+        Hashes a file and inserts it into the cache, unless the object is already cached.
+
+        Files of up to INGEST_BUFFER_SIZE are read into memory while they are hashed, and larger
+        files are written to a temporary file in the same read, which is dropped if the object
+        turns out to be cached already. Tree algorithms use hashing.hash instead, which hashes
+        the leaves of large files in parallel, and the file is only copied if the object is
+        missing.
+
+        Args:
+            source: the path of the file to ingest
+            algorithm: the hash algorithm used to name the object
+
+        Returns:
+            the name of the object
+        """
+        if algorithm.endswith(hashing.TREE_SUFFIX):
+            name = hashing.hash(source, algorithm)
+            if os.path.exists(self.path(name)):
+                self.touch(name)
+            else:
+                self.insert(source, name)
+            return name
+
+        if os.path.getsize(source) <= INGEST_BUFFER_SIZE:
+            with open(source, 'rb') as file:
+                data = file.read()
+
+            h = hashing.new(algorithm)
+            h.update(data)
+            name = hashing.name(algorithm, h.hexdigest())
+            if os.path.exists(self.path(name)):
+                self.touch(name)
+                return name
+
+            fd, tmp = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.__path)
+            try:
+                with os.fdopen(fd, 'wb') as dest:
+                    dest.write(data)
+                shutil.copymode(source, tmp)
+                self.commit(tmp, name)
+            except:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            return name
+
+        fd, tmp = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.__path)
+        try:
+            h = hashing.new(algorithm)
+            with os.fdopen(fd, 'wb') as dest, open(source, 'rb') as file:
+                for block in iter(lambda: file.read(hashing.BLOCK_SIZE), ''):
+                    h.update(block)
+                    dest.write(block)
+
+            name = hashing.name(algorithm, h.hexdigest())
+            if os.path.exists(self.path(name)):
+                # replacing the cached object would break the links of workspaces sharing it
+                os.remove(tmp)
+                self.touch(name)
+                return name
+
+            # mkstemp creates private files, but the object should keep the source's permissions
+            shutil.copymode(source, tmp)
+            self.commit(tmp, name)
+            return name
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def insert(self, source, name):
+        """
+        Copies a file into the cache as the named object.
+
+        Args:
+            source: the path of the file to copy
+            name: the name of the object (the hash of the file)
+        """
+        fd, tmp = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.__path)
+        os.close(fd)
+        try:
+            fastcopy.copy(source, tmp)
+            self.commit(tmp, name)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def commit(self, tmp, name):
+        """
+        Atomically moves a complete temporary file into place as the named object.
+
+        Args:
+            tmp: the path of the temporary file, which must be inside the cache
+            name: the name of the object
+        """
+        dest = self.path(name)
+        try:
+            os.rename(tmp, dest)
+        except OSError:
+            # Windows won't rename over an existing file, in which case
+            # another thread or process already inserted the same object
+            if not os.path.isfile(dest):
+                raise
+            os.remove(tmp)
+
+    def download(self, name, get):
+        """
+        Inserts an object unless it is already in the cache. Processes sharing the cache take a
+        claim on the object (a file created with O_EXCL) before downloading it, so only one of
+        them downloads it while the others wait for the claim to be released. The object is
+        written to a temporary file and renamed into place, so it never appears partially written.
+
+        Args:
+            name: the name of the object
+            get: a function that writes the object to the path it is given
+
+        Returns:
+            True if the object was inserted by this call, False if it was already in the cache
+        """
+        dest = self.path(name)
+        while not os.path.exists(dest):
+            claim = self.__claim(name)
+            if claim is None:
+                self.__wait(name)
+                continue
+
+            try:
+                # the object may have been inserted between the check and the claim
+                if os.path.exists(dest):
+                    return False
+
+                tmp = self.__temp(name)
+                try:
+                    get(tmp)
+                    if not os.path.exists(tmp):
+                        return False    # reported by the caller, which finds no object
+                    self.commit(tmp, name)
+                except:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+                return True
+            finally:
+                self.__release(claim)
+
+        return False
+
+    def download_many(self, names, get_many):
+        """
+        Inserts several objects like download, but with a single call to get_many for all of the
+        missing objects this process can claim. Objects claimed by other processes are waited for
+        afterwards, and downloaded one at a time if those processes fail to insert them.
+
+        Args:
+            names: the names of the objects
+            get_many: a function that writes objects to the paths given by a list of (name, path) tuples
+
+        Returns:
+            the set of names inserted by this call
+        """
+        claims = {}
+        inserted = set()
+        try:
+            for name in names:
+                if name not in claims and not os.path.exists(self.path(name)):
+                    claim = self.__claim(name)
+                    if claim is not None:
+                        claims[name] = claim
+
+            # the objects may have been inserted between the checks and the claims
+            pending = [(name, self.__temp(name)) for name in claims if not os.path.exists(self.path(name))]
+            if pending:
+                try:
+                    get_many(pending)
+                    for name, tmp in pending:
+                        if os.path.exists(tmp):
+                            self.commit(tmp, name)
+                            inserted.add(name)
+                except:
+                    for name, tmp in pending:
+                        if os.path.exists(tmp):
+                            os.remove(tmp)
+                    raise
+        finally:
+            for claim in claims.itervalues():
+                self.__release(claim)
+
+        for name in names:
+            if name not in claims and self.download(name, lambda tmp: get_many([(name, tmp)])):
+                inserted.add(name)
+
+        return inserted
+
+    def __temp(self, name):
+        """Returns a path for downloading an object, unique to the calling thread, which isn't created."""
+        return os.path.join(self.__path, '%s%s-%d-%d' % (TEMP_PREFIX, name, os.getpid(), thread.get_ident()))
+
+    def __claim_path(self, name):
+        return os.path.join(self.__path, CLAIM_PREFIX + name)
+
+    def __claim(self, name):
+        """Claims an object for downloading, returning the path of the claim or None if another process holds it."""
+
+        path = self.__claim_path(name)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return None
+
+        os.close(fd)
+        claims.add(path)
+        return path
+
+    def __release(self, path):
+        claims.remove(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def __wait(self, name):
+        """
+        Waits until another process releases its claim on an object. A claim that is no longer
+        being refreshed was left behind by a process that died, and is removed.
+        """
+        path = self.__claim_path(name)
+        while True:
+            try:
+                age = time.time() - os.path.getmtime(path)
+            except OSError:
+                return  # released
+
+            if age > CLAIM_STALE_AGE:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                return
+
+            time.sleep(CLAIM_POLL)
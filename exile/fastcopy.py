@@ -0,0 +1,209 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import stat
+import sys
+import thread
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # not available on Windows
+
+# used for kernel-side copies when the os module doesn't expose them (before Python 3.3/3.8)
+libc = None
+if sys.platform.startswith('linux'):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        pass
+
+# ioctl request to share the extents of one file with another (from linux/fs.h)
+FICLONE = 0x40049409
+
+# the ways an object can be placed in the workspace, in the order they are tried by default
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+SYMLINK = 'symlink'
+COPY = 'copy'
+
+MODES = [REFLINK, HARDLINK, SYMLINK, COPY]
+
+# reflinks are indistinguishable from copies (modifications are copy-on-write), so they are always
+# safe to try; links share the object with the cache and have to be enabled explicitly
+DEFAULT_MODES = [REFLINK, COPY]
+
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+# the most data handed to the kernel in a single copy call
+CHUNK_SIZE = 1024 * 1024 * 1024
+
+# errors meaning a kernel-side copy isn't possible between two files, rather than that it failed
+UNSUPPORTED = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF])
+
+def libc_function(name, argtypes):
+    """Looks up a function in the C library, returning None if it isn't available."""
+    function = getattr(libc, name, None) if libc is not None else None
+    if function is not None:
+        function.argtypes = argtypes
+        function.restype = ctypes.c_ssize_t
+    return function
+
+def check(result):
+    """Converts the result of a C library call into a byte count, raising OSError on failure."""
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+libc_copy_file_range = libc_function('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+libc_sendfile = libc_function('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+def copy_file_range(src, dst, count):
+    """Copies up to count bytes between file descriptors within the kernel, sharing extents where the filesystem can."""
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(src, dst, count)
+    return check(libc_copy_file_range(src, None, dst, None, count, 0))
+
+def sendfile(src, dst, count):
+    """Copies up to count bytes between file descriptors within the kernel."""
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(dst, src, None, count)
+    return check(libc_sendfile(dst, src, None, count))
+
+# kernel-side copy methods available on this platform, in order of preference
+KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range') or libc_copy_file_range is not None:
+    KERNEL_COPIES.append(copy_file_range)
+if (hasattr(os, 'sendfile') and sys.platform.startswith('linux')) or libc_sendfile is not None:
+    KERNEL_COPIES.append(sendfile)
+
+def copyfile(source, dest):
+    """
+    Copies the contents of source to dest without passing the data through Python when the
+    kernel supports it (copy_file_range, then sendfile), falling back to a buffered copy.
+    """
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+
+        # files reporting no size (like those in /proc) may still have contents, which only a
+        # buffered copy reads
+        methods = KERNEL_COPIES if size else []
+
+        for method in methods:
+            copied = 0
+            try:
+                while copied < size:
+                    count = method(src.fileno(), dst.fileno(), min(size - copied, CHUNK_SIZE))
+                    if count == 0:
+                        break
+                    copied += count
+            except OSError as e:
+                # only fall back if nothing has been written yet
+                if copied or e.errno not in UNSUPPORTED:
+                    raise
+                continue
+
+            if copied == size:
+                return
+
+            # some filesystems (like overlayfs and FUSE) copy nothing rather than failing, in
+            # which case the next method is tried, but a copy that stops partway is an error
+            if copied:
+                raise IOError("short copy of %s: %d of %d bytes" % (source, copied, size))
+
+        shutil.copyfileobj(src, dst, CHUNK_SIZE / 1024)
+
+def copy(source, dest):
+    """Like shutil.copy, but copies the contents with copyfile. dest must be a file path."""
+    copyfile(source, dest)
+    shutil.copymode(source, dest)
+
+def reflink(source, dest):
+    """
+    Creates dest as a copy-on-write clone of source. Only supported by some filesystems (e.g.
+    Btrfs and XFS on Linux); raises IOError or OSError if the clone can't be made.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def make_writable(source, dest):
+    """Gives dest the permissions of source, plus write permission for the owner."""
+    os.chmod(dest, stat.S_IMODE(os.stat(source).st_mode) | stat.S_IWUSR)
+
+def make_readonly(path):
+    """Removes all write permissions from a file, so a shared object can't be modified in place."""
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if mode & WRITE_BITS:
+        os.chmod(path, mode & ~WRITE_BITS)
+
+def create(mode, source, dest):
+    """
+    Creates dest from source using a single materialization mode. dest must not exist.
+
+    Args:
+        mode: one of MODES
+        source: the path of the object in the cache
+        dest: the path at which to create the file
+    """
+    if mode == REFLINK:
+        reflink(source, dest)
+        make_writable(source, dest)
+    elif mode == HARDLINK:
+        make_readonly(source)
+        os.link(source, dest)
+    elif mode == SYMLINK:
+        make_readonly(source)
+        os.symlink(os.path.abspath(source), dest)
+    elif mode == COPY:
+        copyfile(source, dest)
+        make_writable(source, dest)
+    else:
+        raise RuntimeError("unknown materialization mode: " + mode)
+
+def materialize(source, dest, modes=DEFAULT_MODES):
+    """
+    Places an object from the cache in the workspace, trying each mode in turn until one works.
+
+    The file is created beside dest and then renamed over it, so an existing link at dest is
+    replaced rather than written through (which would modify the object in the cache).
+
+    Args:
+        source: the path of the object in the cache
+        dest: the path at which the object should appear
+        modes: the materialization modes to try, in order
+
+    Returns:
+        the mode that was used
+    """
+    tmp = '%s.exile-%d-%d' % (dest, os.getpid(), thread.get_ident())
+
+    error = None
+    for mode in modes:
+        try:
+            create(mode, source, tmp)
+            break
+        except (IOError, OSError) as e:
+            error = e
+            # clean up anything left behind by a partial attempt before trying the next mode
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    else:
+        raise error or RuntimeError("no materialization modes configured")
+
+    try:
+        os.rename(tmp, dest)
+    except OSError:
+        # Windows won't rename over an existing file
+        if not os.path.lexists(dest):
+            os.remove(tmp)
+            raise
+        os.remove(dest)
+        os.rename(tmp, dest)
+
+    return mode
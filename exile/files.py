@@ -1,8 +1,41 @@
 import log
 import os
 
+def relative(root, path, realdirs=None):
+    """
+    Returns a path relative to the root of the exile context, or None if the path is outside the
+    root. Symlinks in the directories leading to the path are resolved, but the last component is
+    not, so that files resolved as symlinks are still tracked at their own path.
+
+    Args:
+        root: the root of the exile context
+        path: the path to make relative
+        realdirs: if given, a dict memoizing the resolved path of each directory; it belongs to the
+                  caller, which should only keep it while the directories can't be replaced
+    """
+    dir, name = os.path.split(os.path.abspath(path))
+
+    real = realdirs.get(dir) if realdirs is not None else None
+    if real is None:
+        real = os.path.realpath(dir)
+        if realdirs is not None:
+            realdirs[dir] = real
+
+    path = os.path.join(real, name) if name else real
+    if path == root:
+        return os.curdir
+    if not path.startswith(os.path.join(root, '')):
+        return None
+    return path[len(os.path.join(root, '')):]
+
 class FileMapping:
-    """Provides convenience methods for accessing and manipulating the JSON config object."""
+    """
+    Provides convenience methods for accessing and manipulating the JSON config object.
+
+    The nested config dicts act as a trie for directory queries, while lookups of single files use
+    a flat index from relative path to hash, which is built on first use and kept in sync by add
+    and remove.
+    """
 
     def __init__(self, root, config, silent=False):
         """
@@ -14,6 +47,16 @@ class FileMapping:
         self.__root = root
         self.__config = config
         self.__silent = silent
+        self.__index = None
+        self.__realdirs = {}    # memoizes relative's resolved directories for this mapping's lifetime
+
+    def __relative(self, path):
+        """Returns the path relative to the root, or None (with a message) if it is outside the root."""
+
+        rel = relative(self.__root, path, self.__realdirs)
+        if rel is None and not self.__silent:
+            log.info("skipping path outside manifest scope: " + os.path.abspath(path))
+        return rel
 
     def __path_components(self, path):
         """
@@ -28,24 +71,14 @@ class FileMapping:
             ['path', 'to', 'a', 'file']
         """
 
-        path = os.path.realpath(path)
-        if not path.startswith(self.__root):
-            if not self.__silent:
-                log.info("skipping path outside manifest scope: " + path)
+        rel = self.__relative(path)
+        if rel is None:
             return None
 
-        relative = os.path.relpath(path, self.__root)
-
-        parts = []
-        head, tail = os.path.split(relative)
-        while tail:
-            parts = [tail] + parts
-            head, tail = os.path.split(head)
-
-        if head:
-            parts = [head] + parts
+        if rel == os.curdir:
+            return []
 
-        return parts
+        return rel.split(os.sep)
 
     def __get(self, parts):
         """
@@ -64,34 +97,58 @@ class FileMapping:
         except (KeyError, TypeError):
             return None
 
+    def __items(self, parent, value):
+        """
+        Generates a (path, hash) tuple for every file in a subtree of the configuration.
+
+        Args:
+            parent: the path to the subtree represented by value
+            value: the subtree of the file configuration corresponding to the above path
+        """
+
+        stack = [(parent, value)]
+        while stack:
+            parent, value = stack.pop()
+            if type(value) is dict:
+                for k, v in value.iteritems():
+                    stack.append((os.path.join(parent, k), v))
+            else:
+                yield parent, value
+
+    def index(self):
+        """Returns a flat dict mapping the relative path of every tracked file to its hash."""
+
+        if self.__index is None:
+            self.__index = dict(self.__items('', self.__config))
+        return self.__index
+
     def get(self, path):
         """
         Gets the configured object for a given path. If the path is not a file
         or is not tracked, returns None.
         """
 
-        value = self.__get(self.__path_components(path))
-        if type(value) is dict:
+        rel = self.__relative(path)
+        if rel is None:
             return None
-        return value
+        return self.index().get(rel)
 
-    def __paths(self, parent, value):
+    def items(self, path):
         """
-        Recursive helper for building a a path list. See "paths".
+        Given a path, returns a list of (path, hash) tuples for the tracked files that fall under that path.
 
-        Args:
-            parent: the path to the subtree represented by value
-            value: the subtree of the file configuration corresponding to the above path
+        For example, "/tmp/test" may return [("/tmp/test/a", "<somehash>"), ("/tmp/test/b", "<somehash>")].
         """
 
-        paths = []
-        if type(value) is dict:
-            for k, v in value.iteritems():
-                paths += self.__paths(os.path.join(parent, k), v)
-        else:
-            paths.append(parent)
+        parts = self.__path_components(path)
+        value = self.__get(parts) if parts is not None else None
+        if value is None:
+            if not self.__silent:
+                log.warning("path is not tracked: " + path)
+            return []
 
-        return paths
+        # paths in "parts" are relative to the repo root, but we want absolute paths
+        return list(self.__items(os.path.join(self.__root, *parts), value))
 
     def paths(self, path):
         """
@@ -100,16 +157,12 @@ class FileMapping:
         For example, "/tmp/test" may return ["/tmp/test/a", "/tmp/test/b"].
         """
 
-        parts = self.__path_components(path)
-        value = self.__get(parts)
-        if value is None:
-            if not self.__silent:
-                log.warning("path is not tracked: " + path)
-            return []
+        return [path for path, hash in self.items(path)]
 
-        # paths in "parts" are relative to the repo root, but we want absolute paths
-        absolute = os.path.realpath(os.path.join(os.path.relpath(self.__root), *parts))
-        return self.__paths(absolute, value)
+    def hashes(self):
+        """Returns the set of all hashes in the configuration."""
+
+        return set(self.index().itervalues())
 
     def add(self, path, hash, silent=False):
         """
@@ -126,11 +179,18 @@ class FileMapping:
             return False
 
         changed = False
-        dict = self.__config
+        node = self.__config
         for i in range(len(parts)):
             if i is len(parts) - 1:
-                if parts[i] not in dict or dict[parts[i]] != hash:
-                    dict[parts[i]] = hash
+                if parts[i] not in node or node[parts[i]] != hash:
+                    if self.__index is not None:
+                        # a file replacing a directory drops everything that was under it
+                        if isinstance(node.get(parts[i]), dict):
+                            for replaced, _ in self.__items(os.path.join(*parts), node[parts[i]]):
+                                del self.__index[replaced]
+                        self.__index[os.path.join(*parts)] = hash
+
+                    node[parts[i]] = hash
                     changed = True
                 
                 if changed and not (self.__silent or silent):
@@ -138,11 +198,11 @@ class FileMapping:
 
                 return changed
 
-            if parts[i] not in dict:
-                dict[parts[i]] = {}
+            if parts[i] not in node:
+                node[parts[i]] = {}
                 changed = True
 
-            dict = dict[parts[i]]
+            node = node[parts[i]]
 
         return False    # shouldn't get here
 
@@ -171,7 +231,7 @@ class FileMapping:
         """
 
         parts = self.__path_components(path)
-        if len(parts) > 0:
+        if parts:
             removed = {}
             current = removed
             for part in parts[:-1]:
@@ -182,11 +242,15 @@ class FileMapping:
             last_part = parts[-1]
             try:
                 leaf = parent[last_part]
-            except KeyError:
+            except (KeyError, TypeError):
                 return None   # if its already missing, no problem
             current[last_part] = leaf
             del parent[last_part]
 
+            if self.__index is not None:
+                for removed_path, hash in self.__items(os.path.join(*parts), leaf):
+                    del self.__index[removed_path]
+
             return FileMapping(self.__root, removed, True)
 
         return None
\ No newline at end of file
@@ -0,0 +1,174 @@
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None  # requires Python 3.6+ or the pyblake2 package
+
+# objects named with the default algorithm are not prefixed, for compatibility with older manifests
+DEFAULT_ALGORITHM = 'sha1'
+
+# the suffix selecting the tree variant of an algorithm (e.g. "blake2b-tree")
+TREE_SUFFIX = '-tree'
+
+# the size of each independently hashed block in a tree hash
+LEAF_SIZE = 4 * 1024 * 1024
+
+BLOCK_SIZE = 65536
+
+# leaf and node inputs are prefixed with different bytes, so that the digest of a leaf can never be
+# passed off as the digest of a node (or the other way around) when a tree hash is verified
+LEAF_PREFIX = '\x00'
+NODE_PREFIX = '\x01'
+
+# the threads hashing leaves, shared by every call to hash so that hashing many files at once
+# doesn't start a pool per file; created on first use
+leaf_pool = None
+leaf_pool_lock = threading.Lock()
+
+ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': blake2b
+}
+
+def factory(algorithm):
+    """Returns the hashlib-style constructor for a base (non-tree) algorithm."""
+
+    try:
+        constructor = ALGORITHMS[algorithm]
+    except KeyError:
+        raise RuntimeError("unknown hash algorithm: " + algorithm)
+
+    if constructor is None:
+        raise RuntimeError("hash algorithm '%s' is not available (blake2b requires Python 3.6+ or the pyblake2 package)" % (algorithm))
+
+    return constructor
+
+def new(algorithm=DEFAULT_ALGORITHM):
+    """Creates a new hash object for the given algorithm name, supporting update() and hexdigest()."""
+
+    if algorithm.endswith(TREE_SUFFIX):
+        return TreeHash(factory(algorithm[:-len(TREE_SUFFIX)]))
+    return factory(algorithm)()
+
+def name(algorithm, hexdigest):
+    """Returns the object name for a digest, prefixed with the algorithm unless it is the default."""
+
+    if algorithm == DEFAULT_ALGORITHM:
+        return hexdigest
+    return algorithm + '-' + hexdigest
+
+def algorithm(name):
+    """Returns the algorithm used to produce an object name."""
+
+    if '-' in name:
+        return name.rsplit('-', 1)[0]
+    return DEFAULT_ALGORITHM
+
+def digest(name):
+    """Returns the hex digest portion of an object name."""
+
+    return name.rsplit('-', 1)[-1]
+
+class TreeHash:
+    """
+    Hashes data as a sequence of LEAF_SIZE blocks, each hashed independently, followed by a hash
+    of the concatenated leaf digests. Because the leaves are independent, a single large file can
+    be hashed on several cores at once (see hash). Leaves are hashed after LEAF_PREFIX and the root
+    after NODE_PREFIX.
+    """
+
+    def __init__(self, factory):
+        self.__factory = factory
+        self.__leaves = []
+        self.__leaf = new_leaf(factory)
+        self.__filled = 0
+
+    def update(self, data):
+        while data:
+            size = min(len(data), LEAF_SIZE - self.__filled)
+            self.__leaf.update(data[:size])
+            self.__filled += size
+            data = data[size:]
+
+            if self.__filled == LEAF_SIZE:
+                self.add_leaf(self.__leaf.digest())
+                self.__leaf = new_leaf(self.__factory)
+                self.__filled = 0
+
+    def add_leaf(self, digest):
+        """Appends the digest of a complete leaf that was hashed separately."""
+        self.__leaves.append(digest)
+
+    def hexdigest(self):
+        leaves = list(self.__leaves)
+        # the trailing partial leaf, or the only leaf of an empty input
+        if self.__filled or not leaves:
+            leaves.append(self.__leaf.digest())
+
+        root = self.__factory()
+        root.update(NODE_PREFIX)
+        for leaf in leaves:
+            root.update(leaf)
+        return root.hexdigest()
+
+def new_leaf(factory):
+    """Creates the hash object for a leaf of a tree hash."""
+
+    h = factory()
+    h.update(LEAF_PREFIX)
+    return h
+
+def hash_leaf(path, offset, factory):
+    """Hashes the leaf of a file starting at the given offset."""
+
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        h = new_leaf(factory)
+        remaining = LEAF_SIZE
+        while remaining:
+            block = file.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            h.update(block)
+            remaining -= len(block)
+        return h.digest()
+
+def hash(path, algorithm=DEFAULT_ALGORITHM):
+    """
+    Compute the hash of a file's contents, returning the object name for the file.
+
+    Tree algorithms hash the leaves of files larger than a single leaf in parallel, on the threads
+    of the shared leaf pool.
+    """
+
+    global leaf_pool
+
+    h = new(algorithm)
+
+    size = os.path.getsize(path)
+    if isinstance(h, TreeHash) and size > LEAF_SIZE:
+        base = factory(algorithm[:-len(TREE_SUFFIX)])
+
+        with leaf_pool_lock:
+            if leaf_pool is None:
+                leaf_pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+
+        for leaf in leaf_pool.map(lambda offset: hash_leaf(path, offset, base), range(0, size, LEAF_SIZE)):
+            h.add_leaf(leaf)
+
+        return name(algorithm, h.hexdigest())
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), ''):
+            h.update(block)
+
+        return name(algorithm, h.hexdigest())
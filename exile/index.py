@@ -0,0 +1,298 @@
+import files
+import hashlib
+import json
+import log
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+INDEX = '.exile.index'
+INDEX_MAGIC = 'exile-index 1\n'
+
+# manifest size, mtime and sha1 digest, then the number of files, the width of each hash and the
+# length of the JSON encoded configuration (the manifest without its files)
+HEADER = struct.Struct('<Qd20sQQQ')
+OFFSET = struct.Struct('<Q')
+
+# the manifest may change again within the resolution of its timestamp (up to 2 seconds on FAT),
+# so an index written this soon after the manifest's mtime is only trusted if the contents match.
+# Once they have been found to match after this window, the index's mtime is updated so later
+# runs can trust the manifest's mtime alone.
+RACY_WINDOW = 2
+
+def index_path(manifest):
+    """Returns the path of the index for a manifest."""
+    return os.path.join(os.path.dirname(manifest), INDEX)
+
+def manifest_digest(manifest):
+    """Returns the sha1 digest of the contents of a manifest."""
+    h = hashlib.sha1()
+    with open(manifest, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), ''):
+            h.update(block)
+    return h.digest()
+
+def encode(rel):
+    """Converts a path relative to the root into its form in the index."""
+    if isinstance(rel, unicode):
+        rel = rel.encode('utf-8')
+    if os.sep != '/':
+        rel = rel.replace(os.sep, '/')
+    return rel
+
+def entries(tree):
+    """
+    Generates an (encoded path, hash) tuple for every file in the tree of a manifest, in sorted
+    order. Sorting each directory's entries with "/" appended to the names of subdirectories puts
+    every file before or after all of a sibling directory's files exactly as sorting the full paths
+    would, so the paths never need to be sorted as a whole.
+    """
+    stack = [('', tree)]
+    while stack:
+        prefix, value = stack.pop()
+        if type(value) is dict:
+            children = sorted((encode(name) + '/' if type(child) is dict else encode(name), child) for name, child in value.iteritems())
+            stack.extend((prefix + name, child) for name, child in reversed(children))
+        else:
+            yield prefix, str(value)
+
+def load(manifest):
+    """
+    Opens the index for a manifest.
+
+    Returns:
+        a ManifestIndex, or None if there is no index or it doesn't match the manifest
+    """
+    try:
+        index = ManifestIndex(os.path.dirname(manifest), index_path(manifest))
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+
+    try:
+        if index.current(manifest):
+            return index
+    except (IOError, OSError):
+        pass
+
+    index.close()
+    return None
+
+def write(manifest, config, stat=None):
+    """
+    Writes the index for a manifest, atomically replacing any existing index.
+
+    Args:
+        manifest: the path of the manifest
+        config: the parsed contents of the manifest
+        stat: the stat of the manifest when config was read, if the index should only be
+              written if the manifest hasn't changed since
+    """
+    root = os.path.dirname(manifest)
+
+    before = os.stat(manifest)
+    if stat is not None and (before.st_size, before.st_mtime) != (stat.st_size, stat.st_mtime):
+        return
+    digest = manifest_digest(manifest)
+    after = os.stat(manifest)
+    if (before.st_size, before.st_mtime) != (after.st_size, after.st_mtime):
+        return
+
+    paths = []
+    hashes = []
+    offsets = [0]
+    end = 0
+    for path, hash in entries(config.get('files', {})):
+        paths.append(path)
+        hashes.append(hash)
+        end += len(path)
+        offsets.append(end)
+
+    width = max(len(hash) for hash in hashes) if hashes else 0
+    if any(len(hash) != width for hash in hashes):
+        hashes = [hash.ljust(width, '\0') for hash in hashes]
+
+    settings = json.dumps(dict((k, v) for k, v in config.iteritems() if k != 'files'), sort_keys=True)
+
+    fd, tmp = tempfile.mkstemp(prefix=INDEX + '.', dir=root)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(INDEX_MAGIC)
+            file.write(HEADER.pack(after.st_size, after.st_mtime, digest, len(paths), width, len(settings)))
+            file.write(settings)
+            file.write(struct.pack('<%dQ' % (len(offsets)), *offsets))
+            file.write(''.join(hashes))
+            file.write(''.join(paths))
+
+        path = index_path(manifest)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(path)
+            os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class ManifestIndex:
+    """
+    A read-only, memory-mapped view of a manifest, which can be opened without parsing the JSON.
+
+    The index file holds a header identifying the manifest it was built from, the manifest's
+    configuration without its files (as JSON), then the tracked files: a table of offsets into
+    a block of sorted relative paths (separated by "/") and a table of fixed-width hashes in the
+    same order. Single files are found by binary search, and the files under a directory are a
+    contiguous range of the sorted paths, so only the entries that are used are ever read.
+
+    Provides the read-only methods of FileMapping.
+    """
+
+    def __init__(self, root, path, silent=False):
+        """
+        Args:
+            root: the directory containing the manifest; the root of the exile context
+            path: the path of the index file
+            silent: if true, no messages will be printed
+        """
+        self.__root = root
+        self.__index_path = path
+        self.__silent = silent
+        self.__realdirs = {}    # memoizes relative's resolved directories for this index's lifetime
+
+        with open(path, 'rb') as file:
+            self.__written = os.fstat(file.fileno()).st_mtime
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if self.__map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise ValueError("not an exile index: " + path)
+
+            start = len(INDEX_MAGIC)
+            self.__size, self.__mtime, self.__digest, self.__count, self.__width, length = HEADER.unpack_from(self.__map, start)
+
+            self.__settings = start + HEADER.size
+            self.__offsets = self.__settings + length
+            self.__hashes = self.__offsets + OFFSET.size * (self.__count + 1)
+            self.__paths = self.__hashes + self.__width * self.__count
+
+            if self.__paths + self.__offset(self.__count) != len(self.__map):
+                raise ValueError("truncated exile index: " + path)
+        except:
+            self.__map.close()
+            raise
+
+    def close(self):
+        self.__map.close()
+
+    def current(self, manifest):
+        """Returns whether the index was built from the current contents of the manifest."""
+
+        st = os.stat(manifest)
+        if st.st_size != self.__size:
+            return False
+
+        if st.st_mtime == self.__mtime and self.__mtime < self.__written - RACY_WINDOW:
+            return True
+
+        if manifest_digest(manifest) != self.__digest:
+            return False
+
+        # the contents were checked outside the racy window, so any later change moves the mtime
+        if st.st_mtime == self.__mtime and time.time() - RACY_WINDOW > self.__mtime:
+            try:
+                os.utime(self.__index_path, None)
+            except OSError:
+                pass    # checked again next time
+        return True
+
+    def config(self):
+        """Returns the configuration of the manifest, without its files."""
+        return json.loads(self.__map[self.__settings:self.__offsets])
+
+    def __offset(self, i):
+        return OFFSET.unpack_from(self.__map, self.__offsets + OFFSET.size * i)[0]
+
+    def __path(self, i):
+        return self.__map[self.__paths + self.__offset(i):self.__paths + self.__offset(i + 1)]
+
+    def __hash(self, i):
+        start = self.__hashes + self.__width * i
+        return self.__map[start:start + self.__width].rstrip('\0')
+
+    def __bisect(self, key):
+        """Returns the position of the first path that is not less than key."""
+
+        lo, hi = 0, self.__count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__path(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __item(self, i):
+        """Returns the (absolute path, hash) tuple of an entry."""
+        return os.path.join(self.__root, *self.__path(i).decode('utf-8').split('/')), self.__hash(i)
+
+    def __relative(self, path):
+        """Returns the path relative to the root, or None (with a message) if it is outside the root."""
+
+        rel = files.relative(self.__root, path, self.__realdirs)
+        if rel is None and not self.__silent:
+            log.info("skipping path outside manifest scope: " + os.path.abspath(path))
+        return rel
+
+    def get(self, path):
+        """
+        Gets the configured object for a given path. If the path is not a file
+        or is not tracked, returns None.
+        """
+
+        rel = self.__relative(path)
+        if rel is None or rel == os.curdir:
+            return None
+
+        key = encode(rel)
+        i = self.__bisect(key)
+        if i < self.__count and self.__path(i) == key:
+            return self.__hash(i)
+        return None
+
+    def items(self, path):
+        """Given a path, returns a list of (path, hash) tuples for the tracked files that fall under that path."""
+
+        rel = self.__relative(path)
+        if rel is None:
+            lo = hi = 0
+        elif rel == os.curdir:
+            return [self.__item(i) for i in xrange(self.__count)]
+        else:
+            key = encode(rel)
+            lo = self.__bisect(key)
+            if lo < self.__count and self.__path(lo) == key:
+                hi = lo + 1
+            else:
+                # every path in the directory starts with "key/", and '0' is the character after '/'
+                lo = self.__bisect(key + '/')
+                hi = self.__bisect(key + '0')
+
+        if lo == hi:
+            if not self.__silent:
+                log.warning("path is not tracked: " + path)
+            return []
+
+        return [self.__item(i) for i in xrange(lo, hi)]
+
+    def paths(self, path):
+        """Given a path, returns the list of tracked files that fall under that path."""
+
+        return [path for path, hash in self.items(path)]
+
+    def hashes(self):
+        """Returns the set of all hashes in the manifest."""
+
+        return set(self.__hash(i) for i in xrange(self.__count))
@@ -0,0 +1,218 @@
+import cache
+import hashing
+import hashlib
+import json
+import log
+import os
+import tempfile
+import threading
+
+# the inventory of a remote is kept in the object cache, named by this prefix and the remote
+INVENTORY_PREFIX = '.inventory-'
+
+# keys of the remote configuration that don't change where objects are stored, including the
+# tuning options of the adapters
+LOCAL_KEYS = set(['cache', 'cache_size', 'cache_age', 'threads', 'disk_threads', 'materialize', 'hash',
+                  'multipart_threshold', 'part_size', 'part_threads', 'connections'])
+
+# a prefix is only listed once this many objects under it have been looked up by a process, since a
+# listing returns every object under the prefix (1/256 of the remote); until then objects are looked
+# up individually
+LIST_THRESHOLD = 16
+
+# objects smaller than this that aren't in the inventory are uploaded without asking the remote
+# whether it has them, since the round trip of asking costs about as much as the upload
+LOOKUP_MIN_SIZE = 64 * 1024
+
+# the inventory file is compacted once it holds this many lines per object (and at least COMPACT_MIN lines)
+COMPACT_RATIO = 2
+COMPACT_MIN = 1024
+
+# inventories shared among all threads of the process, by path
+inventories = {}
+inventories_lock = threading.Lock()
+
+def inventory_path(cache_path, config):
+    """Returns the path of the inventory of the remote described by the "remote" section of a manifest."""
+
+    remote = dict((key, value) for key, value in config.iteritems() if key not in LOCAL_KEYS)
+    name = hashlib.sha1(json.dumps(remote, sort_keys=True)).hexdigest()[:16]
+    return os.path.join(cache_path, INVENTORY_PREFIX + name)
+
+def load(cache_path, config):
+    """Returns the inventory of a remote, shared by every thread that uses the same cache and remote."""
+
+    path = inventory_path(cache_path, config)
+    with inventories_lock:
+        if path not in inventories:
+            inventories[path] = Inventory(path)
+        return inventories[path]
+
+def prefix(name):
+    """Returns the prefix by which a remote lists an object: its name up to the first two digits of its digest."""
+    return name[:len(name) - len(hashing.digest(name)) + 2]
+
+class Inventory:
+    """
+    The set of objects known to exist on a remote, which lets uploads of objects the remote already
+    has be skipped without asking the remote. Objects are recorded as they are uploaded and
+    downloaded, or found on the remote. The objects the remote lists under a prefix (see refresh)
+    are only kept in memory, since a listing may hold far more objects than the workspace uses.
+
+    The file is a list of names, one per line, which processes sharing the cache append to. It is
+    only read once an object needs to be looked up, so downloads can record objects without it.
+    Objects are never removed from a remote by exile, so names stay in the inventory; if a remote
+    is pruned by other means, its inventory in the cache should be removed.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: the path of the inventory file, which is created when objects are first recorded
+        """
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__names = None     # loaded lazily
+        self.__lines = 0        # the number of lines in the file, once it has been loaded
+        self.__new = []         # recorded names that haven't been written to the file
+        self.__listed = {}      # an Event per prefix listed by this process, set once it is recorded
+        self.__listed_names = set()     # the names those listings returned
+        self.__lookups = {}     # the number of objects looked up under each prefix by this process
+
+    def __load(self):
+        """Reads the file if it hasn't been read yet. The lock must be held."""
+
+        if self.__names is not None:
+            return
+
+        names = set(self.__new)
+        lines = 0
+        try:
+            with open(self.__path, 'rb') as file:
+                for line in file:
+                    # a line without a newline is still being written by another process
+                    if line.endswith('\n'):
+                        names.add(line[:-1])
+                        lines += 1
+        except IOError:
+            pass    # no objects recorded yet
+
+        self.__names = names
+        self.__lines = lines
+
+    def contains(self, name):
+        """Returns whether an object is known to exist on the remote."""
+
+        with self.__lock:
+            self.__load()
+            if name in self.__names:
+                return True
+
+            if name in self.__listed_names:
+                # the workspace uses the object, so it is worth writing to the file
+                self.__names.add(name)
+                self.__new.append(name)
+                return True
+
+            return False
+
+    def add(self, names):
+        """Records objects that exist on the remote."""
+
+        with self.__lock:
+            for name in names:
+                if self.__names is None or name not in self.__names:
+                    self.__new.append(name)
+                    if self.__names is not None:
+                        self.__names.add(name)
+
+    def look_up(self, prefix, count):
+        """
+        Counts objects under a prefix that are being looked up on the remote.
+
+        Returns:
+            the number of objects looked up under the prefix by this process, including these
+        """
+        with self.__lock:
+            self.__lookups[prefix] = self.__lookups.get(prefix, 0) + count
+            return self.__lookups[prefix]
+
+    def listed(self, prefix):
+        """Returns whether this process has listed a prefix, so the objects under it that aren't known are missing."""
+
+        with self.__lock:
+            listed = self.__listed.get(prefix)
+        return listed is not None and listed.is_set()
+
+    def refresh(self, prefix, list):
+        """
+        Keeps every object the remote lists under a prefix in memory, unless the prefix has already
+        been listed by this process. Other threads refreshing the same prefix wait for the listing.
+
+        Args:
+            prefix: the prefix of the names to list (see prefix())
+            list: a function returning the names of the remote's objects that start with a prefix
+        """
+        with self.__lock:
+            listed = self.__listed.get(prefix)
+            if listed is None:
+                listed = self.__listed[prefix] = threading.Event()
+                lister = True
+            else:
+                lister = False
+
+        if not lister:
+            listed.wait()
+            return
+
+        try:
+            names = list(prefix)
+            with self.__lock:
+                self.__listed_names.update(names)
+        finally:
+            listed.set()
+
+    def write(self):
+        """Appends the objects recorded since the last write to the file."""
+
+        with self.__lock:
+            new = self.__new
+            self.__new = []
+
+            try:
+                if self.__names is not None and self.__lines + len(new) > max(COMPACT_MIN, COMPACT_RATIO * len(self.__names)):
+                    self.__compact()
+                elif new:
+                    # a single append, so lines written by concurrent processes aren't interleaved
+                    fd = os.open(self.__path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+                    try:
+                        os.write(fd, ''.join(name + '\n' for name in new))
+                    finally:
+                        os.close(fd)
+                    self.__lines += len(new)
+            except (IOError, OSError) as e:
+                log.info("could not write the remote inventory: " + str(e))
+
+    def __compact(self):
+        """
+        Rewrites the file with a line per object, atomically replacing it. The lock must be held.
+        Names appended by other processes since the file was read are dropped, which only means
+        those objects are looked up on the remote again.
+        """
+        fd, tmp = tempfile.mkstemp(prefix=cache.TEMP_PREFIX, dir=os.path.dirname(self.__path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(''.join(name + '\n' for name in sorted(self.__names)))
+
+            try:
+                os.rename(tmp, self.__path)
+            except OSError:
+                # Windows won't rename over an existing file
+                os.remove(self.__path)
+                os.rename(tmp, self.__path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self.__lines = len(self.__names)
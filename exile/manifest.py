@@ -0,0 +1,145 @@
+import json
+import os
+
+INDENT = ' ' * 4
+
+# the number of entries encoded before the output is written to the file
+CHUNK_ENTRIES = 4096
+
+encode_string = json.encoder.encode_basestring_ascii
+
+def encode_value(value, indent):
+    """Returns the JSON text of a value other than a dict."""
+
+    if isinstance(value, basestring):
+        return encode_string(value)
+
+    # other values only appear in the remote configuration, so use json to match it exactly
+    return json.dumps(value, indent=4, sort_keys=True).replace('\n', '\n' + indent)
+
+def iterencode(config):
+    """
+    Generates the JSON text of a manifest in chunks of about CHUNK_ENTRIES entries. The text is the
+    same as json.dump(config, file, indent=4, sort_keys=True) produces, so manifests written by
+    either produce no diffs, but dicts and strings (all of the tracked files) are encoded directly
+    rather than through the pure Python encoder json uses when indenting.
+    """
+    if not isinstance(config, dict):
+        yield encode_value(config, '')
+        return
+
+    chunk = []
+
+    def encode_dict(value, indent):
+        if not value:
+            chunk.append('{}')
+            return
+
+        inner = indent + INDENT
+        separator = '{\n' + inner
+        for key in sorted(value):
+            child = value[key]
+            if isinstance(child, dict):
+                chunk.append(separator + encode_string(key) + ': ')
+                for text in encode_dict(child, inner):
+                    yield text
+            else:
+                chunk.append(separator + encode_string(key) + ': ' + encode_value(child, inner))
+            separator = ', \n' + inner
+
+            if len(chunk) >= CHUNK_ENTRIES:
+                yield ''.join(chunk)
+                del chunk[:]
+
+        chunk.append('\n' + indent + '}')
+
+    for text in encode_dict(config, ''):
+        yield text
+
+    yield ''.join(chunk)
+
+def dump(config, file):
+    """Writes the JSON text of a manifest to a file object."""
+    for text in iterencode(config):
+        file.write(text)
+
+class ReplacingFile:
+    """
+    Writes the new contents of a file to a temporary file next to it, comparing them with the
+    current contents as they are written. Only if they differ is the temporary file flushed to the
+    disk and renamed over the file, so a crash never leaves a partially written file, and a file
+    whose contents don't change isn't modified at all (keeping its mtime).
+    """
+
+    def __init__(self, path):
+        self.__path = path
+        self.__tmp = os.path.join(os.path.dirname(os.path.abspath(path)), '.%s.%d.tmp' % (os.path.basename(path), os.getpid()))
+        self.__file = None
+
+        try:
+            self.__existing = open(path, 'rb')
+        except IOError:
+            self.__existing = None  # doesn't exist yet
+        self.__matching = self.__existing is not None
+
+        try:
+            # created like any new file (subject to the umask), and given the mode of the file it replaces
+            self.__file = os.fdopen(os.open(self.__tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666), 'wb')
+            if self.__existing is not None:
+                os.chmod(self.__tmp, os.fstat(self.__existing.fileno()).st_mode & 07777)
+        except:
+            self.close()
+            raise
+
+    def write(self, data):
+        if self.__matching:
+            self.__matching = self.__existing.read(len(data)) == data
+        self.__file.write(data)
+
+    def commit(self):
+        """
+        Replaces the file with the new contents if they differ from the current ones.
+
+        Returns:
+            True if the contents have changed
+        """
+        changed = not self.__matching or self.__existing.read(1) != ''
+        if changed:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__close_files()
+
+            try:
+                os.rename(self.__tmp, self.__path)
+            except OSError:
+                # Windows won't rename over an existing file
+                os.remove(self.__path)
+                os.rename(self.__tmp, self.__path)
+
+        return changed
+
+    def __close_files(self):
+        for file in (self.__existing, self.__file):
+            if file is not None:
+                file.close()
+
+    def close(self):
+        """Closes the files and removes the temporary file, unless it has replaced the file."""
+
+        self.__close_files()
+        if os.path.exists(self.__tmp):
+            os.remove(self.__tmp)
+
+def write(path, config):
+    """
+    Writes a manifest, atomically replacing the file if its contents have changed.
+
+    Returns:
+        True if the contents of the manifest changed
+    """
+    output = ReplacingFile(path)
+    try:
+        dump(config, output)
+        return output.commit()
+    finally:
+        output.close()
@@ -1,115 +1,538 @@
+import cache
+import collections
+import contextlib
+import fastcopy
 import files
+import hashing
+import inventory
 import json
 import os
-import shutil
+import tempfile
 import threading
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # not available on Windows
+
 SNAPSHOT = '.exile.snapshot'
+SNAPSHOT_HEADER = 'exile-snapshot 2\n'
+
+# the snapshot log is compacted once it holds this many records per entry (and at least COMPACT_MIN records)
+COMPACT_RATIO = 2
+COMPACT_MIN = 1024
 
-# snapshot instance shared among all threads
-# TODO: instance per-thread with merging logic
+# snapshot instance shared among all threads, which each record their changes separately (see Snapshot)
 snapshot = None
-snapshot_lock = threading.Lock()
+snapshot_lock = threading.Lock()    # guards creation of the shared snapshot
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: while a call for a key is in progress, later
+    callers with the same key wait for it to finish instead of repeating it.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__flights = {}     # maps keys in progress to [completion event, exception]
+
+    def run(self, key, function):
+        """
+        Calls function(), unless a call for the same key is already in progress, in which case this
+        waits for that call and raises its exception if it failed.
+
+        Returns:
+            True if this caller ran the function, False if it waited for another caller
+        """
+        return bool(self.run_many([key], lambda keys: function()))
+
+    def run_many(self, keys, function):
+        """
+        Like run for several keys at once: calls function(keys) with the keys that no call is in
+        progress for, if any, then waits for the calls in progress for the other keys.
+
+        Returns:
+            the list of keys this caller ran the function for
+        """
+        flight = [threading.Event(), None]
+        led = []
+        waiting = []
+        with self.__lock:
+            for key in keys:
+                other = self.__flights.get(key)
+                if other is None:
+                    self.__flights[key] = flight
+                    led.append(key)
+                elif other is not flight:
+                    waiting.append(other)
+
+        if led:
+            try:
+                function(led)
+            except Exception as e:
+                flight[1] = e
+                raise
+            finally:
+                with self.__lock:
+                    for key in led:
+                        del self.__flights[key]
+                flight[0].set()
+
+        for other in waiting:
+            other[0].wait()
+            if other[1] is not None:
+                raise other[1]
+
+        return led
+
+# coalesces fetches of the same object by the threads of this process, so each is downloaded once
+fetches = SingleFlight()
+
+def mtime_ns(stat):
+    """
+    Returns the mtime of a stat result in integer nanoseconds, so that it is stored exactly rather
+    than as a float. Python 2's stat has no nanosecond fields, so there the float mtime (accurate
+    to about a microsecond) is converted instead; Snapshot.hash doesn't trust entries recorded
+    within the same instant the file was modified in, which also covers the lost precision.
+    """
+    ns = getattr(stat, 'st_mtime_ns', None)
+    if ns is None:
+        ns = int(round(stat.st_mtime * 1e9))
+    return ns
+
+def load_snapshot(root):
+    """Loads the shared snapshot for the given root, unless it has already been loaded."""
+
+    global snapshot, snapshot_lock
+
+    with snapshot_lock:
+        if snapshot is None:
+            snapshot = Snapshot(root)
+        return snapshot
 
 class Snapshot:
-    """Models the cached information about currently resolved files."""
+    """
+    Models the cached information about currently resolved files.
+
+    Each entry is a list of [hash, mtime (in nanoseconds), size, inode] describing the file as it was when the
+    hash was recorded, which also lets the snapshot act as a cache of file hashes for add.
+
+    The snapshot file is an append-only log: a header line followed by one JSON list per line of
+    [path, hash, mtime, size, inode], where later lines replace earlier ones for the same path.
+    Writing only appends the entries that changed, and the log is compacted once most of its
+    lines have been replaced. The file is only read when an entry is first needed.
+
+    Several processes may share the log, so it is locked while it is written (where files can be
+    locked), and the records other processes appended since it was read are taken in first.
+
+    The snapshot is shared by all worker threads without a lock: each thread records its changes
+    in its own delta, which it consults before the shared entries. The deltas are merged into the
+    shared entries by write, which must only be called while no other thread is using the snapshot.
+    """
 
     def __init__(self, root):
+        self.__root = root
         self.__path = os.path.join(root, SNAPSHOT)
+        self.__realdirs = {}    # memoizes relative's resolved directories for this snapshot's lifetime
+
+        self.__data = None      # loaded lazily, maps relative paths to entries
+        self.__load_lock = threading.Lock()
+        self.__dirty = {}       # entries changed since the last write
+
+        self.__local = threading.local()
+        self.__deltas = []      # the delta of every thread that has changed an entry
+        self.__deltas_lock = threading.Lock()
+        self.__records = 0      # the number of records in the log
+        self.__valid = None     # the offset after the last complete record, None if the log must be rewritten
+        self.__written = 0      # the mtime of the log when it was loaded, in nanoseconds
+        self.__inode = None     # the inode of the log that was read
+
+    def __load(self):
+        """Reads the snapshot file, if it hasn't been read yet, and returns the entries."""
+
+        if self.__data is not None:
+            return self.__data
+
+        with self.__load_lock:
+            if self.__data is None:
+                data = {}
+                try:
+                    with open(self.__path, 'rb') as file:
+                        st = os.fstat(file.fileno())
+                        self.__written = mtime_ns(st)
+
+                        if file.readline() == SNAPSHOT_HEADER:
+                            self.__inode = st.st_ino
+                            self.__records, self.__valid = self.__read(file, data)
+                        else:
+                            # older versions stored the snapshot as a nested JSON dict,
+                            # which is converted to a log the next time it is written
+                            file.seek(0)
+                            self.__flatten(json.load(file), '', data)
+                except (IOError, ValueError):
+                    pass
+
+                # only published once complete, since other threads read it without the lock
+                self.__data = data
+
+        return self.__data
+
+    def __read(self, file, data):
+        """
+        Reads the records from the current position of the log into data. A record cut short by a
+        crash ends the log. Returns the number of records read and the offset after the last
+        complete one.
+        """
+        count = 0
+        valid = file.tell()
+        for line in file:
+            try:
+                if not line.endswith('\n'):
+                    break
+                record = json.loads(line)
+            except ValueError:
+                break
+
+            data[record[0]] = record[1:]
+            count += 1
+            valid += len(line)
+        return count, valid
+
+    def __flatten(self, value, parent, data):
+        """Adds the entries of a nested dict snapshot from an older version of exile to data."""
+
+        for name, child in value.iteritems():
+            path = os.path.join(parent, name)
+            if type(child) is dict:
+                self.__flatten(child, path, data)
+            else:
+                data[path] = child
+
+    def __delta(self):
+        """Returns the entries changed by the current thread since the last merge."""
 
         try:
-            with open(self.__path, 'r') as file:
-                self.__data = json.load(file)
-        except IOError as e:
-            self.__data = {}
+            return self.__local.delta
+        except AttributeError:
+            delta = self.__local.delta = {}
+            with self.__deltas_lock:
+                self.__deltas.append(delta)
+            return delta
 
-        self.__files = files.FileMapping(root, self.__data, silent=True)
+    def merge(self):
+        """Merges the changes made by every thread into the shared entries."""
+
+        data = self.__load()
+        with self.__deltas_lock:
+            for delta in self.__deltas:
+                data.update(delta)
+                self.__dirty.update(delta)
+                delta.clear()
 
     def getmtime(self):
         """Gets the mtime of the snapshot file"""
         return os.path.getmtime(self.__path)
 
-    def add(self, path, hash):
-        return self.__files.add(path, (hash, os.path.getmtime(path)))
+    def add(self, path, hash, stat=None):
+        """
+        Records the hash of a file along with its current stat information.
+
+        Args:
+            path: the path of the file
+            hash: the hash of the file's contents
+            stat: the result of os.stat taken before the file was hashed, if available
+        """
+        if stat is None:
+            stat = os.stat(path)
+        self.__set(path, [hash, mtime_ns(stat), stat.st_size, stat.st_ino])
+
+    def __set(self, path, entry):
+        key = files.relative(self.__root, path, self.__realdirs)
+        if key is not None:
+            self.__delta()[key] = entry
 
     def get(self, path):
-        return self.__files.get(path)
+        key = files.relative(self.__root, path, self.__realdirs)
+        if key is None:
+            return None
+        return self.__entry(key)
+
+    def __entry(self, key):
+        """Returns the entry for a path relative to the root."""
+
+        entry = self.__delta().get(key)
+        if entry is None:
+            entry = self.__load().get(key)
+        return entry
+
+    def __matches(self, entry, hash, stat):
+        """Returns whether an entry records the given object and stat information."""
+
+        if entry is None or len(entry) < 4 or entry[0] != hash:
+            return False
+        return [mtime_ns(stat), stat.st_size, stat.st_ino] == list(entry[1:4])
+
+    def current(self, path, hash, stat):
+        """
+        Returns True if a file is known to hold the given object: its recorded hash matches and its
+        mtime, size and inode are unchanged since it was recorded. The stat should follow symlinks,
+        so that changes to a linked object are detected too.
+
+        Args:
+            path: the path of the file
+            hash: the name of the object the file should contain
+            stat: the result of os.stat for the file
+        """
+        return self.__matches(self.get(path), hash, stat)
+
+    def outdated(self, items):
+        """
+        Generates the (path, hash) items whose files aren't known to hold their objects (see current).
+
+        Files are checked a directory at a time: each directory is listed once, so that missing
+        files (e.g. in a fresh checkout) are found without a failed stat each.
+
+        Args:
+            items: (path, hash) tuples, as returned by FileMapping.items
+        """
+        directories = collections.OrderedDict()
+        for path, hash in items:
+            dir, name = os.path.split(path)
+            directories.setdefault(dir, []).append((path, name, hash))
+
+        for dir, entries in directories.iteritems():
+            try:
+                names = set(os.listdir(dir))
+            except OSError:
+                names = set()   # a missing directory means every file in it is missing
+
+            # the directory is made relative once, rather than every path in it
+            rel = files.relative(self.__root, dir, self.__realdirs)
+            prefix = '' if rel == os.curdir else os.path.join(rel, '')
+
+            for path, name, hash in entries:
+                if rel is not None and name in names:
+                    try:
+                        if self.__matches(self.__entry(prefix + name), hash, os.stat(path)):
+                            continue
+                    except OSError:
+                        pass    # a broken symlink
+
+                yield path, hash
+
+    def rename(self, path, old, new):
+        """
+        Replaces the hash recorded for a path, as long as it currently records the old hash.
+
+        Args:
+            path: the path of the file
+            old: the hash that is expected to be recorded
+            new: the hash that should replace it
+        """
+        snapdata = self.get(path)
+        if snapdata is not None and snapdata[0] == old:
+            self.__set(path, [new] + list(snapdata[1:]))
+
+    def hash(self, path, stat):
+        """
+        Returns the recorded hash for a file if it is unchanged since it was recorded, otherwise None.
+
+        Args:
+            path: the path of the file
+            stat: the result of os.stat for the file
+        """
+        snapdata = self.get(path)
+        if snapdata is None or len(snapdata) < 4:
+            return None
+
+        if [mtime_ns(stat), stat.st_size, stat.st_ino] != list(snapdata[1:4]):
+            return None
+
+        # a file modified in the same instant it was recorded may have changed without
+        # its mtime showing it, so only trust entries that are older than the snapshot
+        if mtime_ns(stat) >= self.__written:
+            return None
+
+        return snapdata[0]
 
     def write(self):
-        """Writes the current state of the snapshot back to the snapshot file"""
-        with open(self.__path, 'wb') as file:
-            json.dump(self.__data, file)#, indent=4, sort_keys=True)
+        """Merges the changes made by every thread and writes them to the snapshot file"""
+
+        self.merge()
+
+        if self.__data is None or (not self.__dirty and self.__valid is not None):
+            return
+
+        with self.__locked() as file:
+            self.__catch_up(file)
+
+            if self.__valid is None or self.__records + len(self.__dirty) > max(COMPACT_MIN, COMPACT_RATIO * len(self.__data)):
+                self.__compact(file)
+            else:
+                # the file is in append mode, so the records land after everything else's
+                file.seek(0, os.SEEK_END)
+                self.__append(file, self.__dirty)
+                self.__valid = os.fstat(file.fileno()).st_size
+                self.__records += len(self.__dirty)
+
+        self.__dirty = {}
+
+    @contextlib.contextmanager
+    def __locked(self):
+        """
+        Returns a context manager providing the log opened for appending (and created if missing),
+        locked against other processes until the context exits.
+        """
+        while True:
+            file = open(self.__path, 'a+b')
+            if fcntl is None:
+                break   # unlocked, but records are still only ever appended
+
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                # another process may have compacted the log while this one waited for the lock
+                if os.fstat(file.fileno()).st_ino == os.stat(self.__path).st_ino:
+                    break
+            except OSError:
+                pass
+            file.close()
+
+        try:
+            yield file
+        finally:
+            file.close()    # releases the lock
+
+    def __catch_up(self, file):
+        """
+        Takes in the records other processes appended to the locked log since it was read (all of
+        them if the log was replaced), and cuts off a record left incomplete by a crash. Entries
+        this process changed keep its own values.
+        """
+        st = os.fstat(file.fileno())
+        file.seek(0)
+        if self.__valid is None or st.st_ino != self.__inode:
+            if file.readline() != SNAPSHOT_HEADER:
+                return  # empty, or in the nested format, so it is compacted
+            self.__inode = st.st_ino
+            self.__records = 0
+        else:
+            file.seek(self.__valid)
+
+        appended = {}
+        count, self.__valid = self.__read(file, appended)
+        self.__records += count
+        for path, entry in appended.iteritems():
+            if path not in self.__dirty:
+                self.__data[path] = entry
+
+        # writers hold the lock, so an incomplete record can only have been left by a crash
+        if self.__valid < st.st_size:
+            file.truncate(self.__valid)
+
+    def __append(self, file, entries):
+        """Writes records for the given entries and makes sure they reach the disk."""
+        for path in sorted(entries):
+            file.write(json.dumps([path] + list(entries[path])) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+    def __compact(self, old):
+        """
+        Rewrites the log with a single record per entry, atomically replacing the old log.
+
+        Args:
+            old: the old log, opened by __locked
+        """
+
+        fd, tmp = tempfile.mkstemp(prefix=SNAPSHOT + '.', dir=self.__root)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(SNAPSHOT_HEADER)
+                self.__append(file, self.__data)
+                valid = file.tell()
+                inode = os.fstat(file.fileno()).st_ino
+
+            try:
+                os.rename(tmp, self.__path)
+            except OSError:
+                # Windows won't rename over an existing file, or remove one that is open
+                old.close()
+                os.remove(self.__path)
+                os.rename(tmp, self.__path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self.__valid = valid
+        self.__inode = inode
+        self.__records = len(self.__data)
 
 class CachedCommunicator:
     """Wrapper around the Communicator classes provided by adapters, but maintains a local cache."""
 
-    def __init__(self, root, cache_path, force, communicator):
+    def __init__(self, root, cache_path, force, communicator, algorithm=hashing.DEFAULT_ALGORITHM, modes=fastcopy.DEFAULT_MODES, inventory=None):
         """
         Initialize the communicator.
 
         Args:
             root: the root of the repository
             cache_path: the path to the cache directory
-            force: if true, always resolve files even if the snapshot shows them up-to-date
+            force: if true, always resolve files even if the snapshot shows them up-to-date, and
+                   always upload objects even if the remote is known to have them
             communicator: the communicator to wrap
+            algorithm: the hash algorithm used to name new objects
+            modes: the ways to try placing objects in the workspace, in order (see fastcopy.MODES)
+            inventory: the Inventory of the remote's objects, if uploads should skip objects the remote has
         """
 
-        global snapshot, snapshot_lock
-
-        if os.path.exists(cache_path) and not os.path.isdir(cache_path):
-            raise RuntimeError('cache is not a directory, please remove it: ' + cache_path)
-
-        # create if it doesn't exist
-        try:
-            os.mkdir(cache_path)
-        except OSError:
-            pass
-
-        self.__cache = cache_path
+        self.__cache = cache.ObjectCache(cache_path)
         self.__force = force
         self.__comm = communicator
-        
-        with snapshot_lock:
-            if snapshot is None:
-                snapshot = Snapshot(root)
+        self.__algorithm = algorithm
+        self.__modes = modes
+        self.__inventory = inventory
+
+        load_snapshot(root)
 
     def get(self, hash, dest):
         """
-        Copies an object from the cache to a destination, downloading it if necessary.
+        Places an object from the cache at a destination, downloading it if necessary.
 
         Args:
             hash: the name of the object (the hash of the file)
             dest: the path to which the object should be copied
         """
-        global snapshot, snapshot_lock
+        if self.outdated(hash, dest):
+            self.place(self.fetch(hash), hash, dest)
+
+    def outdated(self, hash, dest):
+        """Returns whether a destination needs to be resolved (see get)."""
 
         if not self.__force:
             try:
-                with snapshot_lock:
-                    snapdata = snapshot.get(dest)
-
-                if (snapdata is not None and
-                    # if the target hasn't been modified since the last snapshot
-                    os.path.getmtime(dest) == snapdata[1] and
-                    # and the new hash is the same as the one in the snapshot
-                    snapdata[0] == hash):
-                    # then there's nothing to do
-                    return
+                stat = os.stat(dest)
+
+                # if the target hasn't been modified since the last snapshot and it
+                # already holds the requested object, then there's nothing to do
+                if snapshot.current(dest, hash, stat):
+                    return False
             except OSError:
                 # if we have no snapshot or dest doesn't exist, we can't optimize
                 pass
 
-        cached = os.path.join(self.__cache, hash)
-
-        if not os.path.exists(cached):
-            self.__comm.get(hash, cached)
-
-        if not os.path.exists(cached):
-            raise RuntimeError("failed to download object: " + hash)
+        return True
 
-        if not os.path.isfile(cached):
-            raise RuntimeError("stray non-file object in cache, please remove: " + cached)
+    def place(self, cached, hash, dest):
+        """
+        Places an object from the cache at a destination and records it in the snapshot. Only
+        uses the local disk, never the remote.
 
+        Args:
+            cached: the path of the object in the cache (see fetch)
+            hash: the name of the object
+            dest: the path at which the object should appear
+        """
         dir = os.path.dirname(dest)
         if dir:
             # create if it doesn't exist
@@ -117,23 +540,187 @@ class CachedCommunicator:
                 os.makedirs(os.path.dirname(dest))
             except OSError:
                 pass
-        shutil.copy(cached, dest)
+        fastcopy.materialize(cached, dest, self.__modes)
+        snapshot.add(dest, hash)
+
+    def fetch(self, hash):
+        """
+        Makes sure an object is present in the cache, downloading it if necessary.
+
+        Args:
+            hash: the name of the object (the hash of the file)
+
+        Returns:
+            the path of the object in the cache
+        """
+        def fetch():
+            if self.__cache.download(hash, lambda tmp: self.__comm.get(hash, tmp)):
+                self.__record([hash])
+            else:
+                self.__cache.touch(hash)
+
+        # threads of this process are coalesced here, and other processes sharing the cache by
+        # the cache's claim on the object
+        fetches.run(hash, fetch)
+
+        return self.__cached(hash)
 
-        with snapshot_lock:
-            snapshot.add(dest, hash)
+    def fetch_many(self, hashes):
+        """
+        Makes sure several objects are present in the cache, like fetch. If the adapter provides
+        get_many, the missing objects are downloaded with a single call to it.
+
+        Args:
+            hashes: the names of the objects
+
+        Returns:
+            a list of the paths of the objects in the cache, in the same order
+        """
+        get_many = getattr(self.__comm, 'get_many', None)
+        if get_many is None:
+            return [self.fetch(hash) for hash in hashes]
+
+        def fetch(led):
+            inserted = self.__cache.download_many(led, get_many)
+            self.__record(inserted)
+            for hash in set(led) - inserted:
+                self.__cache.touch(hash)
+
+        # like fetch, objects another thread is fetching are waited for rather than fetched again
+        fetches.run_many(hashes, fetch)
+
+        return [self.__cached(hash) for hash in hashes]
+
+    def __cached(self, hash):
+        """Returns the path of an object that should have been fetched, raising RuntimeError if it is missing."""
+
+        cached = self.__cache.path(hash)
+        if not os.path.exists(cached):
+            raise RuntimeError("failed to download object: " + hash)
+
+        if not os.path.isfile(cached):
+            raise RuntimeError("stray non-file object in cache, please remove: " + cached)
+
+        return cached
+
+    def migrate(self, hash, path, migrated):
+        """
+        Re-uploads an object under its content-only name using the configured algorithm.
+
+        Args:
+            hash: the legacy name of the object
+            path: the tracked path the object belongs to
+            migrated: a list to which a (path, new hash) tuple is appended once the object is migrated
+        """
+        cached = self.fetch(hash)
+        new = hashing.hash(cached, self.__algorithm)
+
+        if new != hash:
+            renamed = self.__cache.path(new)
+            if not os.path.exists(renamed):
+                self.__cache.insert(cached, new)
+            self.put(renamed, new)
+
+            snapshot.rename(path, hash, new)
+
+        migrated.append((path, new))
 
     def put(self, source, hash):
         """
-        Uploads an object to the remote, keeping a copy in the local cache.
+        Uploads an object to the remote, keeping a copy in the local cache. Objects the remote
+        already has are skipped (see __on_remote).
+
+        The upload is served from the cached copy, which add has usually already created while
+        hashing the file (see ObjectCache.ingest), so the source is only read if it is missing.
 
         Args:
             source: the file to upload
             hash: the name of the object to create (the hash of the file)
         """
-        global snapshot, snapshot_lock
+        cached = self.__cache_source(source, hash)
+        if not self.__on_remote({ hash: os.path.getsize(cached) }):
+            self.__comm.put(cached, hash)
+            self.__record([hash])
+
+    def put_many(self, items):
+        """
+        Uploads several objects, like put. If the adapter provides put_many, the objects the remote
+        doesn't already have are uploaded with a single call to it.
+
+        Args:
+            items: a list of (source, hash) tuples
+        """
+        put_many = getattr(self.__comm, 'put_many', None)
+        if put_many is None:
+            for source, hash in items:
+                self.put(source, hash)
+            return
+
+        uploads = collections.OrderedDict()
+        for source, hash in items:
+            if hash not in uploads:
+                uploads[hash] = self.__cache_source(source, hash)
+
+        for hash in self.__on_remote(dict((hash, os.path.getsize(cached)) for hash, cached in uploads.iteritems())):
+            del uploads[hash]
 
-        shutil.copy(source, os.path.join(self.__cache, hash))
-        self.__comm.put(source, hash)
+        if uploads:
+            put_many([(cached, hash) for hash, cached in uploads.iteritems()])
+            self.__record(list(uploads))
 
-        with snapshot_lock:
-            snapshot.add(source, hash)
+    def __on_remote(self, sizes):
+        """
+        Returns the set of the given objects that the remote already has. Objects that aren't in
+        the inventory are looked up with the adapter's exists_many, unless they are smaller than
+        inventory.LOOKUP_MIN_SIZE, in which case they are assumed to be missing. Once enough
+        objects under a prefix have been looked up (see inventory.LIST_THRESHOLD), the prefix is
+        listed instead, if the adapter provides list, which happens once per prefix and process.
+        Found objects are recorded in the inventory.
+
+        Args:
+            sizes: maps the names of the objects to their sizes
+        """
+        if self.__force:
+            return set()
+
+        unknown = [hash for hash in sorted(sizes) if self.__inventory is None or not self.__inventory.contains(hash)]
+        missing = [hash for hash in unknown if sizes[hash] < inventory.LOOKUP_MIN_SIZE]
+        unknown = [hash for hash in unknown if sizes[hash] >= inventory.LOOKUP_MIN_SIZE]
+
+        list_objects = getattr(self.__comm, 'list', None)
+        exists_many = getattr(self.__comm, 'exists_many', None)
+        if unknown and self.__inventory is not None and list_objects is not None:
+            prefixes = collections.defaultdict(list)
+            for hash in unknown:
+                prefixes[inventory.prefix(hash)].append(hash)
+
+            unknown = []
+            for prefix, names in sorted(prefixes.iteritems()):
+                if exists_many is None or self.__inventory.look_up(prefix, len(names)) >= inventory.LIST_THRESHOLD:
+                    self.__inventory.refresh(prefix, list_objects)
+
+                if self.__inventory.listed(prefix):
+                    # the listing is complete, so objects missing from it don't need looking up
+                    missing.extend(hash for hash in names if not self.__inventory.contains(hash))
+                else:
+                    unknown.extend(names)
+
+        if unknown and exists_many is not None:
+            found = exists_many(unknown)
+            self.__record(found)
+            unknown = [hash for hash in unknown if hash not in found]
+
+        return set(sizes) - set(unknown) - set(missing)
+
+    def __record(self, hashes):
+        """Records objects known to exist on the remote in the inventory."""
+        if self.__inventory is not None:
+            self.__inventory.add(hashes)
+
+    def __cache_source(self, source, hash):
+        """Returns the path of the cached copy of a file being uploaded, inserting it if it is missing."""
+
+        cached = self.__cache.path(hash)
+        if not os.path.exists(cached):
+            self.__cache.insert(source, hash)
+        return cached
@@ -1,11 +1,16 @@
+import collections
 import copy
+import fastcopy
+import hashing
 import imp
+import inventory
 import log
 import multiprocessing
 import os
-import Queue
 import remote
+import sys
 import threading
+import time
 import traceback
 
 def load_comm_module(config):
@@ -19,88 +24,575 @@ def load_comm_module(config):
     file, path, desc = imp.find_module(type, [os.path.join(parent, 'adapters')])
     return imp.load_module(type, file, path, desc)
 
+def parallel(function, items, threads):
+    """
+    Calls function(*args) for each args tuple in items, on up to the given number of threads, for
+    adapters that transfer several objects (or parts of one) at once. Once a call fails no more
+    are started, and the first error is raised once every thread has stopped.
+    """
+    pending = list(reversed(items))
+    errors = []
+    lock = threading.Lock()
+
+    def main():
+        while True:
+            with lock:
+                if errors or not pending:
+                    return
+                args = pending.pop()
+
+            try:
+                function(*args)
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    workers = [threading.Thread(target=main) for _ in range(max(1, min(threads, len(items))) - 1)]
+    for t in workers:
+        t.start()
+    main()  # the calling thread takes its share rather than waiting idly
+    for t in workers:
+        t.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
 THREAD_COUNT = 250   # Windows can support up to 1000 threads for a process . But win 7 x64 supports not more than 300 open files at a time .
 
-class AsyncCommunicator:
-    """Wrapper around the Communicator classes provided by adapters that distributes work across multiple threads."""
+# the number of tasks that may run at once before any have completed
+INITIAL_THREADS = 4
 
-    def __init__(self, root, cache_path, config, force):
-        # tracks exceptions thrown from worker threads
-        self.__last_exception = None
+# a window of tasks is congested if its throughput fell by more than this fraction from the
+# previous window's while the latency of its tasks rose by more than this fraction
+TOLERANCE = 0.1
 
-        # work queue for worker threads
-        self.__queue = Queue.Queue(1)   # maxsize 1 prevents callers from getting to far ahead
+class Concurrency:
+    """
+    Chooses how many tasks to run at once from the latency and throughput of completed tasks, like
+    TCP congestion control. The limit is adjusted after each window of as many tasks as the limit.
+    While tasks are waiting for a thread, the limit doubles (slow start) until the first sign of
+    congestion, and grows by one afterwards. When throughput drops while latency rises, more
+    concurrent requests are only queueing up at the remote, so the limit is halved.
+    """
 
-        # load the module here since importing isn't thread-safe
-        comm_module = load_comm_module(config)
+    def __init__(self, maximum, initial=INITIAL_THREADS, clock=time.time):
+        """
+        Args:
+            maximum: the most tasks that may ever run at once
+            initial: the number of tasks that may run at once to begin with
+            clock: returns the current time in seconds
+        """
+        self.limit = max(1, min(initial, maximum))
+
+        self.__maximum = maximum
+        self.__clock = clock
+        self.__slow_start = True
+        self.__lock = threading.Lock()
 
-        # start all worker threads
-        for x in range(THREAD_COUNT):
-            t = threading.Thread(target=AsyncCommunicator.__worker_main, args=(self, root, cache_path, comm_module, copy.deepcopy(config), force))
-            t.daemon = True
-            t.start()
+        self.__throughput = None    # tasks per second in the previous window
+        self.__latency = None       # mean seconds per task in the previous window
+        self.__reset()
 
-    def __worker_main(self, root, cache_path, comm_module, config, force):
+    def __reset(self):
+        self.__start = self.__clock()
+        self.__count = 0
+        self.__total = 0.0
+
+    def record(self, latency, saturated):
+        """
+        Records a completed task.
+
+        Args:
+            latency: the number of seconds the task took
+            saturated: whether other tasks were waiting for a thread when it completed
         """
-        The entry point for worker threads. Pulls work from the queue as it
-        becomes available.
+        with self.__lock:
+            self.__count += 1
+            self.__total += latency
+            if self.__count < self.limit:
+                return
+
+            throughput = self.__count / max(self.__clock() - self.__start, 1e-6)
+            mean = self.__total / self.__count
+
+            if self.__throughput is not None and throughput < self.__throughput * (1 - TOLERANCE) and mean > self.__latency * (1 + TOLERANCE):
+                self.limit = max(1, self.limit // 2)
+                self.__slow_start = False
+            elif saturated:
+                self.limit = min(self.__maximum, self.limit * 2 if self.__slow_start else self.limit + 1)
+
+            self.__throughput = throughput
+            self.__latency = mean
+            self.__reset()
+
+# the most tasks that may be waiting for a network thread before submitting another blocks
+MAX_PENDING = 1024
+
+# the most downloaded objects that may be waiting to be placed in the workspace
+MAX_DISK_PENDING = 64
+
+# the most threads placing objects in the workspace, unless the "disk_threads" key is configured
+DISK_THREADS = max(4, 2 * multiprocessing.cpu_count())
+
+# the most tasks a thread takes from the queue at once
+BATCH_SIZE = 16
+
+class Cancelled(Exception):
+    """Raised by Future.result for a task that was cancelled before it ran."""
+
+class Future:
+    """The eventual result of a task submitted to a Stage."""
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__result = None
+        self.__exception = None
+
+    def set_result(self, result):
+        self.__result = result
+        self.__done.set()
+
+    def set_exception(self, exception):
+        self.__exception = exception
+        self.__done.set()
+
+    def cancel(self):
+        self.set_exception(Cancelled("task cancelled"))
+
+    def done(self):
+        return self.__done.is_set()
+
+    def result(self):
+        """Waits for the task to complete, returning its result or raising its exception."""
+        self.__done.wait()
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+class Stage:
+    """
+    A pool of threads running one kind of task, fed by a bounded queue.
 
+    Each submitted task returns a Future. Up to a fixed number of tasks may wait for a thread, and
+    threads take up to BATCH_SIZE of them at once, so short tasks don't each pay for a trip through
+    the queue. The first task to fail cancels all waiting tasks and wakes any thread waiting to
+    submit or join, which then raises Cancelled.
+
+    Threads are started as work arrives, up to the limit chosen by a Concurrency. Threads above a
+    reduced limit exit once their tasks complete, leaving their contexts to be reused by the
+    threads started later. The rest exit once the stage is closed.
+    """
+
+    def __init__(self, name, concurrency, capacity, context, failed=None):
+        """
         Args:
-            root: the directory containing the config file
-            cache_path: the path to the local cache directory
-            comm_module: the Python module for the configured adapter
-            config: the configuration necessary to construct a communicator
-            force: if true, configure the communcator to force updates
+            name: describes the stage in messages
+            concurrency: the Concurrency choosing the number of threads
+            capacity: the most tasks that may wait for a thread
+            context: creates the object passed to tasks by a new thread
+            failed: called with (message, traceback) when a task fails
         """
+        self.name = name
+        self.__concurrency = concurrency
+        self.__capacity = capacity
+        self.__context = context
+        self.__failed = failed
+
+        # guards everything below, and is notified whenever any of it changes
+        self.__condition = threading.Condition()
+        self.__tasks = collections.deque()  # (future, function, args) tuples waiting for a thread
+        self.__running = 0                  # tasks taken by threads that haven't completed
+        self.__threads = 0
+        self.__idle = 0                     # threads that are waiting for a task
+        self.__contexts = []                # contexts left by threads that have exited
+        self.__workers = []                 # every thread started, so that close can wait for them
+        self.__closed = False               # set by close, telling idle threads to exit
+        self.error = None                   # (message, traceback) of the first task that failed
+
+        # instrumentation
+        self.__created = time.time()
+        self.__tasks_done = 0
+        self.__peak = 0                     # the most threads running at once
+        self.__busy = 0.0                   # seconds spent running tasks, summed over all threads
+        self.__blocked = 0.0                # seconds submitters spent waiting for room in the queue
+        self.__thread_time = 0.0            # the lifetimes of threads that have exited
+        self.__started = {}                 # the start time of every running thread
+
+    def __start_worker(self):
+        """Starts another thread if no thread is idle and the concurrency limit allows it."""
+
+        with self.__condition:
+            if self.__idle or self.__threads >= self.__concurrency.limit:
+                return
+            self.__threads += 1
+            self.__idle += 1
+            self.__peak = max(self.__peak, self.__threads)
+            context = self.__contexts.pop() if self.__contexts else None
 
         try:
-            comm = remote.CachedCommunicator(root, cache_path, force, comm_module.Communicator(config))
+            if context is None:
+                context = self.__context()
         except Exception as e:
-            self.__last_exception = (str(e), traceback.format_exc())
+            with self.__condition:
+                self.__threads -= 1
+                self.__idle -= 1
+            self.fail(str(e), traceback.format_exc())
             return
 
-        # once any thread throws an exception, stop processing work
-        while self.__last_exception is None:
-            work = self.__queue.get()   # wait on the next task
-            try:
-                work["func"](comm, *work["args"])
-            except Exception as e:
-                self.__last_exception = (str(e), traceback.format_exc())
-            finally:
-                self.__queue.task_done()
+        t = threading.Thread(target=Stage.__worker_main, args=(self, context))
+        t.daemon = True
+        t.start()
+        with self.__condition:
+            self.__workers.append(t)
+
+    def fail(self, message, trace):
+        """Records the first error and cancels every task that hasn't started."""
+
+        with self.__condition:
+            first = self.error is None
+            if first:
+                self.error = (message, trace)
+            while self.__tasks:
+                self.__tasks.popleft()[0].cancel()
+            self.__condition.notify_all()
+
+        if first and self.__failed is not None:
+            self.__failed(message, trace)
+
+    def __exit(self):
+        """Accounts for the exit of the calling thread. The condition must be held."""
+
+        self.__threads -= 1
+        self.__thread_time += time.time() - self.__started.pop(threading.current_thread())
+
+    def __take(self):
+        """Waits for tasks and takes a batch of them, or returns None if the thread should stop."""
+
+        with self.__condition:
+            while not self.__tasks and self.error is None and not self.__closed:
+                self.__condition.wait()
+
+            if self.error is not None or not self.__tasks:
+                self.__idle -= 1
+                self.__exit()
+                return None
+
+            # leave tasks for the other threads when the queue is short
+            count = max(1, min(BATCH_SIZE, len(self.__tasks) // max(self.__threads, 1)))
+            batch = [self.__tasks.popleft() for _ in range(min(count, len(self.__tasks)))]
+
+            self.__idle -= 1
+            self.__running += len(batch)
+            self.__condition.notify_all()   # there is room for more tasks
+            return batch
+
+    def __worker_main(self, context):
+        """
+        The entry point for worker threads. Takes batches of tasks as they become available.
+
+        Args:
+            context: the object passed to every task run by this thread
+        """
+
+        with self.__condition:
+            self.__started[threading.current_thread()] = time.time()
+
+        while True:
+            batch = self.__take()
+            if batch is None:
+                return
+
+            busy = 0.0
+            for future, function, args in batch:
+                if self.error is not None:
+                    future.cancel()
+                    continue
+
+                start = time.time()
+                try:
+                    future.set_result(function(context, *args))
+                except Exception as e:
+                    # fail first, so that waiters on the future see the stage failed
+                    self.fail(str(e), traceback.format_exc())
+                    future.set_exception(e)
+                latency = time.time() - start
+                busy += latency
+                self.__concurrency.record(latency, bool(self.__tasks))
+
+            with self.__condition:
+                self.__running -= len(batch)
+                self.__tasks_done += len(batch)
+                self.__busy += busy
+                self.__condition.notify_all()
+
+                # leave if the limit was lowered, but never the last thread
+                if self.__threads > self.__concurrency.limit:
+                    self.__contexts.append(context)
+                    self.__exit()
+                    return
+                self.__idle += 1
+
+    def submit(self, function, *args):
+        """
+        Runs function(context, *args) on one of the stage's threads, blocking while the queue is
+        full. Raises Cancelled if a task has failed.
+
+        Returns:
+            a Future for the result of the function
+        """
+
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError("%s stage is closed" % (self.name))
+
+        self.__start_worker()
+
+        future = Future()
+        with self.__condition:
+            if len(self.__tasks) >= self.__capacity:
+                start = time.time()
+                while len(self.__tasks) >= self.__capacity and self.error is None:
+                    self.__condition.wait()
+                self.__blocked += time.time() - start
+
+            if self.error is not None:
+                raise Cancelled("%s stage failed: %s" % (self.name, self.error[0]))
+
+            self.__tasks.append((future, function, args))
+            self.__condition.notify()
+
+        return future
+
+    def join(self):
+        """Blocks until every submitted task has completed. Raises Cancelled if a task has failed."""
+
+        with self.__condition:
+            while (self.__tasks or self.__running) and self.error is None:
+                self.__condition.wait()
+
+            if self.error is not None:
+                raise Cancelled("%s stage failed: %s" % (self.name, self.error[0]))
+
+    def close(self):
+        """
+        Tells the stage's threads to exit once no tasks are left, and waits for them to, so that no
+        thread is left waiting for work when the interpreter shuts down. No more tasks may be
+        submitted afterwards.
+        """
+
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+            threads = list(self.__workers)
+
+        for t in threads:
+            t.join()
+
+    def stats(self):
+        """
+        Returns a dict describing the work done by the stage so far: the number of tasks, the peak
+        number of threads, the fraction of the threads' lifetimes spent running tasks (utilization)
+        and the seconds submitters spent blocked on a full queue.
+        """
+
+        with self.__condition:
+            now = time.time()
+            thread_time = self.__thread_time + sum(now - start for start in self.__started.itervalues())
+            return {
+                'tasks': self.__tasks_done,
+                'threads': self.__peak,
+                'utilization': self.__busy / thread_time if thread_time else 0.0,
+                'blocked': self.__blocked,
+                'elapsed': now - self.__created
+            }
+
+class AsyncCommunicator:
+    """
+    Wrapper around the Communicator classes provided by adapters that distributes work across multiple threads.
+
+    Work is split between two stages (see Stage). The network stage runs everything that talks to
+    the remote, with as many threads as the remote handles well: the Concurrency adapts to its
+    latency and throughput, up to the adapter's "max_threads" (or THREAD_COUNT). Once an object has
+    been downloaded, the disk stage places it in the workspace, with threads sized for local storage
+    (DISK_THREADS). The disk stage's queue is short, so downloads pause while the disk falls behind.
+
+    If the adapter module sets "batch_size", declaring that its Communicator pipelines or combines
+    the requests of get_many and put_many, gets and puts are collected into batches of that many
+    objects, each transferred by a single network task. Other adapters transfer one object per
+    task, so that objects are transferred in parallel across the network threads.
+    """
+
+    def __init__(self, root, cache_path, config, force):
+        # load the module here since importing isn't thread-safe
+        self.__comm_module = load_comm_module(config)
+
+        self.__root = root
+        self.__cache_path = cache_path
+        self.__config = config
+        self.__force = force
+        self.__inventory = inventory.load(cache_path, config)
+
+        maximum = config.get('threads', getattr(self.__comm_module, 'max_threads', THREAD_COUNT))
+        self.__network = Stage('network', Concurrency(maximum), MAX_PENDING, self.__communicator, self.__fail)
+
+        # placing objects never uses the adapter, so every disk thread shares one communicator
+        local = remote.CachedCommunicator(root, cache_path, force, None,
+                                          config.get('hash', hashing.DEFAULT_ALGORITHM),
+                                          config.get('materialize', fastcopy.DEFAULT_MODES))
+        disk_threads = config.get('disk_threads', DISK_THREADS)
+        self.__disk = Stage('disk', Concurrency(disk_threads, disk_threads), MAX_DISK_PENDING, lambda: local, self.__fail)
+
+        communicator = self.__comm_module.Communicator
+        self.__batch_size = getattr(self.__comm_module, 'batch_size', None)
+        self.__gets = [] if self.__batch_size and hasattr(communicator, 'get_many') else None
+        self.__puts = [] if self.__batch_size and hasattr(communicator, 'put_many') else None
+
+    def __communicator(self):
+        """Creates a communicator for a network thread."""
+
+        config = copy.deepcopy(self.__config)
+        return remote.CachedCommunicator(self.__root, self.__cache_path, self.__force, self.__comm_module.Communicator(config),
+                                         config.get('hash', hashing.DEFAULT_ALGORITHM),
+                                         config.get('materialize', fastcopy.DEFAULT_MODES),
+                                         self.__inventory)
+
+    def __fail(self, message, trace):
+        """Cancels the work of both stages once either fails."""
+
+        for stage in (self.__network, self.__disk):
+            stage.fail(message, trace)
 
     def __check_error(self):
-        if self.__last_exception is not None:
-            log.error(*self.__last_exception)
+        for stage in (self.__network, self.__disk):
+            if stage.error is not None:
+                log.error(*stage.error)
 
-    def __add_task(self, task):
-        full = True
-        while full:
-            try:
-                self.__check_error()
-                self.__queue.put(item=task, timeout=0.5)
-                full = False
-            except Queue.Full as e:
-                pass
+    def submit(self, function, *args):
+        """
+        Runs function(comm, *args) on a network thread, where comm is the thread's CachedCommunicator.
+        Blocks while MAX_PENDING tasks are already waiting.
+
+        Returns:
+            a Future for the result of the function
+        """
 
         self.__check_error()
+        try:
+            return self.__network.submit(function, *args)
+        except Cancelled:
+            self.__check_error()
+            raise
+
+    def __download(self, comm, hash, dest):
+        """Downloads an object on a network thread, then hands it to the disk stage."""
+
+        if comm.outdated(hash, dest):
+            return self.__disk.submit(remote.CachedCommunicator.place, comm.fetch(hash), hash, dest)
+
+    def __download_many(self, comm, items):
+        """Downloads a batch of (hash, dest) tuples on a network thread, then hands them to the disk stage."""
+
+        outdated = [(hash, dest) for hash, dest in items if comm.outdated(hash, dest)]
+        paths = comm.fetch_many([hash for hash, dest in outdated])
+
+        placed = {}
+        for (hash, dest), cached in zip(outdated, paths):
+            placed[hash, dest] = self.__disk.submit(remote.CachedCommunicator.place, cached, hash, dest)
+        return [placed.get(item) for item in items]
+
+    def __upload_many(self, comm, items):
+        """Uploads a batch of (source, hash) tuples on a network thread."""
+
+        comm.put_many(items)
+        return [None] * len(items)
+
+    def __run_batch(self, comm, function, batch):
+        """Runs function(comm, items) for a batch of queued transfers, completing each transfer's future."""
+
+        try:
+            results = function(comm, [args for future, args in batch])
+        except Exception as e:
+            for future, args in batch:
+                future.set_exception(e)
+            raise
+
+        for (future, args), result in zip(batch, results):
+            future.set_result(result)
+
+    def __batch(self, pending, function, *args):
+        """Queues a transfer to run with others in a batch, submitting the batch once it is full."""
+
+        future = Future()
+        pending.append((future, args))
+        if len(pending) >= self.__batch_size:
+            self.__flush(pending, function)
+        return future
+
+    def __flush(self, pending, function):
+        """Submits the queued transfers as a batch."""
+
+        if pending:
+            batch = pending[:]
+            del pending[:]
+            self.submit(self.__run_batch, function, batch)
 
     def get(self, hash, dest):
-        self.__add_task( { "func": remote.CachedCommunicator.get, "args": (hash, dest) } )
+        if self.__gets is not None:
+            return self.__batch(self.__gets, self.__download_many, hash, dest)
+        return self.submit(self.__download, hash, dest)
 
     def put(self, source, hash):
-        self.__add_task( { "func": remote.CachedCommunicator.put, "args": (source, hash) } )
+        if self.__puts is not None:
+            return self.__batch(self.__puts, self.__upload_many, source, hash)
+        return self.submit(remote.CachedCommunicator.put, source, hash)
+
+    def migrate(self, hash, path, migrated):
+        return self.submit(remote.CachedCommunicator.migrate, hash, path, migrated)
+
+    def stats(self):
+        """Returns the stats (see Stage.stats) of the network and disk stages, by name."""
+
+        return dict((stage.name, stage.stats()) for stage in (self.__network, self.__disk))
 
     def join(self):
         """
-        Blocks until all asynchronous get and put operations have finished.
+        Blocks until all asynchronous get and put operations have finished, then stops the worker
+        threads. Nothing may be submitted afterwards.
         """
 
+        try:
+            self.__check_error()
+            log.info("waiting for work to complete")
+            try:
+                if self.__gets is not None:
+                    self.__flush(self.__gets, self.__download_many)
+                if self.__puts is not None:
+                    self.__flush(self.__puts, self.__upload_many)
+
+                # downloads add work to the disk stage, so the network stage has to finish first
+                self.__network.join()
+                self.__disk.join()
+            except Cancelled:
+                pass
+        finally:
+            # stop the threads even when exiting with an error; network threads hand work to the
+            # disk stage, so they stop first
+            for stage in (self.__network, self.__disk):
+                stage.close()
         self.__check_error()
-        log.info("waiting for work to complete")
-        self.__queue.join()
-        self.__check_error()
 
-        with remote.snapshot_lock:
-            if remote.snapshot is not None:
-                remote.snapshot.write()
+        for stage in (self.__network, self.__disk):
+            stats = stage.stats()
+            if stats['tasks']:
+                log.info("%s stage: %d tasks, %d threads, %.0f%% utilization, %.2fs blocked on a full queue" % (
+                         stage.name, stats['tasks'], stats['threads'], stats['utilization'] * 100, stats['blocked']))
+
+        # adapters may report their own stats, like the hits and misses of a connection pool
+        if hasattr(self.__comm_module, 'stats'):
+            log.info("%s adapter: %s" % (self.__config['type'], ', '.join('%s %s' % (value, name) for name, value in sorted(self.__comm_module.stats().iteritems()))))
+
+        # all workers are idle, so their changes to the snapshot can be merged
+        if remote.snapshot is not None:
+            remote.snapshot.write()
+        self.__inventory.write()
@@ -1,6 +1,33 @@
 from test_add import BasicAddTest
 from test_add import PurgeTest
+from test_add import InventoryTest
 from test_resolve import BasicResolveTest
 from test_resolve import SubDirResolveTest
+from test_resolve import HardlinkResolveTest
+from test_resolve import SymlinkResolveTest
+from test_resolve import FallbackResolveTest
+from test_resolve import IndexResolveTest
+from test_migrate import MigrateTest
+from test_migrate import LocalMigrateTest
+from test_cache import GCTest
+from test_cache import EvictTest
+from test_cache import EvictAgeTest
+from test_cache import LayoutTest
+from test_cache import SharedCacheTest
 from test_snapshot import SnapshotTest
-from test_unit import TestHash
\ No newline at end of file
+from test_snapshot import HashCacheTest
+from test_s3 import S3Test
+from test_unit import TestHash
+from test_unit import TestAlgorithms
+from test_unit import TestSnapshot
+from test_unit import TestFileMapping
+from test_unit import TestManifestIndex
+from test_unit import TestManifestWriter
+from test_unit import TestConcurrency
+from test_unit import TestAsyncCommunicator
+from test_unit import TestStage
+from test_unit import TestSingleFlight
+from test_unit import TestFastCopy
+from test_unit import TestObjectCache
+from test_unit import TestBatchedCommunicator
+from test_unit import TestInventory
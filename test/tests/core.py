@@ -115,13 +115,34 @@ class ExileTest(unittest.TestCase):
         self.assertFile(fullpath, relative)
         self.assertEqual(hash(fullpath), os.path.basename(fullpath))
 
+    def cachePath(self, object):
+        """Returns the path of an object in the cache, relative to the exile directory"""
+        return os.path.join('.exile.cache', object[:2], object)
+
+    def ageCache(self, seconds):
+        """Makes every object in the cache look inserted and last used the given number of seconds earlier."""
+        cache = os.path.join(self._dir, '.exile.cache')
+        for dir in os.listdir(cache):
+            if os.path.isdir(os.path.join(cache, dir)):
+                for name in os.listdir(os.path.join(cache, dir)):
+                    path = os.path.join(cache, dir, name)
+                    st = os.stat(path)
+                    os.utime(path, (st.st_atime - seconds, st.st_mtime - seconds))
+
     def assertInCache(self, object):
-        path = os.path.join('.exile.cache', object)
+        path = self.cachePath(object)
         fullpath = os.path.join(self._dir, path)
         self.assertObject(fullpath, path)
 
+    def repoObjects(self):
+        """Returns the names of all objects in the repository"""
+        objects = []
+        for root, dirs, files in os.walk(self._repo):
+            objects += files
+        return objects
+
     def assertInRepo(self, object):
-        self.assertObject(os.path.join(self._repo, object), object)
+        self.assertObject(os.path.join(self._repo, object[:2], object), object)
 
     def assertContents(self, path, contents):
         fullpath = os.path.join(self._dir, path)
@@ -139,9 +160,19 @@ class ExileTest(unittest.TestCase):
     def exile_resolve(self, *args):
         self.__exile('resolve', *args)
 
+    def exile_migrate(self, *args):
+        self.__exile('migrate', *args)
+
+    def exile_cache(self, *args):
+        self.__exile('cache', *args)
+
     def clearRepo(self):
         for file in os.listdir(self._repo):
-            os.remove(os.path.join(self._repo, file))
+            full = os.path.join(self._repo, file)
+            if os.path.isfile(full):
+                os.remove(full)
+            elif os.path.isdir(full):
+                shutil.rmtree(full)
 
     def clearWorkspace(self):
         for file in os.listdir(self._dir):
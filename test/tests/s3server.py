@@ -0,0 +1,181 @@
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import re
+import threading
+import urlparse
+import uuid
+
+from xml.sax.saxutils import escape
+
+class S3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for S3, serving a single bucket from memory with path-style requests. It
+    supports just what the s3 adapter uses: listing (with a prefix, marker and page size), HEAD,
+    GET (with ranges), PUT and multipart uploads. Every request is counted in requests, by a name like "GET range" or "PUT part", and
+    every connection accepted is counted as "connect".
+    """
+
+    daemon_threads = True
+
+    def __init__(self, bucket):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), S3Handler)
+        self.bucket = bucket
+        self.objects = {}
+        self.uploads = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def process_request(self, request, client_address):
+        self.count('connect')
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+class S3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        """Returns the key (None for the bucket itself) and the query parameters of the request."""
+        url = urlparse.urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        if parts[0] != self.server.bucket:
+            return False, None, {}
+        key = parts[1] if len(parts) > 1 and parts[1] else None
+        return True, key, dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def respond(self, status, body='', headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        self.respond(status, '<?xml version="1.0" encoding="UTF-8"?><Error><Code>%s</Code><Message>%s</Message></Error>' % (code, code))
+
+    def object_headers(self, data):
+        return {
+            'ETag': '"%s"' % (hashlib.md5(data).hexdigest()),
+            'Last-Modified': 'Thu, 01 Jan 2015 00:00:00 GMT',
+            'Content-Type': 'application/octet-stream'
+        }
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        found, key, query = self.parse()
+        if not found:
+            return self.error(404, 'NoSuchBucket')
+
+        if key is None:
+            if self.command == 'HEAD':
+                self.server.count('HEAD bucket')
+                return self.respond(200)
+
+            self.server.count('LIST')
+            prefix = query.get('prefix', '')
+            marker = query.get('marker', '')
+            max_keys = int(query.get('max-keys', 1000))
+            listed = [(name, data) for name, data in sorted(self.server.objects.items()) if name.startswith(prefix) and name > marker]
+            contents = ''.join('<Contents><Key>%s</Key><LastModified>2015-01-01T00:00:00.000Z</LastModified><ETag>"%s"</ETag><Size>%d</Size></Contents>' % (
+                               escape(name), hashlib.md5(data).hexdigest(), len(data))
+                               for name, data in listed[:max_keys])
+            return self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker><MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>%s</ListBucketResult>' % (
+                                self.server.bucket, escape(prefix), escape(marker), max_keys, 'true' if len(listed) > max_keys else 'false', contents))
+
+        if 'uploadId' in query:
+            self.server.count('LIST parts')
+            parts = self.server.uploads.get(query['uploadId'])
+            if parts is None:
+                return self.error(404, 'NoSuchUpload')
+            listing = ''.join('<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag><Size>%d</Size></Part>' % (number, hashlib.md5(data).hexdigest(), len(data))
+                              for number, data in sorted(parts.items()))
+            return self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><ListPartsResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId><IsTruncated>false</IsTruncated>%s</ListPartsResult>' % (
+                                self.server.bucket, escape(key), query['uploadId'], listing))
+
+        data = self.server.objects.get(key)
+        if data is None:
+            self.server.count(self.command)
+            return self.error(404, 'NoSuchKey')
+
+        headers = self.object_headers(data)
+        headers['Accept-Ranges'] = 'bytes'
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match is None or self.command == 'HEAD':
+            self.server.count(self.command)
+            return self.respond(200, data, headers)
+
+        self.server.count('GET range')
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        if start >= len(data):
+            return self.error(416, 'InvalidRange')
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+        self.respond(206, data[start:end + 1], headers)
+
+    def do_PUT(self):
+        found, key, query = self.parse()
+        data = self.body()
+        if not found or key is None:
+            return self.error(404, 'NoSuchBucket')
+
+        if 'uploadId' in query:
+            self.server.count('PUT part')
+            parts = self.server.uploads.get(query['uploadId'])
+            if parts is None:
+                return self.error(404, 'NoSuchUpload')
+            parts[int(query['partNumber'])] = data
+        else:
+            self.server.count('PUT')
+            self.server.objects[key] = data
+
+        self.respond(200, '', { 'ETag': '"%s"' % (hashlib.md5(data).hexdigest()) })
+
+    def do_POST(self):
+        found, key, query = self.parse()
+        body = self.body()
+        if not found or key is None:
+            return self.error(404, 'NoSuchBucket')
+
+        if 'uploads' in query:
+            self.server.count('POST initiate')
+            id = uuid.uuid4().hex
+            self.server.uploads[id] = {}
+            return self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId></InitiateMultipartUploadResult>' % (
+                                self.server.bucket, escape(key), id))
+
+        self.server.count('POST complete')
+        parts = self.server.uploads.pop(query.get('uploadId'), None)
+        if parts is None:
+            return self.error(404, 'NoSuchUpload')
+
+        numbers = [int(number) for number in re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+        self.server.objects[key] = ''.join(parts[number] for number in numbers)
+        self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult><Location>/%s/%s</Location><Bucket>%s</Bucket><Key>%s</Key><ETag>"%s-%d"</ETag></CompleteMultipartUploadResult>' % (
+                     self.server.bucket, escape(key), self.server.bucket, escape(key), uuid.uuid4().hex, len(numbers)))
+
+    def do_DELETE(self):
+        found, key, query = self.parse()
+        self.server.count('DELETE')
+        if 'uploadId' in query:
+            self.server.uploads.pop(query['uploadId'], None)
+        elif found and key is not None:
+            self.server.objects.pop(key, None)
+        self.respond(204)
@@ -64,7 +64,7 @@ class PurgeTest(AddTest):
         self.exile_add('-p', 'dir')
 
         # we only removed files, so nothing should have been pushed to the repo
-        self.assertTrue(len(os.listdir(self._repo)) == 0)
+        self.assertTrue(len(self.repoObjects()) == 0)
 
     def test_purge(self):
         expected = copy.deepcopy(self._files)
@@ -92,4 +92,25 @@ class PurgeTest(AddTest):
 
         self.assertUpdated(expected)
         for path in removed:
-            self.assertTrue(not os.path.exists(path))
\ No newline at end of file
+            self.assertTrue(not os.path.exists(path))
+
+class InventoryTest(AddTest):
+    def setUp(self):
+        self._files = {
+            'a': 'a',
+            'copy': 'a'
+        }
+        super(InventoryTest, self).setUp()
+
+        self.exile_add('a')
+
+    def test_skip(self):
+        # the remote is known to have the object, so adding a copy doesn't upload it again
+        shutil.rmtree(self._repo)
+        os.mkdir(self._repo)
+        self.exile_add('copy')
+        self.assertEqual(self.repoObjects(), [])
+
+        # unless forced
+        self.exile_add('-f', 'copy')
+        self.assertAdded('a')
@@ -0,0 +1,176 @@
+from core import *
+
+import copy
+import hashlib
+import json
+import os
+import time
+
+class GCTest(ExileTest):
+    def setUp(self):
+        self._files = {
+            'a': 'a',
+            'b': 'b'
+        }
+        super(GCTest, self).setUp()
+
+        self.exile_add('a', 'b')
+        shutil.copy('exile.manifest', 'old.manifest')
+
+        create_file(self._dir, 'b', 'modified')
+        self.exile_add('b')
+
+        # objects used recently may be in use by another process, so they are never collected
+        self.ageCache(3600)
+
+    def test_gc(self):
+        self.exile_cache('gc')
+        self.assertInCache(hashlib.sha1('a').hexdigest())
+        self.assertInCache(hashlib.sha1('modified').hexdigest())
+        self.assertFalse(os.path.exists(self.cachePath(hashlib.sha1('b').hexdigest())))
+
+    def test_manifests(self):
+        self.exile_cache('gc', 'exile.manifest', 'old.manifest')
+        for contents in ['a', 'b', 'modified']:
+            self.assertInCache(hashlib.sha1(contents).hexdigest())
+
+    def test_in_use(self):
+        # a claimed object is being downloaded by another process, and a recently used one may be
+        # about to be placed
+        object = hashlib.sha1('b').hexdigest()
+        open(os.path.join('.exile.cache', '.claim-' + object), 'w').close()
+        os.utime(self.cachePath(hashlib.sha1('modified').hexdigest()), None)
+        self.exile_cache('gc')
+        self.assertTrue(os.path.exists(self.cachePath(object)))     # without reading it, which may update its atime
+        self.assertInCache(hashlib.sha1('modified').hexdigest())
+
+        os.remove(os.path.join('.exile.cache', '.claim-' + object))
+        self.exile_cache('gc')
+        self.assertFalse(os.path.exists(self.cachePath(object)))
+
+class EvictTest(ExileTest):
+    _config = copy.deepcopy(ExileTest._config)
+    _config['remote']['cache_size'] = 10
+
+    def setUp(self):
+        self._files = {
+            'a': 'a' * 6,
+            'b': 'b' * 6
+        }
+        super(EvictTest, self).setUp()
+
+    def test_evict(self):
+        self.exile_add('a')
+        self.ageCache(3600)
+        self.exile_add('b')
+
+        # only the most recently used object fits within the limit
+        self.assertInCache(hashlib.sha1('b' * 6).hexdigest())
+        self.assertFalse(os.path.exists(self.cachePath(hashlib.sha1('a' * 6).hexdigest())))
+
+        # resolving refetches the evicted object, which in turn evicts the other one
+        self.ageCache(3600)
+        os.remove('a')
+        self.exile_resolve('a')
+        self.assertResolved('a', 'a' * 6)
+        self.assertFalse(os.path.exists(self.cachePath(hashlib.sha1('b' * 6).hexdigest())))
+
+    def test_in_use(self):
+        # objects used recently may be in use by another process, even if the cache is over its limit
+        self.exile_add('a')
+        self.exile_add('b')
+        self.assertInCache(hashlib.sha1('a' * 6).hexdigest())
+        self.assertInCache(hashlib.sha1('b' * 6).hexdigest())
+
+class EvictAgeTest(ExileTest):
+    _config = copy.deepcopy(ExileTest._config)
+    _config['remote']['cache_age'] = 1
+
+    def setUp(self):
+        self._files = {
+            'a': 'a',
+            'b': 'b'
+        }
+        super(EvictAgeTest, self).setUp()
+
+    def test_evict(self):
+        self.exile_add('a')
+
+        # make the object look unused for two days
+        path = self.cachePath(hashlib.sha1('a').hexdigest())
+        old = time.time() - 2 * 24 * 60 * 60
+        os.utime(path, (old, old))
+
+        self.exile_add('b')
+        self.assertInCache(hashlib.sha1('b').hexdigest())
+        self.assertFalse(os.path.exists(path))
+
+class LayoutTest(ExileTest):
+    def setUp(self):
+        self._files = {
+            'a': 'a'
+        }
+        super(LayoutTest, self).setUp()
+
+        self.exile_add('a')
+
+    def test_migrate(self):
+        # put the cache back into the older flat layout
+        object = hashlib.sha1('a').hexdigest()
+        shutil.rmtree('.exile.cache')
+        os.mkdir('.exile.cache')
+        shutil.copy('a', os.path.join('.exile.cache', object))
+
+        # the cached copy should be found after migration, even with an empty repository
+        self.clearRepo()
+        os.remove('a')
+        self.exile_resolve('a')
+        self.assertResolved('a', 'a')
+        self.assertFalse(os.path.exists(os.path.join('.exile.cache', object)))
+
+class SharedCacheTest(ExileTest):
+    def setUp(self):
+        # many files sharing a few objects, some large enough to take a while to copy
+        self._files = {}
+        for i in range(40):
+            self._files[os.path.join('d%d' % (i % 4), 'f%d' % (i))] = str(i % 8) * (1 + (i % 8) * 64 * 1024)
+        super(SharedCacheTest, self).setUp()
+
+        self.exile_add('d0', 'd1', 'd2', 'd3')
+
+        self._cache = tempfile.mkdtemp()
+        self._checkouts = []
+
+    def tearDown(self):
+        super(SharedCacheTest, self).tearDown()
+        shutil.rmtree(self._cache)
+        for checkout in self._checkouts:
+            shutil.rmtree(checkout)
+
+    def checkout(self):
+        """Creates a checkout of the manifest that uses the shared cache."""
+        with open(os.path.join(self._dir, 'exile.manifest')) as file:
+            config = json.load(file)
+        config['remote']['cache'] = self._cache
+
+        checkout = tempfile.mkdtemp()
+        with open(os.path.join(checkout, 'exile.manifest'), 'w') as file:
+            json.dump(config, file, indent=4, sort_keys=True)
+        self._checkouts.append(checkout)
+        return checkout
+
+    def test_concurrent_resolve(self):
+        checkouts = [self.checkout() for _ in range(8)]
+        processes = [subprocess.Popen(['python', EXILE, '-v0', 'resolve', '.'], cwd=checkout) for checkout in checkouts]
+        self.assertEqual([p.wait() for p in processes], [0] * len(processes))
+
+        for checkout in checkouts:
+            for path, contents in self._files.iteritems():
+                with open(os.path.join(checkout, path), 'rb') as file:
+                    self.assertTrue(file.read() == contents, "wrong contents: " + path)
+
+        # every object was inserted whole, and nothing was left behind
+        for contents in set(self._files.itervalues()):
+            object = hashlib.sha1(contents).hexdigest()
+            self.assertObject(os.path.join(self._cache, object[:2], object), object)
+        self.assertEqual([name for name in os.listdir(self._cache) if name.startswith(('.tmp-', '.claim-'))], [])
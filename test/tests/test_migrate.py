@@ -0,0 +1,81 @@
+from core import *
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+LOCAL_ADAPTER = os.path.realpath('../adapters/local.py')
+
+class MigrateTest(ExileTest):
+    def setUp(self):
+        self._files = {
+            'a': 'same',
+            os.path.join('dir', 'b'): 'same',
+            os.path.join('dir', 'c'): 'different'
+        }
+        super(MigrateTest, self).setUp()
+
+        # build a version 1 manifest by hand, with objects named by a hash of their path and contents
+        files = {}
+        for path, contents in self._files.iteritems():
+            legacy = hashlib.sha1(path + contents).hexdigest()
+            # older versions of the local adapter also stored objects in a single directory
+            shutil.copy(path, os.path.join(self._repo, legacy))
+
+            value = files
+            parts = path.split(os.sep)
+            for part in parts[:-1]:
+                value = value.setdefault(part, {})
+            value[parts[-1]] = legacy
+
+        self.writeManifest(dict(self._config, files=files))
+
+        self.clearWorkspace()
+
+    def writeManifest(self, config):
+        with open('exile.manifest', 'w') as file:
+            json.dump(config, file, indent=4, sort_keys=True)
+
+    def readManifest(self):
+        with open('exile.manifest', 'r') as file:
+            return json.load(file)
+
+    def test_migrate(self):
+        self.exile_migrate()
+
+        manifest = self.readManifest()
+        self.assertEqual(manifest['version'], 2)
+        self.assertEqual(manifest['files']['a'], manifest['files']['dir']['b'])
+
+        for path, contents in self._files.iteritems():
+            self.assertInRepo(hashlib.sha1(contents).hexdigest())
+
+        self.exile_resolve('a', 'dir')
+        for path, contents in self._files.iteritems():
+            self.assertResolved(path, contents)
+
+    def test_partial(self):
+        self.exile_migrate('dir')
+
+        manifest = self.readManifest()
+        self.assertNotIn('version', manifest)
+        self.assertEqual(manifest['files']['dir']['c'], hashlib.sha1('different').hexdigest())
+        self.assertEqual(manifest['files']['a'], hashlib.sha1('asame').hexdigest())
+
+class LocalMigrateTest(ExileTest):
+    def setUp(self):
+        super(LocalMigrateTest, self).setUp()
+
+        # create a repository in the older flat layout
+        for path, contents in self._files.iteritems():
+            shutil.copy(path, os.path.join(self._repo, hashlib.sha1(contents).hexdigest()))
+
+    def test_migrate(self):
+        subprocess.call(['python', LOCAL_ADAPTER, self._repo], stdout=open(os.devnull, 'w'))
+
+        for path, contents in self._files.iteritems():
+            self.assertInRepo(hashlib.sha1(contents).hexdigest())
+        self.assertEqual(len(self.repoObjects()), len(set(self._files.values())))
+        self.assertEqual([name for name in os.listdir(self._repo) if len(name) != 2], [])
@@ -1,8 +1,11 @@
 from core import *
 
+import copy
 import hashlib
+import json
 import os
 import shutil
+import stat
 
 class ResolveTest(ExileTest):
     def setUp(self):
@@ -37,4 +40,98 @@ class SubDirResolveTest(ResolveTest):
         os.chdir('dir')
         self.exile_resolve('a', 'b')
         for path, contents in self._files.iteritems():
-            self.assertResolved(path, contents)
\ No newline at end of file
+            self.assertResolved(path, contents)
+
+class HardlinkResolveTest(ResolveTest):
+    _config = copy.deepcopy(ExileTest._config)
+    _config['remote']['materialize'] = ['hardlink']
+
+    def test_resolve(self):
+        path, contents = self._files.items()[0]
+        self.exile_resolve(path)
+        self.assertResolved(path, contents)
+
+        cached = self.cachePath(hashlib.sha1(contents).hexdigest())
+        self.assertEqual(os.stat(path).st_ino, os.stat(cached).st_ino)
+
+        # the shared object must not be writable through the workspace
+        self.assertFalse(os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+class SymlinkResolveTest(ResolveTest):
+    _config = copy.deepcopy(ExileTest._config)
+    _config['remote']['materialize'] = ['symlink']
+
+    def test_resolve(self):
+        path, contents = self._files.items()[0]
+        self.exile_resolve(path)
+        self.assertResolved(path, contents)
+        self.assertTrue(os.path.islink(path))
+
+    def test_again(self):
+        self.exile_resolve(*self._files.keys())
+        before = dict((path, os.lstat(path).st_ino) for path in self._files)
+
+        # the links are tracked at their own paths, so resolving again leaves them alone
+        self.exile_resolve(*self._files.keys())
+        for path, contents in self._files.iteritems():
+            self.assertResolved(path, contents)
+            self.assertEqual(before[path], os.lstat(path).st_ino)
+
+    def test_update(self):
+        self.exile_resolve('a')
+
+        # point the manifest at another object, which must replace the existing link
+        with open('exile.manifest', 'r') as file:
+            manifest = json.load(file)
+        manifest['files']['a'] = manifest['files']['b']
+        with open('exile.manifest', 'w') as file:
+            json.dump(manifest, file)
+
+        self.exile_resolve('a')
+        self.assertResolved('a', self._files['b'])
+
+    def test_replaced(self):
+        path, contents = self._files.items()[0]
+        self.exile_resolve(path)
+
+        # replacing the link with a regular file is detected as a modification
+        os.remove(path)
+        create_file(self._dir, path, 'modified')
+        self.exile_resolve(path)
+        self.assertResolved(path, contents)
+        self.assertTrue(os.path.islink(path))
+
+class FallbackResolveTest(ResolveTest):
+    _config = copy.deepcopy(ExileTest._config)
+    _config['remote']['materialize'] = ['reflink', 'copy']
+
+    def test_resolve(self):
+        # reflinks usually aren't supported by the filesystem running the tests, so this
+        # exercises the fallback to a copy, which must be writable
+        for path, contents in self._files.iteritems():
+            self.exile_resolve(path)
+            self.assertResolved(path, contents)
+            self.assertFalse(os.path.islink(path))
+            self.assertTrue(os.stat(path).st_mode & stat.S_IWUSR)
+
+class IndexResolveTest(ResolveTest):
+    def test_resolve(self):
+        # resolving builds the index, and later resolves read it
+        self.exile_resolve('a')
+        self.assertTrue(os.path.isfile('.exile.index'))
+        self.exile_resolve(*self._files.keys())
+        for path, contents in self._files.iteritems():
+            self.assertResolved(path, contents)
+
+    def test_manifest_changed(self):
+        self.exile_resolve('a')
+
+        # point "a" at the object for "b", keeping the manifest the same size
+        with open('exile.manifest', 'r') as file:
+            manifest = json.load(file)
+        manifest['files']['a'] = manifest['files']['b']
+        with open('exile.manifest', 'w') as file:
+            json.dump(manifest, file, indent=4, sort_keys=True)
+
+        self.exile_resolve('a')
+        self.assertResolved('a', 'B')
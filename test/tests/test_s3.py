@@ -0,0 +1,118 @@
+from core import *
+
+import copy
+import hashlib
+import unittest
+
+from s3server import S3Server
+
+try:
+    import boto
+except ImportError:
+    boto = None     # the s3 adapter can't be used
+
+@unittest.skipIf(boto is None, "boto is not installed")
+class S3Test(ExileTest):
+    _config = copy.deepcopy(ExileTest._config)
+    _config['remote'] = {
+        'type': 's3',
+        'cache': '.exile.cache',
+        'id': 'id',
+        'secret': 'secret',
+        'bucket': 'exile',
+        'secure': False,
+        'host': '127.0.0.1',
+        'multipart_threshold': 1024,
+        'part_size': 1024,
+        'part_threads': 4,
+        'connections': 2
+    }
+
+    def setUp(self):
+        self._files = {
+            'large': ''.join(hashlib.sha1(str(i)).hexdigest() for i in range(256)) * 620,     # 6.2 MB
+            'small': 'small',
+            'empty': ''
+        }
+
+        self._server = S3Server('exile')
+        self._server.start()
+        self._config['remote']['port'] = self._server.server_address[1]
+        super(S3Test, self).setUp()
+
+    def tearDown(self):
+        super(S3Test, self).tearDown()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def requests(self, name):
+        return self._server.requests.get(name, 0)
+
+    def resolveAgain(self, path):
+        """Resolves a file again from the remote."""
+        os.remove(path)
+        shutil.rmtree('.exile.cache')
+        self._server.requests.clear()
+        self.exile_resolve(path)
+
+    def test_multipart(self):
+        contents = self._files['large']
+        self.exile_add('large')
+
+        # the configured part size is below the minimum S3 accepts, so the parts are 5 MB
+        self.assertEqual(self.requests('POST initiate'), 1)
+        self.assertEqual(self.requests('PUT part'), 2)
+        self.assertEqual(self.requests('POST complete'), 1)
+        self.assertEqual(self._server.objects[hashlib.sha1(contents).hexdigest()], contents)
+
+        # the first request covers the threshold, and the rest is downloaded in ranges of a part each
+        self.resolveAgain('large')
+        self.assertResolved('large', contents)
+        self.assertEqual(self.requests('GET range'), 3)
+
+    def test_single(self):
+        self.exile_add('small', 'empty')
+        self.assertEqual(self.requests('PUT'), 2)
+        self.assertEqual(self.requests('POST initiate'), 0)
+
+        # objects within the threshold are downloaded with a single request
+        self.resolveAgain('small')
+        self.assertResolved('small', 'small')
+        self.assertEqual(self.requests('GET range'), 1)
+
+        # an empty object can't be requested by range, so it is downloaded whole
+        self.resolveAgain('empty')
+        self.assertResolved('empty', '')
+        self.assertEqual(self.requests('GET'), 1)
+
+    def test_connections(self):
+        names = ['file%d' % (i) for i in range(20)]
+        for name in names:
+            create_file(self._dir, name, name)
+
+        # every transfer of the process (and every part) shares the pool of 2 connections, and the
+        # bucket is never looked up
+        self.exile_add('large', *names)
+        self.assertEqual(self.requests('PUT'), 20)
+        self.assertEqual(self.requests('PUT part'), 2)
+        self.assertLessEqual(self.requests('connect'), 2)
+        self.assertEqual(self.requests('HEAD bucket'), 0)
+
+        os.remove('large')
+        shutil.rmtree('.exile.cache')
+        self._server.requests.clear()
+        self.exile_resolve('large')
+        self.assertResolved('large', self._files['large'])
+        self.assertLessEqual(self.requests('connect'), 2)
+
+    def test_exists(self):
+        self.exile_add('large')
+
+        # with the inventory gone, the object is found by listing the bucket rather than a HEAD request
+        shutil.rmtree('.exile.cache')
+        create_file(self._dir, 'copy', self._files['large'])
+        self._server.requests.clear()
+        self.exile_add('copy')
+        self.assertEqual(self.requests('LIST'), 1)
+        self.assertEqual(self.requests('HEAD'), 0)
+        self.assertEqual(self.requests('POST initiate'), 0)
@@ -3,34 +3,36 @@ from core import *
 import hashlib
 import json
 import os
+import subprocess
 import time
 
 # relative to repo root
 SNAPSHOT_PATH = '.exile.snapshot'
 
 class SnapshotTest(ExileTest):
-    def assertSnapshot(self, files):
+    def readSnapshot(self):
+        """Replays the snapshot log into a mapping from relative path to entry"""
+        snapshot = {}
         with open(SNAPSHOT_PATH, 'r') as file:
-            snapshot = json.load(file)
+            self.assertEqual(file.readline(), 'exile-snapshot 2\n')
+            for line in file:
+                record = json.loads(line)
+                snapshot[record[0]] = record[1:]
+        return snapshot
 
-        for path, contents in files.iteritems():
-            # split the path into components
-            components = []
-            head, tail = os.path.split(path)
-            while tail:
-                components = [tail] + components
-                head, tail = os.path.split(head)
+    def assertSnapshot(self, files):
+        snapshot = self.readSnapshot()
 
+        for path, contents in files.iteritems():
             # make sure the snapshot has the right hash
-            value = snapshot
-            for component in components:
-                value = value[component]
+            value = snapshot[path]
             self.assertEqual(value[0], hashlib.sha1(contents).hexdigest())
 
-            # make sure the snapshot's mtime is not less than the file's
+            # make sure the snapshot records the file's mtime, in nanoseconds
             file_mtime = os.path.getmtime(path)
             snapshot_mtime = value[1]
-            self.assertLessEqual(file_mtime, snapshot_mtime)
+            self.assertTrue(isinstance(snapshot_mtime, (int, long)))
+            self.assertAlmostEqual(file_mtime, snapshot_mtime / 1e9, places=5)
 
     def setUp(self):
         self._files = {
@@ -113,4 +115,91 @@ class SnapshotTest(ExileTest):
         # resolve again, should overwrite the file
         self.exile_resolve(path)
         self.assertResolved(path, contents)
-        self.assertLess(before, os.path.getmtime(path))
\ No newline at end of file
+        self.assertLess(before, os.path.getmtime(path))
+
+    def test_outdated(self):
+        # only the missing file is handed to the workers
+        os.remove('a')
+        output = subprocess.check_output(['python', EXILE, 'resolve', '.'])
+        self.assertEqual(output.splitlines(), ['resolving: ' + os.path.join(os.getcwd(), 'a')])
+        self.assertResolved('a', 'a')
+
+        # nothing at all once everything is up to date
+        output = subprocess.check_output(['python', EXILE, 'resolve', '.'])
+        self.assertEqual(output, '')
+
+    def test_append(self):
+        with open(SNAPSHOT_PATH, 'r') as file:
+            before = file.read()
+
+        # resolving a changed file only appends its new entry
+        path, contents = self._files.items()[0]
+        os.remove(path)
+        self.exile_resolve(path)
+
+        with open(SNAPSHOT_PATH, 'r') as file:
+            after = file.read()
+        self.assertTrue(after.startswith(before))
+        self.assertEqual(len(after.splitlines()), len(before.splitlines()) + 1)
+        self.assertSnapshot(self._files)
+
+    def test_torn(self):
+        # a record cut short by a crash is ignored and overwritten
+        with open(SNAPSHOT_PATH, 'a') as file:
+            file.write('["a", "trunc')
+
+        path, contents = self._files.items()[0]
+        os.remove(path)
+        self.exile_resolve(path)
+        self.assertResolved(path, contents)
+        self.assertSnapshot(self._files)
+
+    def test_legacy(self):
+        # older versions stored the snapshot as a nested dict
+        legacy = {}
+        for path, value in self.readSnapshot().iteritems():
+            parts = path.split(os.sep)
+            parent = legacy
+            for part in parts[:-1]:
+                parent = parent.setdefault(part, {})
+            parent[parts[-1]] = value
+
+        with open(SNAPSHOT_PATH, 'w') as file:
+            json.dump(legacy, file)
+
+        path, contents = self._files.items()[0]
+        before = os.path.getmtime(path)
+        self.exile_resolve(*self._files.keys())
+        self.assertEqual(before, os.path.getmtime(path))
+        self.assertSnapshot(self._files)
+
+class HashCacheTest(ExileTest):
+    def setUp(self):
+        self._files = {
+            'a': 'a'
+        }
+        super(HashCacheTest, self).setUp()
+
+        # backdate the file so the snapshot entry is clearly older than the snapshot itself
+        self.__mtime = time.time() - 10
+        os.utime('a', (self.__mtime, self.__mtime))
+        self.exile_add('a')
+
+    def manifestHash(self, path):
+        with open('exile.manifest', 'r') as file:
+            return json.load(file)['files'][path]
+
+    def test_unchanged(self):
+        # same size and mtime, so add should trust the snapshot instead of rehashing
+        create_file(self._dir, 'a', 'b')
+        os.utime('a', (self.__mtime, self.__mtime))
+
+        self.exile_add('a')
+        self.assertEqual(self.manifestHash('a'), hashlib.sha1('a').hexdigest())
+
+    def test_changed(self):
+        create_file(self._dir, 'a', 'b')
+        os.utime('a', (self.__mtime + 1, self.__mtime + 1))
+
+        self.exile_add('a')
+        self.assertEqual(self.manifestHash('a'), hashlib.sha1('b').hexdigest())
@@ -1,9 +1,14 @@
 import hashlib
 import imp
+import json
+import multiprocessing
 import os
 import random
+import shutil
 import struct
 import tempfile
+import threading
+import time
 import unittest
 
 class TestHash(unittest.TestCase):
@@ -37,4 +42,1023 @@ class TestHash(unittest.TestCase):
         self.trySize(100000)
 
     def test_large(self):
-        self.trySize(2000000)
\ No newline at end of file
+        self.trySize(2000000)
+
+class TestAlgorithms(unittest.TestCase):
+    def setUp(self):
+        random.seed(563143)
+
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__hashing = imp.load_module('exile', file, path, desc).hashing
+
+        # use tiny leaves so tree hashes span several leaves without large files
+        self.__leaf_size = self.__hashing.LEAF_SIZE
+        self.__hashing.LEAF_SIZE = 1024
+
+        tmpfd, self.__tmp = tempfile.mkstemp()
+        with os.fdopen(tmpfd, 'wb') as file:
+            for _ in range(1000):
+                file.write(struct.pack('<Q', random.getrandbits(64)))
+
+    def tearDown(self):
+        self.__hashing.LEAF_SIZE = self.__leaf_size
+        os.remove(self.__tmp)
+
+    def test_names(self):
+        with open(self.__tmp, 'rb') as file:
+            contents = file.read()
+
+        self.assertEqual(self.__hashing.hash(self.__tmp), hashlib.sha1(contents).hexdigest())
+        self.assertEqual(self.__hashing.hash(self.__tmp, 'sha256'), 'sha256-' + hashlib.sha256(contents).hexdigest())
+
+        for name in [self.__hashing.hash(self.__tmp, algorithm) for algorithm in ['sha1', 'sha256', 'sha1-tree']]:
+            self.assertEqual(self.__hashing.name(self.__hashing.algorithm(name), self.__hashing.digest(name)), name)
+
+    def test_tree(self):
+        # the parallel whole-file hash must match streaming the file through the hash object
+        h = self.__hashing.new('sha1-tree')
+        with open(self.__tmp, 'rb') as file:
+            for block in iter(lambda: file.read(100), ''):
+                h.update(block)
+
+        self.assertEqual(self.__hashing.hash(self.__tmp, 'sha1-tree'), 'sha1-tree-' + h.hexdigest())
+        self.assertNotEqual(self.__hashing.hash(self.__tmp, 'sha1-tree'), 'sha1-tree-' + self.__hashing.hash(self.__tmp))
+
+    def test_tree_prefixes(self):
+        # leaves and the root are hashed after different prefixes
+        with open(self.__tmp, 'rb') as file:
+            leaves = [hashlib.sha1('\x00' + block).digest() for block in iter(lambda: file.read(1024), '')]
+
+        self.assertEqual(self.__hashing.hash(self.__tmp, 'sha1-tree'), 'sha1-tree-' + hashlib.sha1('\x01' + ''.join(leaves)).hexdigest())
+
+    def test_unknown(self):
+        self.assertRaises(RuntimeError, self.__hashing.new, 'nosuchhash')
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__remote = imp.load_module('exile', file, path, desc).remote
+
+        self.__dir = os.path.realpath(tempfile.mkdtemp())
+        for name in 'abc':
+            with open(self.path(name), 'wb') as file:
+                file.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.__dir)
+
+    def path(self, name):
+        return os.path.join(self.__dir, name)
+
+    def test_processes(self):
+        # each snapshot stands in for a process sharing the log, and has read it before the others write
+        first, second, third = [self.__remote.Snapshot(self.__dir) for _ in range(3)]
+        for snapshot in (first, second, third):
+            snapshot.get(self.path('a'))
+
+        first.add(self.path('a'), 'hash-a')
+        first.write()
+        second.add(self.path('b'), 'hash-b')
+        second.write()
+        third.add(self.path('c'), 'hash-c')
+        third.write()
+
+        snapshot = self.__remote.Snapshot(self.__dir)
+        for name in 'abc':
+            self.assertEqual(snapshot.get(self.path(name))[0], 'hash-' + name)
+
+class TestFileMapping(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__files = imp.load_module('exile', file, path, desc).files
+
+        self.__root = os.path.realpath(tempfile.mkdtemp())
+        self.__config = {
+            'a': '1',
+            'b': {
+                'c': '2',
+                'd': {
+                    'e': '3'
+                }
+            }
+        }
+        self.__mapping = self.__files.FileMapping(self.__root, self.__config, silent=True)
+
+    def tearDown(self):
+        os.rmdir(self.__root)
+
+    def path(self, *parts):
+        return os.path.join(self.__root, *parts)
+
+    def test_get(self):
+        self.assertEqual(self.__mapping.get(self.path('a')), '1')
+        self.assertEqual(self.__mapping.get(self.path('b', 'd', 'e')), '3')
+        self.assertEqual(self.__mapping.get(self.path('b')), None)
+        self.assertEqual(self.__mapping.get(self.path('missing')), None)
+        self.assertEqual(self.__mapping.get(os.path.dirname(self.__root)), None)
+
+    def test_items(self):
+        self.assertEqual(sorted(self.__mapping.items(self.path('b'))),
+                         [(self.path('b', 'c'), '2'), (self.path('b', 'd', 'e'), '3')])
+        self.assertEqual(len(self.__mapping.paths(self.__root)), 3)
+
+    def test_add_remove(self):
+        self.__mapping.get(self.path('a'))   # build the index before changing the mapping
+
+        self.assertTrue(self.__mapping.add(self.path('b', 'd', 'f'), '4'))
+        self.assertFalse(self.__mapping.add(self.path('b', 'd', 'f'), '4'))
+        self.assertEqual(self.__mapping.get(self.path('b', 'd', 'f')), '4')
+        self.assertEqual(self.__config['b']['d']['f'], '4')
+
+        removed = self.__mapping.remove(self.path('b', 'd'))
+        self.assertEqual(removed.get(self.path('b', 'd', 'e')), '3')
+        self.assertEqual(self.__mapping.get(self.path('b', 'd', 'e')), None)
+        self.assertEqual(self.__mapping.get(self.path('b', 'd', 'f')), None)
+        self.assertEqual(self.__mapping.hashes(), set(['1', '2']))
+
+    def test_replaced_directory(self):
+        os.mkdir(self.path('x'))
+        self.assertEqual(self.__mapping.get(self.path('x', 'c')), None)
+
+        # a directory resolved by one mapping is resolved again by the next
+        os.rmdir(self.path('x'))
+        os.symlink('b', self.path('x'))
+        try:
+            mapping = self.__files.FileMapping(self.__root, self.__config, silent=True)
+            self.assertEqual(mapping.get(self.path('x', 'c')), '2')
+        finally:
+            os.remove(self.path('x'))
+
+class TestManifestIndex(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__index = imp.load_module('exile', file, path, desc).index
+
+        self.__root = os.path.realpath(tempfile.mkdtemp())
+        self.__manifest = os.path.join(self.__root, 'exile.manifest')
+        self.__config = {
+            'version': 2,
+            'remote': { 'type': 'local' },
+            'files': {
+                'a': '1',
+                'b': {
+                    'c': '2',
+                    'd': {
+                        'e': 'sha256-3'
+                    }
+                },
+                # sort next to the files in "b", but aren't in it
+                'b.x': '4',
+                'bb': '5'
+            }
+        }
+        with open(self.__manifest, 'w') as file:
+            file.write('{}')
+        self.__index.write(self.__manifest, self.__config)
+        self.__mapping = self.__index.load(self.__manifest)
+
+    def tearDown(self):
+        if self.__mapping is not None:
+            self.__mapping.close()
+        shutil.rmtree(self.__root)
+
+    def path(self, *parts):
+        return os.path.join(self.__root, *parts)
+
+    def test_config(self):
+        self.assertEqual(self.__mapping.config(), { 'version': 2, 'remote': { 'type': 'local' } })
+
+    def test_get(self):
+        self.assertEqual(self.__mapping.get(self.path('a')), '1')
+        self.assertEqual(self.__mapping.get(self.path('b', 'd', 'e')), 'sha256-3')
+        self.assertEqual(self.__mapping.get(self.path('bb')), '5')
+        self.assertEqual(self.__mapping.get(self.path('b')), None)
+        self.assertEqual(self.__mapping.get(self.path('missing')), None)
+        self.assertEqual(self.__mapping.get(os.path.dirname(self.__root)), None)
+
+    def test_items(self):
+        self.assertEqual(self.__mapping.items(self.path('b')),
+                         [(self.path('b', 'c'), '2'), (self.path('b', 'd', 'e'), 'sha256-3')])
+        self.assertEqual(self.__mapping.items(self.path('b.x')), [(self.path('b.x'), '4')])
+        self.assertEqual(self.__mapping.items(self.path('missing')), [])
+        self.assertEqual(len(self.__mapping.paths(self.__root)), 5)
+        self.assertEqual(self.__mapping.hashes(), set(['1', '2', 'sha256-3', '4', '5']))
+
+    def test_stale(self):
+        # same size and mtime, but the index was written too recently to trust them
+        stat = os.stat(self.__manifest)
+        with open(self.__manifest, 'w') as file:
+            file.write('[]')
+        os.utime(self.__manifest, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(self.__index.load(self.__manifest), None)
+
+        # a different size is always a change
+        with open(self.__manifest, 'w') as file:
+            file.write('{ }')
+        self.__index.write(self.__manifest, self.__config)
+        self.assertNotEqual(self.__index.load(self.__manifest), None)
+        with open(self.__manifest, 'w') as file:
+            file.write('{  }')
+        self.assertEqual(self.__index.load(self.__manifest), None)
+
+    def test_trusted(self):
+        # an index written together with the manifest, since long enough for the mtime to be trusted
+        old = time.time() - 10
+        os.utime(self.__manifest, (old, old))
+        self.__index.write(self.__manifest, self.__config)
+        os.utime(self.__index.index_path(self.__manifest), (old, old))
+
+        digests = []
+        manifest_digest = self.__index.manifest_digest
+        def counting_digest(manifest):
+            digests.append(manifest)
+            return manifest_digest(manifest)
+        self.__index.manifest_digest = counting_digest
+        try:
+            # the contents are checked once, after which the mtime is enough
+            for _ in range(2):
+                index = self.__index.load(self.__manifest)
+                self.assertNotEqual(index, None)
+                index.close()
+        finally:
+            self.__index.manifest_digest = manifest_digest
+        self.assertEqual(len(digests), 1)
+
+class TestManifestWriter(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__manifest = imp.load_module('exile', file, path, desc).manifest
+
+        self.__dir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__dir, 'exile.manifest')
+        self.__config = {
+            'version': 2,
+            'remote': {
+                'type': 'local',
+                'materialize': ['hardlink', 'copy'],
+                'cache_age': 1.5,
+                'options': { 'a': [1, { 'b': None }], 'c': {} }
+            },
+            'files': {
+                u'caf\xe9': '1',
+                'b': {
+                    'quote"': '2',
+                    'empty': {},
+                    'd': { 'e': 'sha256-3' }
+                }
+            }
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.__dir)
+
+    def expected(self):
+        return json.dumps(self.__config, indent=4, sort_keys=True)
+
+    def contents(self):
+        with open(self.__path, 'rb') as file:
+            return file.read()
+
+    def test_format(self):
+        self.assertEqual(''.join(self.__manifest.iterencode(self.__config)), self.expected())
+
+        # the output is the same however it is split into chunks
+        chunk_entries = self.__manifest.CHUNK_ENTRIES
+        self.__manifest.CHUNK_ENTRIES = 1
+        try:
+            self.assertEqual(''.join(self.__manifest.iterencode(self.__config)), self.expected())
+        finally:
+            self.__manifest.CHUNK_ENTRIES = chunk_entries
+
+    def test_update(self):
+        self.assertTrue(self.__manifest.write(self.__path, self.__config))
+        self.assertEqual(self.contents(), self.expected())
+
+        # an unchanged manifest isn't modified
+        os.utime(self.__path, (0, 0))
+        self.assertFalse(self.__manifest.write(self.__path, self.__config))
+        self.assertEqual(os.path.getmtime(self.__path), 0)
+
+        self.__config['files']['b']['quote"'] = '22'
+        self.assertTrue(self.__manifest.write(self.__path, self.__config))
+        self.assertEqual(self.contents(), self.expected())
+
+        # a shorter manifest is truncated
+        del self.__config['files']['b']
+        self.assertTrue(self.__manifest.write(self.__path, self.__config))
+        self.assertEqual(self.contents(), self.expected())
+
+    def test_replace(self):
+        self.__manifest.write(self.__path, self.__config)
+        os.chmod(self.__path, 0640)
+        inode = os.stat(self.__path).st_ino
+
+        # a changed manifest is replaced by a new file with the same mode, leaving no temporary file
+        self.__config['files']['b']['quote"'] = '22'
+        self.assertTrue(self.__manifest.write(self.__path, self.__config))
+        self.assertNotEqual(os.stat(self.__path).st_ino, inode)
+        self.assertEqual(os.stat(self.__path).st_mode & 0777, 0640)
+        self.assertEqual(os.listdir(self.__dir), ['exile.manifest'])
+
+        # a failed write leaves the manifest as it was
+        def fail():
+            yield 'partial'
+            raise RuntimeError("failed")
+        iterencode = self.__manifest.iterencode
+        self.__manifest.iterencode = lambda config: fail()
+        try:
+            self.assertRaises(RuntimeError, self.__manifest.write, self.__path, self.__config)
+        finally:
+            self.__manifest.iterencode = iterencode
+        self.assertEqual(self.contents(), self.expected())
+        self.assertEqual(os.listdir(self.__dir), ['exile.manifest'])
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__worker = imp.load_module('exile', file, path, desc).worker
+
+        self.__now = 0.0
+
+    def clock(self):
+        return self.__now
+
+    def window(self, concurrency, latency, saturated=True):
+        """Completes a window of tasks that each took latency seconds, running concurrency.limit at a time."""
+        self.__now += latency
+        for i in range(concurrency.limit):
+            concurrency.record(latency, saturated)
+
+    def test_slow_start(self):
+        concurrency = self.__worker.Concurrency(16, initial=2, clock=self.clock)
+        self.window(concurrency, 1.0)
+        self.assertEqual(concurrency.limit, 4)
+        self.window(concurrency, 1.0)
+        self.assertEqual(concurrency.limit, 8)
+
+        # capped by the maximum
+        self.window(concurrency, 1.0)
+        self.window(concurrency, 1.0)
+        self.assertEqual(concurrency.limit, 16)
+
+    def test_unsaturated(self):
+        concurrency = self.__worker.Concurrency(16, initial=2, clock=self.clock)
+        self.window(concurrency, 1.0, saturated=False)
+        self.assertEqual(concurrency.limit, 2)
+
+    def test_congestion(self):
+        concurrency = self.__worker.Concurrency(64, initial=8, clock=self.clock)
+        self.window(concurrency, 1.0)
+        self.assertEqual(concurrency.limit, 16)
+
+        # twice the requests at once, but each takes four times as long
+        self.window(concurrency, 4.0)
+        self.assertEqual(concurrency.limit, 8)
+
+        # after congestion the limit grows additively
+        self.window(concurrency, 1.0)
+        self.assertEqual(concurrency.limit, 9)
+
+class TestAsyncCommunicator(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__exile = imp.load_module('exile', file, path, desc)
+
+        self.__dir = tempfile.mkdtemp()
+        config = { 'type': 'local', 'location': self.__dir }
+        self.__comm = self.__exile.worker.AsyncCommunicator(self.__dir, os.path.join(self.__dir, 'cache'), config, False)
+
+    def tearDown(self):
+        self.__exile.remote.snapshot = None
+        shutil.rmtree(self.__dir)
+
+    def test_results(self):
+        threads = threading.active_count()
+        futures = [self.__comm.submit(lambda comm, i: i * 2, i) for i in range(100)]
+        self.__comm.join()
+        self.assertEqual([future.result() for future in futures], [i * 2 for i in range(100)])
+
+        # join stops the worker threads
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_error(self):
+        def fail(comm):
+            raise RuntimeError("failed")
+
+        self.__exile.log.verbosity = -1
+        try:
+            failed = self.__comm.submit(fail)
+            self.assertRaises(RuntimeError, failed.result)
+
+            # the error is reported to the submitting thread without waiting for a timeout
+            self.assertRaises(SystemExit, self.__comm.submit, lambda comm: None)
+            self.assertRaises(SystemExit, self.__comm.join)
+        finally:
+            self.__exile.log.verbosity = 2
+
+    def resolve(self, label, count, load):
+        """Resolves count objects from the repository with an adapter module loaded by load, returning the network stage's stats."""
+
+        worker = self.__exile.worker
+        config = { 'type': 'local', 'location': self.__dir }
+        load_comm_module = worker.load_comm_module
+        worker.load_comm_module = load
+        try:
+            comm = worker.AsyncCommunicator(self.__dir, os.path.join(self.__dir, label + '-cache'), config, False)
+        finally:
+            worker.load_comm_module = load_comm_module
+
+        for i in range(count):
+            comm.get(hashlib.sha1(str(i)).hexdigest(), os.path.join(self.__dir, label + str(i)))
+        comm.join()
+        for i in range(count):
+            with open(os.path.join(self.__dir, label + str(i)), 'rb') as file:
+                self.assertEqual(file.read(), str(i))
+        return comm.stats()['network']
+
+    def test_batching(self):
+        worker = self.__exile.worker
+        config = { 'type': 'local', 'location': self.__dir }
+        local = worker.load_comm_module(config).Communicator(config)
+        source = os.path.join(self.__dir, 'source')
+        for i in range(10):
+            with open(source, 'wb') as file:
+                file.write(str(i))
+            local.put(source, hashlib.sha1(str(i)).hexdigest())
+
+        # the local adapter transfers its objects in batches of its batch_size, each in a single task
+        self.assertEqual(self.resolve('batched', 10, worker.load_comm_module)['tasks'], 1)
+
+        load_comm_module = worker.load_comm_module
+        def load_smaller(config):
+            module = load_comm_module(config)
+            module.batch_size = 4
+            return module
+        self.assertEqual(self.resolve('smaller', 10, load_smaller)['tasks'], 3)
+
+        # adapters that don't declare a batch_size transfer an object per task (loading the adapter
+        # again restores it)
+        def load_single(config):
+            module = load_comm_module(config)
+            del module.batch_size
+            return module
+        self.assertEqual(self.resolve('single', 10, load_single)['tasks'], 10)
+
+class TestStage(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__worker = imp.load_module('exile', file, path, desc).worker
+
+    def stage(self, threads, capacity):
+        worker = self.__worker
+        return worker.Stage('test', worker.Concurrency(threads, threads), capacity, lambda: None)
+
+    def test_stats(self):
+        stage = self.stage(2, 1)
+        for i in range(10):
+            stage.submit(lambda context: time.sleep(0.01))
+        stage.join()
+
+        stats = stage.stats()
+        self.assertEqual(stats['tasks'], 10)
+        self.assertEqual(stats['threads'], 2)
+        self.assertTrue(0 < stats['utilization'] <= 1)
+        # the queue only holds one task, so submitting had to wait
+        self.assertTrue(stats['blocked'] > 0)
+
+    def test_error(self):
+        stage = self.stage(1, 10)
+
+        started = threading.Event()
+        release = threading.Event()
+        def block(context):
+            started.set()
+            release.wait()
+            raise RuntimeError("failed")
+
+        failed = stage.submit(block)
+        started.wait()
+        waiting = stage.submit(lambda context: None)
+        release.set()
+
+        self.assertRaises(RuntimeError, failed.result)
+        self.assertRaises(self.__worker.Cancelled, waiting.result)
+        self.assertRaises(self.__worker.Cancelled, stage.join)
+        self.assertRaises(self.__worker.Cancelled, stage.submit, lambda context: None)
+
+    def test_close(self):
+        threads = threading.active_count()
+        stage = self.stage(4, 10)
+        futures = [stage.submit(lambda context: time.sleep(0.01)) for i in range(10)]
+        stage.close()
+
+        # the tasks already submitted run, then every thread exits
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(threading.active_count(), threads)
+        self.assertRaises(RuntimeError, stage.submit, lambda context: None)
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__remote = imp.load_module('exile', file, path, desc).remote
+
+        self.__dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.__remote.snapshot = None
+        shutil.rmtree(self.__dir)
+
+    def concurrently(self, count, function):
+        """Calls function from count threads at once, returning the exceptions they raised."""
+        errors = []
+        def main():
+            try:
+                function()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=main) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
+    def test_fetch(self):
+        class Communicator:
+            gets = 0
+            def get(self, hash, dest):
+                Communicator.gets += 1
+                time.sleep(0.1)
+                with open(dest, 'wb') as file:
+                    file.write('contents')
+
+        object = hashlib.sha1('contents').hexdigest()
+        comm = self.__remote.CachedCommunicator(self.__dir, os.path.join(self.__dir, 'cache'), False, Communicator())
+
+        # every thread gets the complete object, but it is only downloaded once
+        def fetch():
+            with open(comm.fetch(object), 'rb') as file:
+                self.assertEqual(file.read(), 'contents')
+        self.assertEqual(self.concurrently(10, fetch), [])
+        self.assertEqual(Communicator.gets, 1)
+
+    def test_fetch_many(self):
+        objects = dict((hashlib.sha1(str(i)).hexdigest(), str(i)) for i in range(5))
+        downloaded = []
+        class Communicator:
+            def get_many(self, items):
+                time.sleep(0.1)
+                for hash, dest in items:
+                    downloaded.append(hash)
+                    with open(dest, 'wb') as file:
+                        file.write(objects[hash])
+
+        comm = self.__remote.CachedCommunicator(self.__dir, os.path.join(self.__dir, 'cache'), False, Communicator())
+        hashes = sorted(objects)
+
+        # batches and single fetches of overlapping objects download each object once
+        def fetch_many():
+            for hash, path in zip(hashes, comm.fetch_many(hashes)):
+                with open(path, 'rb') as file:
+                    self.assertEqual(file.read(), objects[hash])
+        self.assertEqual(self.concurrently(5, fetch_many), [])
+        self.assertEqual(sorted(downloaded), hashes)
+
+    def test_run_many(self):
+        flight = self.__remote.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def first(keys):
+            calls.append(keys)
+            started.set()
+            release.wait()
+
+        t = threading.Thread(target=flight.run_many, args=(['a', 'b'], first))
+        t.start()
+        started.wait()
+
+        # only the key that isn't in flight is run, and the others are waited for
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual(flight.run_many(['b', 'c', 'c'], calls.append), ['c'])
+        self.assertTrue(release.is_set())
+        t.join()
+        self.assertEqual(calls, [['a', 'b'], ['c']])
+
+    def test_error(self):
+        flight = self.__remote.SingleFlight()
+        calls = []
+        def fail():
+            calls.append(None)
+            time.sleep(0.1)
+            raise RuntimeError("failed")
+
+        errors = self.concurrently(5, lambda: flight.run('key', fail))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(errors), 5)
+
+        # once a call completes, the next one runs again
+        self.assertRaises(RuntimeError, flight.run, 'key', fail)
+        self.assertEqual(len(calls), 2)
+
+class TestFastCopy(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__fastcopy = imp.load_module('exile', file, path, desc).cache.fastcopy
+        self.__methods = self.__fastcopy.KERNEL_COPIES
+
+        self.__dir = tempfile.mkdtemp()
+        self.__source = os.path.join(self.__dir, 'source')
+        self.__dest = os.path.join(self.__dir, 'dest')
+        with open(self.__source, 'wb') as file:
+            file.write('contents')
+
+    def tearDown(self):
+        self.__fastcopy.KERNEL_COPIES = self.__methods
+        shutil.rmtree(self.__dir)
+
+    def assertCopied(self):
+        with open(self.__dest, 'rb') as file:
+            self.assertEqual(file.read(), 'contents')
+
+    def test_nothing_copied(self):
+        # a kernel copy that copies nothing falls through to the next method
+        self.__fastcopy.KERNEL_COPIES = [lambda src, dst, count: 0]
+        self.__fastcopy.copyfile(self.__source, self.__dest)
+        self.assertCopied()
+
+    def test_short_copy(self):
+        def partial(src, dst, count):
+            if os.lseek(dst, 0, os.SEEK_CUR):
+                return 0
+            return os.write(dst, os.read(src, 1))
+
+        self.__fastcopy.KERNEL_COPIES = [partial]
+        self.assertRaises(IOError, self.__fastcopy.copyfile, self.__source, self.__dest)
+
+    def test_no_size(self):
+        # files like those in /proc report no size, but still have contents
+        if not os.path.exists('/proc/self/status'):
+            self.skipTest("no /proc filesystem")
+        self.__fastcopy.copyfile('/proc/self/status', self.__dest)
+        self.assertTrue(os.path.getsize(self.__dest) > 0)
+
+class TestObjectCache(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__cache = imp.load_module('exile', file, path, desc).cache
+
+        self.__dir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__dir, 'cache')
+        self.__object = hashlib.sha1('contents').hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.__dir)
+
+    def assertClean(self):
+        """Asserts that no temporary files or claims were left in the cache."""
+        self.assertEqual([name for name in os.listdir(self.__path) if name.startswith(('.tmp-', '.claim-'))], [])
+
+    def test_processes(self):
+        log = os.path.join(self.__dir, 'downloads')
+        def get(tmp):
+            with open(log, 'a') as file:
+                file.write('download\n')
+            time.sleep(0.2)
+            with open(tmp, 'wb') as file:
+                file.write('contents')
+
+        def main():
+            cache = self.__cache.ObjectCache(self.__path)
+            cache.download(self.__object, get)
+            with open(cache.path(self.__object), 'rb') as file:
+                os._exit(0 if file.read() == 'contents' else 1)
+
+        # every process sees the complete object, but only one of them downloads it
+        processes = [multiprocessing.Process(target=main) for _ in range(8)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual([p.exitcode for p in processes], [0] * len(processes))
+        with open(log) as file:
+            self.assertEqual(file.read(), 'download\n')
+        self.assertClean()
+
+    def test_stale_claim(self):
+        cache = self.__cache.ObjectCache(self.__path)
+
+        # a claim that is no longer being refreshed belongs to a process that died
+        claim = os.path.join(self.__path, '.claim-' + self.__object)
+        open(claim, 'w').close()
+        old = time.time() - self.__cache.CLAIM_STALE_AGE - 1
+        os.utime(claim, (old, old))
+
+        def get(tmp):
+            with open(tmp, 'wb') as file:
+                file.write('contents')
+        self.assertTrue(cache.download(self.__object, get))
+        self.assertFalse(cache.download(self.__object, get))
+        self.assertClean()
+
+    def test_heartbeat(self):
+        path = os.path.join(self.__dir, 'claim')
+        open(path, 'w').close()
+        os.utime(path, (0, 0))
+
+        # the mtime is refreshed until the heartbeat stops, which it does without waiting out the interval
+        threads = threading.active_count()
+        heartbeat = self.__cache.Heartbeat(0.01)
+        heartbeat.add(path)
+        time.sleep(0.2)
+        self.assertGreater(os.path.getmtime(path), 0)
+        start = time.time()
+        heartbeat.stop()
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_error(self):
+        cache = self.__cache.ObjectCache(self.__path)
+
+        def fail(tmp):
+            with open(tmp, 'wb') as file:
+                file.write('partial')
+            raise RuntimeError("failed")
+        self.assertRaises(RuntimeError, cache.download, self.__object, fail)
+
+        # nothing is inserted, and the next attempt can claim the object again
+        self.assertFalse(os.path.exists(cache.path(self.__object)))
+        self.assertClean()
+
+    def test_ingest(self):
+        cache = self.__cache.ObjectCache(self.__path)
+        hashing = self.__cache.hashing
+        source = os.path.join(self.__dir, 'source')
+        with open(source, 'wb') as file:
+            file.write('contents' * 1024)
+
+        # small and large files, and a tree algorithm
+        buffer_size = self.__cache.INGEST_BUFFER_SIZE
+        for algorithm, size in [('sha1', 8192), ('sha1', 0), ('sha256-tree', 8192)]:
+            self.__cache.INGEST_BUFFER_SIZE = size
+            try:
+                name = cache.ingest(source, algorithm)
+                inode = os.stat(cache.path(name)).st_ino
+
+                # an object that is already cached is left in place
+                self.assertEqual(cache.ingest(source, algorithm), name)
+            finally:
+                self.__cache.INGEST_BUFFER_SIZE = buffer_size
+
+            self.assertEqual(name, hashing.hash(source, algorithm))
+            self.assertEqual(os.stat(cache.path(name)).st_ino, inode)
+            with open(cache.path(name), 'rb') as file:
+                self.assertEqual(file.read(), 'contents' * 1024)
+        self.assertClean()
+
+class TestBatchedCommunicator(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        self.__remote = imp.load_module('exile', file, path, desc).remote
+
+        # look up objects however small they are
+        self.__lookup_min_size = self.__remote.inventory.LOOKUP_MIN_SIZE
+        self.__remote.inventory.LOOKUP_MIN_SIZE = 0
+
+        self.__dir = tempfile.mkdtemp()
+        self.__objects = dict((hashlib.sha1(str(i)).hexdigest(), str(i)) for i in range(5))
+
+    def tearDown(self):
+        self.__remote.inventory.LOOKUP_MIN_SIZE = self.__lookup_min_size
+        self.__remote.snapshot = None
+        shutil.rmtree(self.__dir)
+
+    def communicator(self, comm):
+        return self.__remote.CachedCommunicator(self.__dir, os.path.join(self.__dir, 'cache'), False, comm)
+
+    def test_fetch_many(self):
+        objects = self.__objects
+        calls = []
+        class Communicator:
+            def get_many(self, items):
+                calls.append([hash for hash, dest in items])
+                for hash, dest in items:
+                    with open(dest, 'wb') as file:
+                        file.write(objects[hash])
+
+        comm = self.communicator(Communicator())
+        hashes = sorted(objects)
+        paths = comm.fetch_many(hashes + hashes[:1])
+        for hash, path in zip(hashes, paths):
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), objects[hash])
+
+        # every missing object is downloaded with a single call, and only once
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(calls[0]), hashes)
+
+        comm.fetch_many(hashes)
+        self.assertEqual(len(calls), 1)
+
+    def test_put_many(self):
+        uploads = []
+        class Communicator:
+            def put_many(self, items):
+                uploads.append([hash for source, hash in items])
+
+            def exists_many(self, hashes):
+                return set(hashes[:2])
+
+        comm = self.communicator(Communicator())
+        hashes = sorted(self.__objects)
+        items = []
+        for hash in hashes:
+            source = os.path.join(self.__dir, hash)
+            with open(source, 'wb') as file:
+                file.write(self.__objects[hash])
+            items.append((source, hash))
+
+        # objects that already exist are skipped
+        comm.put_many(items)
+        self.assertEqual(uploads, [hashes[2:]])
+
+    def test_fallback(self):
+        objects = self.__objects
+        class Communicator:
+            def get(self, hash, dest):
+                with open(dest, 'wb') as file:
+                    file.write(objects[hash])
+
+        # adapters without get_many are used one object at a time
+        comm = self.communicator(Communicator())
+        hashes = sorted(objects)
+        for hash, path in zip(hashes, comm.fetch_many(hashes)):
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), objects[hash])
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        me = os.path.dirname(os.path.realpath(__file__))
+        root = os.path.dirname(os.path.dirname(me))
+        file, path, desc = imp.find_module('exile', [root])
+        exile = imp.load_module('exile', file, path, desc)
+        self.__remote = exile.remote
+        self.__inventory = exile.inventory
+
+        # look up objects however small they are, unless a test says otherwise
+        self.__lookup_min_size = self.__inventory.LOOKUP_MIN_SIZE
+        self.__inventory.LOOKUP_MIN_SIZE = 0
+
+        self.__dir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__dir, 'inventory')
+
+    def tearDown(self):
+        self.__inventory.LOOKUP_MIN_SIZE = self.__lookup_min_size
+        self.__remote.snapshot = None
+        shutil.rmtree(self.__dir)
+
+    def test_persist(self):
+        inventory = self.__inventory.Inventory(self.__path)
+        inventory.add(['1', '2'])
+        inventory.write()
+        inventory.add(['3'])
+        inventory.write()
+
+        inventory = self.__inventory.Inventory(self.__path)
+        for name in ['1', '2', '3']:
+            self.assertTrue(inventory.contains(name))
+        self.assertFalse(inventory.contains('4'))
+
+    def test_path(self):
+        # tuning the transfers doesn't change where objects are stored, so the inventory is kept
+        config = { 'type': 's3', 'bucket': 'bucket' }
+        tuned = dict(config, threads=8, part_size='8M', part_threads=2, multipart_threshold='32M', connections=4)
+        path = self.__inventory.inventory_path(self.__dir, config)
+        self.assertEqual(self.__inventory.inventory_path(self.__dir, tuned), path)
+        self.assertNotEqual(self.__inventory.inventory_path(self.__dir, dict(config, bucket='other')), path)
+
+    def test_prefix(self):
+        self.assertEqual(self.__inventory.prefix('3f786850e387550fdab836ed7e6dc881de23001b'), '3f')
+        self.assertEqual(self.__inventory.prefix('sha256-' + 'ab' * 32), 'sha256-ab')
+
+    def test_put(self):
+        listed = [hashlib.sha1(str(i)).hexdigest() for i in range(3)]
+        new = hashlib.sha1('new').hexdigest()
+        calls = []
+        class Communicator:
+            def list(self, prefix):
+                calls.append(prefix)
+                return [name for name in listed if name.startswith(prefix)]
+
+            def put(self, source, hash):
+                calls.append(hash)
+
+        inventory = self.__inventory.Inventory(self.__path)
+        comm = self.__remote.CachedCommunicator(self.__dir, os.path.join(self.__dir, 'cache'), False, Communicator(),
+                                                inventory=inventory)
+        source = os.path.join(self.__dir, 'source')
+        with open(source, 'wb') as file:
+            file.write('contents')
+
+        # objects found by listing their prefix aren't uploaded, and each prefix is only listed once
+        for hash in listed + listed:
+            comm.put(source, hash)
+        self.assertEqual(sorted(calls), sorted(set(hash[:2] for hash in listed)))
+
+        # an uploaded object is recorded, so it is only uploaded once
+        del calls[:]
+        comm.put(source, new)
+        comm.put(source, new)
+        self.assertEqual(calls, [new[:2], new])
+        self.assertTrue(inventory.contains(new))
+
+    def test_threshold(self):
+        # objects in the same prefix, of which the remote has every other one
+        names = [name for name in (hashlib.sha1(str(i)).hexdigest() for i in range(5000)) if name.startswith('00')]
+        names = names[:self.__inventory.LIST_THRESHOLD + 4]
+        remote = set(names[::2] + ['00' + '0' * 38])
+        calls = []
+        class Communicator:
+            def list(self, prefix):
+                calls.append('list')
+                return [name for name in remote if name.startswith(prefix)]
+
+            def exists_many(self, hashes):
+                calls.append('exists')
+                return set(hashes) & remote
+
+            def put(self, source, hash):
+                calls.append('put')
+
+        inventory = self.__inventory.Inventory(self.__path)
+        comm = self.__remote.CachedCommunicator(self.__dir, os.path.join(self.__dir, 'cache'), False, Communicator(),
+                                                inventory=inventory)
+        source = os.path.join(self.__dir, 'source')
+        with open(source, 'wb') as file:
+            file.write('contents')
+
+        # objects are looked up one at a time until enough of them fall under the prefix to list it
+        for name in names:
+            comm.put(source, name)
+        threshold = self.__inventory.LIST_THRESHOLD
+        self.assertEqual(calls.count('exists'), threshold - 1)
+        self.assertEqual(calls.count('list'), 1)
+        self.assertEqual(calls.count('put'), len(names) - len(names[::2]))
+
+        # only the objects the workspace uses are written to the file, not the whole listing
+        inventory.write()
+        inventory = self.__inventory.Inventory(self.__path)
+        for name in names:
+            self.assertTrue(inventory.contains(name))
+        self.assertFalse(inventory.contains('00' + '0' * 38))
+
+    def test_small(self):
+        self.__inventory.LOOKUP_MIN_SIZE = 1024
+        known = hashlib.sha1('known').hexdigest()
+        calls = []
+        class Communicator:
+            def exists_many(self, hashes):
+                calls.append('exists')
+                return set()
+
+            def put(self, source, hash):
+                calls.append(hash)
+
+        inventory = self.__inventory.Inventory(self.__path)
+        inventory.add([known])
+        comm = self.__remote.CachedCommunicator(self.__dir, os.path.join(self.__dir, 'cache'), False, Communicator(),
+                                                inventory=inventory)
+
+        # small objects are uploaded without asking the remote first, unless the inventory has them
+        for size in (1023, 1024):
+            source = os.path.join(self.__dir, str(size))
+            with open(source, 'wb') as file:
+                file.write('x' * size)
+            comm.put(source, str(size))
+            comm.put(source, known)
+        self.assertEqual(calls, ['1023', 'exists', '1024'])